@@ -1,8 +1,13 @@
 from __future__ import unicode_literals
 
-from django.contrib import admin
+import collections
 
+from django.contrib import admin, messages
+from django.utils.translation import gettext_lazy as _
+
+from .metadata import NOT_MODIFIED, REFRESH_FIELDS, UNCHANGED, UPDATED, refresh_metadata
 from .models import IdP, IdPAttribute, IdPUserDefaultValue
+from .sessions import terminate_sessions
 
 
 class IdPAttributeInline(admin.TabularInline):
@@ -28,7 +33,7 @@ class IdPAdmin(admin.ModelAdmin):
     )
     list_filter = ("is_active",)
     list_editable = ("sort_order", "is_active")
-    actions = ("import_metadata", "generate_certificates")
+    actions = ("import_metadata", "generate_certificates", "terminate_sessions")
     inlines = (IdPUserDefaultValueInline, IdPAttributeInline)
     fieldsets = (
         (
@@ -51,6 +56,7 @@ class IdPAdmin(admin.ModelAdmin):
                 "fields": (
                     "contact_name",
                     "contact_email",
+                    "key_algorithm",
                     "x509_certificate",
                     "private_key",
                     "certificate_expires",
@@ -66,6 +72,7 @@ class IdPAdmin(admin.ModelAdmin):
                     "metadata_xml",
                     "lowercase_encoding",
                     "last_import",
+                    "idp_certificate_expires",
                 )
             },
         ),
@@ -106,7 +113,7 @@ class IdPAdmin(admin.ModelAdmin):
             },
         ),
     )
-    readonly_fields = ("last_import", "last_login")
+    readonly_fields = ("last_import", "last_login", "idp_certificate_expires")
 
     def get_changeform_initial_data(self, request):
         return {
@@ -117,13 +124,51 @@ class IdPAdmin(admin.ModelAdmin):
             )
         }
 
+    @admin.display(description=_("IdP certificate expires"))
+    def idp_certificate_expires(self, obj):
+        # The first of the IdP signing certificates to expire.
+        return obj.get_keys().idp_certificate_expires if obj.pk else None
+
     def generate_certificates(self, request, queryset):
-        for idp in queryset:
-            idp.generate_certificate()
+        if len(queryset) == 1:
+            # A single key may be waiting in the key pool.
+            queryset[0].generate_certificate()
+        else:
+            IdP.generate_certificates(queryset)
 
     def import_metadata(self, request, queryset):
-        for idp in queryset:
+        # Refresh IdPs with a metadata URL concurrently, and only save the ones whose
+        # metadata changed.
+        counts = collections.Counter()
+        for idp, outcome, error in refresh_metadata(
+            queryset.exclude(metadata_url="").only(*REFRESH_FIELDS)
+        ):
+            counts[outcome] += 1
+            if error is not None:
+                self.message_user(
+                    request,
+                    _("Could not refresh metadata for %(idp)s: %(error)s")
+                    % {"idp": idp, "error": error},
+                    messages.ERROR,
+                )
+        for idp in queryset.filter(metadata_url=""):
             idp.import_metadata()
+            counts[UPDATED] += 1
+        self.message_user(
+            request,
+            _("Metadata %(updated)d updated, %(unchanged)d unchanged.")
+            % {
+                "updated": counts[UPDATED],
+                "unchanged": counts[UNCHANGED] + counts[NOT_MODIFIED],
+            },
+        )
+
+    @admin.action(description=_("Log out all registered sessions"))
+    def terminate_sessions(self, request, queryset):
+        count = sum(terminate_sessions(idp) for idp in queryset)
+        self.message_user(
+            request, _("%(count)d sessions logged out.") % {"count": count}
+        )
 
     def save_model(self, request, obj, form, change):
         super(IdPAdmin, self).save_model(request, obj, form, change)
@@ -6,3 +6,6 @@ class SPConfig(AppConfig):
     name = "sp"
     verbose_name = _("SAML SP")
     default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        from . import checks  # noqa: F401
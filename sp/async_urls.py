@@ -0,0 +1,14 @@
+from django.urls import path
+
+from . import async_views
+
+urlpatterns = [
+    path("", async_views.metadata, name="sp-idp-metadata"),
+    path("acs/", async_views.acs, name="sp-idp-acs"),
+    path("slo/", async_views.slo, name="sp-idp-slo"),
+    path("slo/soap/", async_views.slo_soap, name="sp-idp-slo-soap"),
+    path("login/", async_views.login, name="sp-idp-login"),
+    path("test/", async_views.login, {"test": True}, name="sp-idp-test"),
+    path("verify/", async_views.login, {"verify": True}, name="sp-idp-verify"),
+    path("logout/", async_views.logout, name="sp-idp-logout"),
+]
@@ -0,0 +1,346 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import REDIRECT_FIELD_NAME
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.http.response import HttpResponseBase
+from django.shortcuts import redirect, render
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import sessions, timestamps
+from .instrumentation import instrument, phase, set_idp
+from .keys import SAMLAuth
+from .slo import (
+    LogoutRequestError,
+    get_logout_request_targets,
+    is_signed_logout_request,
+    parse_soap_logout_request,
+    soap_fault_response,
+    soap_logout_response,
+)
+from .stores import get_replay_store
+from .utils import (
+    aget_recorded_response,
+    aget_request_idp,
+    aget_saml_session,
+    aget_session_nameid,
+    ais_logged_in_by,
+    apop_login_state,
+    arecord_response,
+    asave_login_state,
+    new_login_state_token,
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the thread pool used to run python3-saml's (CPU-bound) XML parsing, signing,
+    and signature validation off the event loop. The pool is bounded by
+    `SP_SAML_THREADS`, so a burst of logins queues up instead of starving the default
+    executor used by sync_to_async.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=getattr(settings, "SP_SAML_THREADS", 4),
+                thread_name_prefix="sp-saml",
+            )
+        return _executor
+
+
+@receiver(setting_changed)
+def _setting_changed(setting, **kwargs):
+    global _executor
+    if setting == "SP_SAML_THREADS":
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = None
+
+
+async def run_saml(func, *args, **kwargs):
+    """
+    Runs a python3-saml call in the SAML thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+async def get_saml_auth(request, idp):
+    return SAMLAuth(
+        await idp.aprepare_request(request),
+        old_settings=await idp.aget_saml_settings(),
+    )
+
+
+# Templates may touch request.user (via context processors), which isn't safe to do
+# from the event loop.
+arender = sync_to_async(render)
+
+
+@instrument("metadata")
+async def metadata(request, **kwargs):
+    with phase("lookup"):
+        idp = await aget_request_idp(request, **kwargs)
+    set_idp(idp)
+    with phase("build"):
+        md = await idp.aget_sp_metadata()
+    response = get_conditional_response(
+        request, etag=md.etag, last_modified=int(md.last_modified.timestamp())
+    )
+    if response is None:
+        response = HttpResponse(md.xml, content_type="text/xml")
+    max_age = getattr(settings, "SP_METADATA_MAX_AGE", 3600)
+    remaining = int((md.expires - timezone.now()).total_seconds())
+    patch_cache_control(response, public=True, max_age=max(0, min(max_age, remaining)))
+    response["ETag"] = md.etag
+    response["Last-Modified"] = http_date(md.last_modified.timestamp())
+    return response
+
+
+@csrf_exempt
+@require_POST
+@instrument("acs")
+async def acs(request, **kwargs):
+    with phase("lookup"):
+        idp = await aget_request_idp(request, **kwargs)
+    set_idp(idp)
+    relay_state = request.POST.get("RelayState")
+    with phase("state"):
+        state = await apop_login_state(idp, relay_state)
+    if state is None:
+        with phase("replay"):
+            redir = await _replayed_login_redirect(request, idp)
+        if redir:
+            return redirect(redir)
+        return await arender(
+            request,
+            "sp/error.html",
+            {
+                "idp": idp,
+                "state": relay_state,
+                "reason": _("The login request has expired or was already used."),
+            },
+            status=400,
+        )
+    with phase("settings"):
+        saml = await get_saml_auth(request, idp)
+    with phase("verify"):
+        await run_saml(saml.process_response, request_id=state["request_id"])
+    errors = saml.get_errors()
+    if errors:
+        return await arender(
+            request,
+            "sp/error.html",
+            {
+                "idp": idp,
+                "state": relay_state,
+                "errors": errors,
+                "reason": saml.get_last_error_reason(),
+            },
+            status=500,
+        )
+    mode = state["mode"]
+    redir = state["redirect"]
+    with phase("replay"):
+        recorded = await arecord_response(idp, saml, idp.get_login_redirect(redir))
+    if not recorded:
+        # A response we've already processed. If it was already used to log in this
+        # session (e.g. a double-submitted form), send the user where it went then.
+        if mode == "login" and await ais_logged_in_by(request, idp):
+            return redirect(await aget_recorded_response(idp, saml) or "/")
+        return await arender(
+            request,
+            "sp/error.html",
+            {
+                "idp": idp,
+                "state": relay_state,
+                "reason": _("This SAML response has already been processed."),
+            },
+            status=400,
+        )
+    if mode == "test":
+        attrs = []
+        for saml_attr, value in saml.get_attributes().items():
+            attr, created = await idp.attributes.aget_or_create(
+                saml_attribute=saml_attr
+            )
+            attrs.append((attr, "; ".join(value)))
+        return await arender(
+            request,
+            "sp/test.html",
+            {
+                "idp": idp,
+                "attrs": attrs,
+                "nameid": saml.get_nameid(),
+                "nameid_format": saml.get_nameid_format(),
+                "redir": redir,
+            },
+        )
+    user = await idp.aauthenticate(request, saml)
+    mapping = await idp.aget_attribute_mapping()
+    if mode == "verify":
+        if user == await request.auser():
+            return redirect(idp.get_login_redirect(redir))
+    elif user:
+        if isinstance(user, HttpResponseBase):
+            return user
+        await idp.alogin(request, user, saml)
+        await timestamps.atouch(idp)
+        with phase("redirect"):
+            return redirect(idp.get_login_redirect(redir))
+    return await arender(
+        request,
+        "sp/unauth.html",
+        {
+            "nameid": mapping.get_nameid(saml),
+            "idp": idp,
+            "verify": mode == "verify",
+        },
+        status=401,
+    )
+
+
+async def _replayed_login_redirect(request, idp):
+    """
+    Returns where a SAML response went when it logged in the current session, or None.
+    A double-submitted form gets here once the first submission has used up its login
+    state.
+    """
+    if get_replay_store() is None or not await ais_logged_in_by(request, idp):
+        return None
+    saml = await get_saml_auth(request, idp)
+    # The InResponseTo was checked against the login request the first time.
+    await run_saml(saml.process_response)
+    if saml.get_errors():
+        return None
+    return await aget_recorded_response(idp, saml)
+
+
+@instrument("slo")
+async def slo(request, **kwargs):
+    with phase("lookup"):
+        idp = await aget_request_idp(request, **kwargs)
+    set_idp(idp)
+    with phase("settings"):
+        saml = await get_saml_auth(request, idp)
+    state = request.GET.get("RelayState")
+    with phase("process"):
+        redir = await run_saml(saml.process_slo)
+    errors = saml.get_errors()
+    if errors:
+        return await arender(
+            request,
+            "sp/error.html",
+            {
+                "idp": idp,
+                "state": state,
+                "errors": errors,
+                "reason": saml.get_last_error_reason(),
+            },
+            status=500,
+        )
+    await idp.alogout(request)
+    if sessions.is_enabled() and is_signed_logout_request(request, saml):
+        with phase("terminate"):
+            _, nameid, session_indexes = await run_saml(
+                get_logout_request_targets,
+                saml.get_settings(),
+                saml.get_last_request_xml(),
+            )
+            await sessions.aterminate_sessions(idp, nameid, session_indexes)
+    if not redir:
+        redir = idp.get_logout_redirect(state)
+    return redirect(redir)
+
+
+@csrf_exempt
+@require_POST
+@instrument("slo_soap")
+async def slo_soap(request, **kwargs):
+    with phase("lookup"):
+        idp = await aget_request_idp(request, **kwargs)
+    set_idp(idp)
+    if not sessions.is_enabled():
+        return soap_fault_response("Back-channel logout is not enabled.")
+    with phase("settings"):
+        saml_settings = await idp.aget_saml_settings()
+    with phase("process"):
+        try:
+            request_id, nameid, session_indexes = await run_saml(
+                parse_soap_logout_request, saml_settings, request.body
+            )
+        except LogoutRequestError as e:
+            return soap_fault_response(str(e))
+    with phase("terminate"):
+        await sessions.aterminate_sessions(idp, nameid, session_indexes)
+    with phase("build"):
+        xml = await run_saml(
+            soap_logout_response,
+            saml_settings,
+            request_id,
+            sign=idp.logout_response_signed,
+        )
+    return HttpResponse(xml, content_type="text/xml")
+
+
+@instrument("login")
+async def login(request, test=False, verify=False, **kwargs):
+    with phase("lookup"):
+        idp = await aget_request_idp(request, **kwargs)
+    set_idp(idp)
+    with phase("settings"):
+        saml = await get_saml_auth(request, idp)
+    reauth = verify or "reauth" in request.GET
+    redir = request.GET.get(REDIRECT_FIELD_NAME, "")
+    nameid = await aget_session_nameid(request) if verify else None
+    token = new_login_state_token()
+    with phase("build"):
+        url = await run_saml(
+            saml.login, token, force_authn=reauth, name_id_value_req=nameid
+        )
+    mode = "test" if test else "verify" if verify else "login"
+    with phase("state"):
+        await asave_login_state(idp, token, redir, mode, saml.get_last_request_id())
+    return redirect(url)
+
+
+@instrument("logout")
+async def logout(request, **kwargs):
+    with phase("lookup"):
+        idp = await aget_request_idp(request, **kwargs)
+    set_idp(idp)
+    redir = idp.get_logout_redirect(request.GET.get(REDIRECT_FIELD_NAME))
+    with phase("settings"):
+        saml = await get_saml_auth(request, idp)
+    if saml.get_slo_url() and idp.logout_triggers_slo:
+        saml_session = await aget_saml_session(request)
+        with phase("build"):
+            url = await run_saml(
+                saml.logout,
+                redir,
+                name_id=saml_session.nameid if saml_session else None,
+                session_index=saml_session.session_index if saml_session else None,
+                name_id_format=saml_session.nameid_format if saml_session else None,
+            )
+        return redirect(url)
+    else:
+        await idp.alogout(request)
+        return redirect(redir)
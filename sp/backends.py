@@ -1,9 +1,16 @@
 import re
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Subquery
+from django.db.models.functions import Cast
+from django.utils import timezone
 
+from . import timestamps
+from .cache import idp_user_cache
 from .models import IdPUser
 
 UserModel = get_user_model()
@@ -16,9 +23,15 @@ class SAMLAuthenticationBackend(ModelBackend):
         look up and associate, or to use when creating a new User.
         """
         # Start with either the SAML nameid, or SAML attribute mapped to nameid.
-        username = idp.get_nameid(saml)
+        return self.make_username(idp, idp.get_nameid(saml))
+
+    def make_username(self, idp, nameid):
+        """
+        Generates a username for the given (potentially mapped) nameid, as used by
+        get_username.
+        """
         # Add IdP-specific prefix and suffix.
-        username = idp.username_prefix + username + idp.username_suffix
+        username = idp.username_prefix + nameid + idp.username_suffix
         # Make sure the username is valid for Django's User model.
         username = re.sub(r"[^a-zA-Z0-9_@\+\.]", "-", username)
         # Make the username unique to the IdP, if SP_UNIQUE_USERNAMES is True.
@@ -26,14 +39,81 @@ class SAMLAuthenticationBackend(ModelBackend):
             username += "-" + str(idp.pk)
         return username
 
+    def get_linked_user(self, idp, nameid):
+        """
+        Returns a tuple of the User associated with the nameid for this IdP, and the
+        primary key of the IdPUser linking them, or raises IdPUser.DoesNotExist.
+        """
+        cached = idp_user_cache.get((idp.pk, nameid))
+        if cached is not None:
+            user_pk, link_pk = cached
+            user = UserModel._default_manager.filter(pk=user_pk).first()
+            if user is not None:
+                return user, link_pk
+        user = self._linked_user_query(
+            idp, nameid, content_type=ContentType.objects.get_for_model(UserModel)
+        ).first()
+        if user is not None:
+            link_pk = user.__dict__.pop("sp_link_pk")
+        else:
+            # Links to some other model, or a user that no longer exists.
+            link = idp.users.get(nameid=nameid)
+            user, link_pk = link.user, link.pk
+            if user is None:
+                return user, link_pk
+        self._cache_linked_user(idp, nameid, user, link_pk)
+        return user, link_pk
+
+    async def aget_linked_user(self, idp, nameid):
+        """
+        Like get_linked_user, using the async ORM.
+        """
+        cached = idp_user_cache.get((idp.pk, nameid))
+        if cached is not None:
+            user_pk, link_pk = cached
+            user = await UserModel._default_manager.filter(pk=user_pk).afirst()
+            if user is not None:
+                return user, link_pk
+        # Match the content type by natural key, since looking it up isn't async-safe.
+        user = await self._linked_user_query(
+            idp,
+            nameid,
+            content_type__app_label=UserModel._meta.app_label,
+            content_type__model=UserModel._meta.model_name,
+        ).afirst()
+        if user is None:
+            # The GenericForeignKey fallback isn't async-capable.
+            return await sync_to_async(self.get_linked_user)(idp, nameid)
+        link_pk = user.__dict__.pop("sp_link_pk")
+        self._cache_linked_user(idp, nameid, user, link_pk)
+        return user, link_pk
+
+    def _linked_user_query(self, idp, nameid, **content_type):
+        # Look up the user and link in a single query, joining on the user's primary key
+        # rather than going through the GenericForeignKey.
+        links = IdPUser.objects.filter(idp=idp, nameid=nameid, **content_type)
+        return UserModel._default_manager.filter(
+            pk__in=links.values(pk=Cast("user_id", UserModel._meta.pk))
+        ).annotate(sp_link_pk=Subquery(links.values("pk")[:1]))
+
+    def _cache_linked_user(self, idp, nameid, user, link_pk):
+        idp_user_cache.set(
+            (idp.pk, nameid),
+            (user.pk, link_pk),
+            getattr(settings, "SP_USER_CACHE_TIMEOUT", 0),
+        )
+
     def authenticate(self, request, idp=None, saml=None):
         # The nameid (potentially mapped) to associate a User with an IdP.
         nameid = idp.get_nameid(saml)
+        if not nameid:
+            return None
         created = False
 
         try:
             # If this nameid is already associated with a User, our job is done.
-            user = idp.users.get(nameid=nameid).user
+            user, link_pk = self.get_linked_user(idp, nameid)
+            timestamps.touch(IdPUser(pk=link_pk))
         except IdPUser.DoesNotExist:
             # Otherwise, associate or create a user with the generated username, if the
             # IdP settings allow it.
@@ -47,7 +127,7 @@ class SAMLAuthenticationBackend(ModelBackend):
                 user = UserModel._default_manager.get(**{username_field: username})
                 if not idp.associate_users:
                     return None
-                idp.users.create(nameid=nameid, user=user)
+                idp.users.create(nameid=nameid, user=user, last_login=timezone.now())
             except UserModel.DoesNotExist:
                 if not idp.create_users:
                     return None
@@ -62,7 +142,7 @@ class SAMLAuthenticationBackend(ModelBackend):
         user = self.update_user(request, idp, saml, user, created)
 
         if created:
-            idp.users.create(nameid=nameid, user=user)
+            idp.users.create(nameid=nameid, user=user, last_login=timezone.now())
 
         return user
 
@@ -70,3 +150,32 @@ class SAMLAuthenticationBackend(ModelBackend):
         # By default just call through to IdP.update_user, but provide an easy place
         # to customize this behavior for subclasses.
         return idp.update_user(request, saml, user, created)
+
+    async def aauthenticate(self, request, idp=None, saml=None):
+        cls = type(self)
+        if (
+            cls.authenticate is not SAMLAuthenticationBackend.authenticate
+            or cls.get_linked_user is not SAMLAuthenticationBackend.get_linked_user
+        ):
+            # Respect subclasses that only customize the synchronous API.
+            return await sync_to_async(self.authenticate)(request, idp=idp, saml=saml)
+        # Make sure the attribute mapping is loaded, so get_nameid won't hit the
+        # database from the event loop.
+        nameid = (await idp.aget_attribute_mapping()).get_nameid(saml)
+        if not nameid:
+            return None
+        try:
+            user, link_pk = await self.aget_linked_user(idp, nameid)
+        except IdPUser.DoesNotExist:
+            # Associating and creating users is comparatively rare, and involves
+            # several queries best run together in a thread.
+            return await sync_to_async(self.authenticate)(request, idp=idp, saml=saml)
+        await timestamps.atouch(IdPUser(pk=link_pk))
+        return await self.aupdate_user(request, idp, saml, user, False)
+
+    async def aupdate_user(self, request, idp, saml, user, created):
+        if type(self).update_user is not SAMLAuthenticationBackend.update_user:
+            return await sync_to_async(self.update_user)(
+                request, idp, saml, user, created
+            )
+        return await idp.aupdate_user(request, saml, user, created)
@@ -0,0 +1,151 @@
+import collections
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+# Every IdPCache created, so they can all be invalidated when an IdP changes.
+_caches = []
+
+
+class IdPCache:
+    """
+    A process-wide cache of objects derived from an IdP's configuration. Entries are
+    keyed on the IdP's primary key, and are only used while the IdP's `updated`
+    timestamp (its configuration version) matches the one the entry was built from, so
+    changes saved by other processes are picked up on their next request.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def get(self, idp, builder):
+        version = idp.updated
+        entry = self._entries.get(idp.pk)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = builder(idp)
+        # Don't cache anything for unsaved IdPs, there's nothing to invalidate them.
+        if idp.pk is not None:
+            with self._lock:
+                self._entries[idp.pk] = (version, value)
+        return value
+
+    def peek(self, idp):
+        """
+        Returns the cached value for the IdP's current version, or None, without
+        building anything.
+        """
+        entry = self._entries.get(idp.pk)
+        if entry is not None and entry[0] == idp.updated:
+            return entry[1]
+        return None
+
+    def invalidate(self, pk=None):
+        with self._lock:
+            if pk is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(pk, None)
+
+
+class TTLCache:
+    """
+    A small, thread-safe, size-bounded LRU cache whose entries expire after a timeout.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, timeout):
+        if timeout <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Results of IdP lookups by URL parameters, including misses. Since any IdP change can
+# affect which lookups hit or miss, this is cleared whenever any IdP is saved.
+idp_lookup_cache = TTLCache()
+
+# IdPs (or False, if missing) by primary key, for the IdP a session was logged in with.
+session_idp_cache = TTLCache()
+
+# Maps (IdP pk, nameid) to (user pk, IdPUser pk) for returning users.
+idp_user_cache = TTLCache(maxsize=10000)
+
+
+def invalidate_idp(pk=None):
+    """
+    Removes all cached objects for the IdP with the given primary key, or for all IdPs
+    if `pk` is None.
+    """
+    for cache in _caches:
+        cache.invalidate(pk)
+    idp_lookup_cache.clear()
+    if pk is None:
+        session_idp_cache.clear()
+    else:
+        session_idp_cache.delete(pk)
+
+
+@receiver(post_save, sender="sp.IdP")
+@receiver(post_delete, sender="sp.IdP")
+def _idp_changed(sender, instance, update_fields=None, **kwargs):
+    # Saves that only touch bookkeeping fields (like last_login) leave the
+    # configuration, and anything derived from it, untouched.
+    if update_fields is None or "updated" in update_fields:
+        invalidate_idp(instance.pk)
+
+
+@receiver(post_save, sender="sp.IdPAttribute")
+@receiver(post_delete, sender="sp.IdPAttribute")
+@receiver(post_save, sender="sp.IdPUserDefaultValue")
+@receiver(post_delete, sender="sp.IdPUserDefaultValue")
+def _idp_related_changed(sender, instance, **kwargs):
+    # Attribute mappings and user defaults are part of the IdP configuration, so bump
+    # the IdP's version for other processes, and drop anything cached here.
+    from .models import IdP
+
+    IdP.objects.filter(pk=instance.idp_id).update(updated=timezone.now())
+    invalidate_idp(instance.idp_id)
+
+
+@receiver(post_save, sender="sp.IdPUser")
+@receiver(post_delete, sender="sp.IdPUser")
+def _idp_user_changed(sender, instance, **kwargs):
+    idp_user_cache.delete((instance.idp_id, instance.nameid))
+
+
+@receiver(setting_changed)
+def _setting_changed(**kwargs):
+    invalidate_idp()
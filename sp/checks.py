@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.core import checks
+from django.db import DatabaseError
+from django.utils.module_loading import import_string
+
+from .hooks import HOOKS, load_hook
+from .models import IdP
+from .stores import CacheReplayStore
+
+# Cache backends that don't share entries between processes (or don't keep them).
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def _check_path(path, errors, level, obj, hint, check_id):
+    try:
+        func = load_hook(path)
+    except ImportError as e:
+        errors.append(level(str(e), hint=hint, obj=obj, id=check_id))
+        return
+    if not callable(func):
+        message = "{} is not callable.".format(path)
+        errors.append(level(message, hint=hint, obj=obj, id=check_id))
+
+
+@checks.register()
+def check_hooks(app_configs=None, databases=None, **kwargs):
+    """
+    Checks that the dotted paths of the global hook settings (and `SP_IDP_LOADER`) can
+    be imported and, when the database checks are run, those of each IdP's hooks. IdPs
+    only get warnings, so they can't block migrations.
+    """
+    errors = []
+    for setting in [setting for setting, _ in HOOKS.values()] + ["SP_IDP_LOADER"]:
+        path = getattr(settings, setting, None)
+        if path:
+            hint = "Check the {} setting.".format(setting)
+            _check_path(path, errors, checks.Error, setting, hint, "sp.E001")
+    if not databases:
+        return errors
+    fields = [name + "_method" for name in HOOKS]
+    for database in databases:
+        try:
+            idps = list(IdP.objects.using(database).only("name", *fields))
+        except DatabaseError:
+            # Not migrated yet.
+            continue
+        for idp in idps:
+            for field in fields:
+                path = getattr(idp, field)
+                if path:
+                    hint = 'Check the {} of IdP "{}".'.format(field, idp)
+                    _check_path(path, errors, checks.Warning, idp, hint, "sp.W001")
+    return errors
+
+
+@checks.register()
+def check_replay_cache(app_configs=None, **kwargs):
+    """
+    Warns when `SP_REPLAY_STORE` is a CacheReplayStore using a cache that is local to
+    each process, so a response could be replayed against another process or host.
+    """
+    path = getattr(settings, "SP_REPLAY_STORE", "sp.stores.CacheReplayStore")
+    try:
+        store_class = import_string(path) if path else None
+    except ImportError:
+        return []
+    if not isinstance(store_class, type) or not issubclass(
+        store_class, CacheReplayStore
+    ):
+        return []
+    alias = getattr(settings, "SP_REPLAY_CACHE", "default")
+    backend = settings.CACHES.get(alias, {}).get("BACKEND")
+    if backend not in LOCAL_CACHE_BACKENDS:
+        return []
+    return [
+        checks.Warning(
+            "The replay store uses the {} cache ({}), which isn't shared between "
+            "processes.".format(alias, backend),
+            hint="Set SP_REPLAY_CACHE to a cache shared by every process (such as "
+            "Redis or Memcached), or use sp.stores.DatabaseReplayStore.",
+            obj="SP_REPLAY_CACHE",
+            id="sp.W002",
+        )
+    ]
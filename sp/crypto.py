@@ -0,0 +1,149 @@
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import threading
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+from django.conf import settings
+
+DEFAULT_KEY_ALGORITHM = "rsa-2048"
+
+# Functions generating a private key for each of the choices of `IdP.key_algorithm`.
+KEY_GENERATORS = {
+    "rsa-2048": lambda: rsa.generate_private_key(public_exponent=65537, key_size=2048),
+    "rsa-3072": lambda: rsa.generate_private_key(public_exponent=65537, key_size=3072),
+    "ec-p256": lambda: ec.generate_private_key(ec.SECP256R1()),
+}
+
+# EC keys take well under a millisecond to generate, so they aren't worth generating
+# in worker processes or ahead of time.
+CHEAP_KEY_ALGORITHMS = {"ec-p256"}
+
+
+def generate_private_key(algorithm=DEFAULT_KEY_ALGORITHM):
+    """
+    Generates a new private key (by default, 2048-bit RSA), returned as an unencrypted
+    PKCS#8 PEM string.
+    """
+    key = KEY_GENERATORS[algorithm]()
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode("ascii")
+
+
+def generate_private_keys(count, processes=None, algorithm=DEFAULT_KEY_ALGORITHM):
+    """
+    Generates `count` private keys, spread over a pool of `processes` worker processes
+    (by default `SP_KEYGEN_PROCESSES`, or the number of CPUs).
+    """
+    processes = min(
+        count,
+        processes or getattr(settings, "SP_KEYGEN_PROCESSES", None) or os.cpu_count(),
+    )
+    if processes <= 1 or algorithm in CHEAP_KEY_ALGORITHMS:
+        return [generate_private_key(algorithm) for _ in range(count)]
+    # Workers are spawned rather than forked, so they don't inherit database
+    # connections or threads from this process.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return list(
+            executor.map(
+                generate_private_key,
+                [algorithm] * count,
+                chunksize=max(1, count // (processes * 4)),
+            )
+        )
+
+
+def make_certificate(private_key, common_name, not_before, not_after):
+    """
+    Returns a self-signed certificate (as a PEM string) for the given PEM private key.
+    """
+    key = serialization.load_pem_private_key(private_key.encode("ascii"), None)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    basic_contraints = x509.BasicConstraints(ca=True, path_length=0)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(not_before)
+        .not_valid_after(not_after)
+        .add_extension(basic_contraints, critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    return cert.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+
+class KeyPool:
+    """
+    Keeps up to `SP_KEY_POOL_SIZE` private keys of each RSA key algorithm generated
+    ahead of time by a background thread (started for an algorithm the first time one
+    of its keys is needed), so generating a certificate doesn't have to wait for key
+    generation. Each key is handed out at most once, and the pool is emptied in forked
+    child processes so they can't hand out the same keys as their parent.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._keys = {}
+
+    @property
+    def size(self):
+        return getattr(settings, "SP_KEY_POOL_SIZE", 0)
+
+    def start(self, algorithm=DEFAULT_KEY_ALGORITHM):
+        """
+        Starts filling the pool for an algorithm in the background, if it is enabled.
+        """
+        size = self.size
+        with self._lock:
+            if (
+                size <= 0
+                or algorithm in CHEAP_KEY_ALGORITHMS
+                or algorithm in self._keys
+            ):
+                return
+            keys = self._keys[algorithm] = queue.Queue(maxsize=size)
+            threading.Thread(
+                target=self._fill,
+                args=(keys, algorithm),
+                name="sp-key-pool-" + algorithm,
+                daemon=True,
+            ).start()
+
+    def _fill(self, keys, algorithm):
+        while True:
+            # Blocks while the pool is full.
+            keys.put(generate_private_key(algorithm))
+
+    def take(self, algorithm=DEFAULT_KEY_ALGORITHM):
+        """
+        Returns a pre-generated private key, or a newly generated one if the pool is
+        empty (or disabled).
+        """
+        self.start(algorithm)
+        keys = self._keys.get(algorithm)
+        if keys is not None:
+            try:
+                return keys.get_nowait()
+            except queue.Empty:
+                pass
+        return generate_private_key(algorithm)
+
+
+key_pool = KeyPool()
+take_private_key = key_pool.take
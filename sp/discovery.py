@@ -0,0 +1,226 @@
+import bisect
+import collections
+import itertools
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import IdP
+
+# The IdP fields the index is built from, none of which are large.
+INDEX_FIELDS = ("name", "idp_entity_id", "url_params", "sort_order", "updated")
+
+MAX_PAGE_SIZE = 100
+
+
+class DiscoveryEntry(
+    collections.namedtuple(
+        "DiscoveryEntry", ["pk", "name", "entity_id", "login_url", "sort_order"]
+    )
+):
+    """
+    An active IdP as listed by the discovery views: its name, entity ID (from its
+    metadata), login URL, and sort order.
+    """
+
+    def as_json(self):
+        return {
+            "name": self.name,
+            "entity_id": self.entity_id,
+            "login_url": self.login_url,
+            "sort_order": self.sort_order,
+        }
+
+
+# An indexed entry, with the key it is listed by (IdPs are ordered by sort_order, then
+# name), and the casefolded text searched by substring. Sort keys end with the primary
+# key, so items are ordered by their sort keys alone.
+_Item = collections.namedtuple("_Item", ["sort_key", "text", "entry"])
+
+
+def _make_item(idp):
+    entry = DiscoveryEntry(
+        idp.pk, idp.name, idp.idp_entity_id, idp.get_login_url(), idp.sort_order
+    )
+    name = idp.name.casefold()
+    return _Item(
+        (idp.sort_order, name, idp.pk),
+        name + "\n" + idp.idp_entity_id.casefold(),
+        entry,
+    )
+
+
+class DiscoveryIndex:
+    """
+    An in-memory index of the active IdPs, for listing and searching them without
+    loading (or reversing URLs for) every IdP on each request. IdPs saved or deleted in
+    this process are updated in the index immediately; changes made by other processes
+    are picked up every `SP_DISCOVERY_REFRESH` seconds, by comparing each IdP's
+    `updated` version and only fetching the IdPs that changed. The sorted lists are
+    replaced (not modified) on every update, so searches never need a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # Items sorted by sort key, and (casefolded name, sort key, item) tuples
+            # sorted for prefix search, replaced together.
+            self._lists = ([], [])
+            # The item and `updated` version of each indexed IdP, by primary key.
+            self._indexed = {}
+            self._checked = None
+
+    def refresh(self, force=False):
+        """
+        Brings the index up to date with the database, if it hasn't been checked in the
+        last `SP_DISCOVERY_REFRESH` seconds (or `force` is set).
+        """
+        timeout = getattr(settings, "SP_DISCOVERY_REFRESH", 10)
+        checked = self._checked
+        if not force and checked is not None and time.monotonic() - checked < timeout:
+            return
+        with self._lock:
+            if not force and self._checked != checked:
+                # Another thread refreshed the index while this one waited.
+                return
+            versions = dict(
+                IdP.objects.filter(is_active=True).values_list("pk", "updated")
+            )
+            removed = [pk for pk in self._indexed if pk not in versions]
+            changed = [
+                pk
+                for pk, updated in versions.items()
+                if pk not in self._indexed or self._indexed[pk][1] != updated
+            ]
+            idps = []
+            if changed:
+                idps = IdP.objects.filter(is_active=True).only(*INDEX_FIELDS)
+                if len(changed) * 2 < len(versions):
+                    idps = idps.filter(pk__in=changed)
+                else:
+                    # Cheaper than a huge IN clause.
+                    changed = set(changed)
+                    idps = [idp for idp in idps if idp.pk in changed]
+            self._apply(list(idps), removed)
+            self._checked = time.monotonic()
+
+    def update(self, idp):
+        """
+        Adds, updates, or (if it is inactive) removes a saved IdP.
+        """
+        if self._checked is None:
+            # Nothing to update until the index is first used.
+            return
+        if idp.get_deferred_fields() & set(INDEX_FIELDS + ("is_active",)):
+            # Fetch the missing fields on the next search.
+            self._checked = None
+            return
+        with self._lock:
+            if idp.is_active:
+                self._apply([idp], [])
+            else:
+                self._apply([], [idp.pk])
+
+    def remove(self, pk):
+        with self._lock:
+            if pk in self._indexed:
+                self._apply([], [pk])
+
+    def _apply(self, idps, removed):
+        # Called with the lock held.
+        items, names = (list(lst) for lst in self._lists)
+        for pk in removed + [idp.pk for idp in idps]:
+            old = self._indexed.pop(pk, None)
+            if old is not None:
+                item = old[0]
+                del items[bisect.bisect_left(items, item)]
+                del names[bisect.bisect_left(names, _name_entry(item))]
+        for idp in idps:
+            item = _make_item(idp)
+            items.append(item)
+            names.append(_name_entry(item))
+            self._indexed[idp.pk] = (item, idp.updated)
+        if idps:
+            # Sorting an already sorted list with a few items appended is linear.
+            items.sort()
+            names.sort()
+        self._lists = (items, names)
+
+    def search(self, query="", prefix=False, offset=0, limit=None):
+        """
+        Returns the total number of active IdPs matching `query` (case-insensitively),
+        and the page of their DiscoveryEntries starting at `offset`. By default, IdPs
+        match if their name or entity ID contains the query; with `prefix`, if their
+        name starts with it. Matches are ordered by sort order, then name.
+        """
+        self.refresh()
+        items, names = self._lists
+        query = query.strip().casefold()
+        end = None if limit is None else offset + limit
+        if not query:
+            return len(items), [item.entry for item in items[offset:end]]
+        if prefix:
+            start = bisect.bisect_left(names, (query,))
+            # Every name starting with the query sorts before this.
+            stop = bisect.bisect_left(names, (query + "\U0010ffff",), start)
+            if (stop - start) * 8 < len(names):
+                matches = sorted(name[2] for name in names[start:stop])
+                return len(matches), [item.entry for item in matches[offset:end]]
+            # With this many matches, scanning the items in order for the requested
+            # page is cheaper than sorting them all.
+            matches = (item for item in items if item.text.startswith(query))
+            page = itertools.islice(matches, offset, end)
+            return stop - start, [item.entry for item in page]
+        matches = [item for item in items if query in item.text]
+        return len(matches), [item.entry for item in matches[offset:end]]
+
+
+def get_search_params(params):
+    """
+    Returns the search query, whether to match by prefix, the offset, and the page size
+    from the query parameters (`q`, `match`, `offset`, and `limit`) of a discovery
+    request. The page size defaults to `SP_DISCOVERY_PAGE_SIZE`, and is at most
+    MAX_PAGE_SIZE.
+    """
+    default_limit = getattr(settings, "SP_DISCOVERY_PAGE_SIZE", 20)
+    try:
+        offset = max(int(params.get("offset", 0)), 0)
+    except ValueError:
+        offset = 0
+    try:
+        limit = min(max(int(params.get("limit", default_limit)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = default_limit
+    return params.get("q", ""), params.get("match") == "prefix", offset, limit
+
+
+def _name_entry(item):
+    return (item.sort_key[1], item.sort_key, item)
+
+
+discovery_index = DiscoveryIndex()
+
+
+@receiver(post_save, sender=IdP)
+def _idp_saved(sender, instance, update_fields=None, **kwargs):
+    # Bookkeeping saves (like last_login) don't change anything that is indexed.
+    if update_fields is None or "updated" in update_fields:
+        discovery_index.update(instance)
+
+
+@receiver(post_delete, sender=IdP)
+def _idp_deleted(sender, instance, **kwargs):
+    discovery_index.remove(instance.pk)
+
+
+@receiver(setting_changed)
+def _setting_changed(**kwargs):
+    # The login URLs depend on the URL configuration.
+    discovery_index.reset()
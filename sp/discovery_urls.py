@@ -0,0 +1,8 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path("", views.discovery, name="sp-discovery"),
+    path("api/", views.discovery_api, name="sp-discovery-api"),
+]
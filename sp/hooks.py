@@ -0,0 +1,91 @@
+import asyncio
+import functools
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .instrumentation import phase
+
+# The IdP hooks, with the setting for their global default and its default. Each may be
+# overridden per IdP by the IdP's `<name>_method` field.
+HOOKS = {
+    "prepare_request": ("SP_PREPARE_REQUEST", "sp.utils.prepare_request"),
+    "authenticate": ("SP_AUTHENTICATE", "sp.utils.authenticate"),
+    "login": ("SP_LOGIN", "sp.utils.login"),
+    "logout": ("SP_LOGOUT", "sp.utils.logout"),
+    "update_user": ("SP_UPDATE_USER", "sp.utils.update_user"),
+}
+
+# Async counterparts of the built-in hooks in sp.utils.
+ASYNC_HOOKS = {
+    "sp.utils.prepare_request": "sp.utils.aprepare_request",
+    "sp.utils.authenticate": "sp.utils.aauthenticate",
+    "sp.utils.login": "sp.utils.alogin",
+    "sp.utils.logout": "sp.utils.alogout",
+    "sp.utils.update_user": "sp.utils.aupdate_user",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def load_hook(path):
+    """
+    Imports the function at a dotted path, once.
+    """
+    return import_string(path)
+
+
+class Hook:
+    """
+    A resolved hook function, which is timed as the `name` phase of the current flow
+    (with its dotted path as the `sp.hook` span attribute) when called. `func` is None
+    for hooks that are disabled (only `update_user` may be).
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.func = load_hook(path) if path else None
+        self._afunc = None
+        self._attributes = {"sp.hook": path}
+
+    def __call__(self, *args, **kwargs):
+        with phase(self.name, self._attributes):
+            return self.func(*args, **kwargs)
+
+    @property
+    def afunc(self):
+        # Resolved on first use, so sync-only deployments never import the async hooks.
+        if self._afunc is None:
+            func = load_hook(ASYNC_HOOKS.get(self.path, self.path))
+            if not asyncio.iscoroutinefunction(func):
+                func = sync_to_async(func)
+            self._afunc = func
+        return self._afunc
+
+    async def acall(self, *args, **kwargs):
+        """
+        Calls the hook from async code: built-in hooks are swapped for their async
+        counterparts, async hooks are awaited, and regular functions run in a thread.
+        """
+        with phase(self.name, self._attributes):
+            return await self.afunc(*args, **kwargs)
+
+
+def get_hook_path(idp, name):
+    setting, default = HOOKS[name]
+    return getattr(idp, name + "_method") or getattr(settings, setting, default)
+
+
+def resolve_hooks(idp):
+    """
+    Returns a dictionary of the resolved Hook for each of HOOKS, for an IdP.
+    """
+    return {name: Hook(name, get_hook_path(idp, name)) for name in HOOKS}
+
+
+@receiver(setting_changed)
+def _setting_changed(**kwargs):
+    load_hook.cache_clear()
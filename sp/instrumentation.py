@@ -0,0 +1,369 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import logging
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import Signal, receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Sent (with sender="sp") for every finished span, with a `span` keyword argument.
+span_finished = Signal()
+
+OK = "OK"
+ERROR = "ERROR"
+
+
+class Span(
+    collections.namedtuple(
+        "Span",
+        [
+            "name",
+            "trace_id",
+            "span_id",
+            "parent_id",
+            "start_time",
+            "end_time",
+            "attributes",
+            "status",
+        ],
+    )
+):
+    """
+    A timed flow (e.g. "sp.acs") or phase of a flow (e.g. "sp.acs.verify"), shaped
+    like an OpenTelemetry span: IDs are random integers (128 bits for the trace, 64
+    for spans), times are nanoseconds since the epoch, and the status is OK or ERROR.
+    The attributes include `sp.flow`, `sp.phase` (for phases), `sp.idp` (the IdP
+    primary key, once known), and `db.query_count` and `db.query_time` (in seconds).
+    """
+
+    @property
+    def duration(self):
+        """
+        The duration of the span, in seconds.
+        """
+        return (self.end_time - self.start_time) / 1e9
+
+
+_callbacks = None
+_current_trace = contextvars.ContextVar("sp_trace", default=None)
+
+
+def get_span_callbacks():
+    """
+    Returns the functions listed (as dotted paths) in `SP_SPAN_CALLBACKS`, each of which
+    is called with every finished Span.
+    """
+    global _callbacks
+    if _callbacks is None:
+        _callbacks = [
+            import_string(path) for path in getattr(settings, "SP_SPAN_CALLBACKS", [])
+        ]
+    return _callbacks
+
+
+def get_query_budgets():
+    """
+    Returns `SP_QUERY_BUDGETS`, the maximum number of database queries allowed for each
+    flow (e.g. "acs"), or flow variant (e.g. "acs.returning_user").
+    """
+    return getattr(settings, "SP_QUERY_BUDGETS", None) or {}
+
+
+@receiver(setting_changed)
+def _setting_changed(setting, **kwargs):
+    global _callbacks
+    if setting == "SP_SPAN_CALLBACKS":
+        _callbacks = None
+
+
+def is_enabled():
+    return bool(span_finished.receivers or get_span_callbacks() or get_query_budgets())
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def _count_query(trace, execute, sql, params, many, context):
+    if _current_trace.get() is not trace:
+        # A query for another request sharing this thread's connection.
+        return execute(sql, params, many, context)
+    start = time.perf_counter_ns()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        trace.queries += 1
+        trace.query_time += time.perf_counter_ns() - start
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.parent_id = self.trace.active_id
+        self.span_id = random.getrandbits(64)
+        self.trace.active_id = self.span_id
+        self.queries = self.trace.queries
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        self.trace.active_id = self.parent_id
+        self.trace.phases.append(
+            (
+                self.name,
+                self.span_id,
+                self.parent_id,
+                self.start,
+                end,
+                exc_type,
+                self.trace.queries - self.queries,
+                self.attributes,
+            )
+        )
+        return False
+
+
+class Trace:
+    """
+    Collects the timings of the phases of one flow (a request to one of the views),
+    which are sent as spans when the flow finishes.
+    """
+
+    def __init__(self, flow):
+        self.flow = flow
+        self.idp = None
+        self.variant = None
+        self.attributes = {}
+        self.phases = []
+        self.queries = 0
+        self.query_time = 0
+        self.trace_id = random.getrandbits(128)
+        self.span_id = self.active_id = random.getrandbits(64)
+        # Spans are timed with perf_counter_ns, and reported relative to the epoch.
+        self.epoch = time.time_ns() - time.perf_counter_ns()
+
+    def phase(self, name, attributes=None):
+        return _Phase(self, name, attributes)
+
+    def start(self):
+        self.token = _current_trace.set(self)
+        self.started = time.perf_counter_ns()
+
+    def count_queries(self):
+        """
+        Installs a query counter on this thread's database connections, until
+        stop_counting is called. Async views run queries in the thread sync_to_async
+        uses, so they call this there.
+        """
+        self.counter = functools.partial(_count_query, self)
+        self.connections = connections.all()
+        for connection in self.connections:
+            connection.execute_wrappers.append(self.counter)
+
+    def stop_counting(self):
+        # Concurrent async requests can share a connection, and finish in any order,
+        # so each removes its own counter, rather than popping the last wrapper.
+        for connection in self.connections:
+            connection.execute_wrappers.remove(self.counter)
+
+    def finish(self, response=None, exc_type=None):
+        ended = time.perf_counter_ns()
+        _current_trace.reset(self.token)
+        if response is not None:
+            self.attributes["http.status_code"] = response.status_code
+        self.attributes["db.query_count"] = self.queries
+        self.attributes["db.query_time"] = self.query_time / 1e9
+        failed = exc_type is not None or (
+            response is not None and response.status_code >= 500
+        )
+        spans = [
+            self.make_span(
+                "sp." + self.flow,
+                self.span_id,
+                None,
+                self.started,
+                ended,
+                ERROR if failed else OK,
+                self.attributes,
+            )
+        ]
+        for (
+            name,
+            span_id,
+            parent_id,
+            start,
+            end,
+            phase_exc,
+            queries,
+            extra,
+        ) in self.phases:
+            attributes = {"sp.phase": name, "db.query_count": queries}
+            if extra:
+                attributes.update(extra)
+            spans.append(
+                self.make_span(
+                    "sp.{}.{}".format(self.flow, name),
+                    span_id,
+                    parent_id,
+                    start,
+                    end,
+                    OK if phase_exc is None else ERROR,
+                    attributes,
+                )
+            )
+        # Parents start before their children, so send spans in order of start time.
+        spans.sort(key=lambda span: span.start_time)
+        callbacks = get_span_callbacks()
+        for span in spans:
+            span_finished.send(sender="sp", span=span)
+            for callback in callbacks:
+                callback(span)
+        if exc_type is None:
+            self.check_budget(ended - self.started)
+
+    def check_budget(self, elapsed):
+        """
+        Logs a warning, or raises QueryBudgetExceeded if `SP_QUERY_BUDGET_RAISE` (which
+        defaults to DEBUG) is set, when the flow ran more queries than its budget.
+        """
+        budgets = get_query_budgets()
+        name = self.flow
+        if self.variant and name + "." + self.variant in budgets:
+            name += "." + self.variant
+        budget = budgets.get(name)
+        if budget is None or self.queries <= budget:
+            return
+        message = "{} ran {} queries (budget {}) in {:.1f} ms, for IdP {}.".format(
+            name,
+            self.queries,
+            budget,
+            elapsed / 1e6,
+            self.idp.pk if self.idp is not None else None,
+        )
+        if getattr(settings, "SP_QUERY_BUDGET_RAISE", settings.DEBUG):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+    def make_span(self, name, span_id, parent_id, start, end, status, attributes):
+        attrs = {"sp.flow": self.flow}
+        if self.idp is not None:
+            attrs["sp.idp"] = self.idp.pk
+        attrs.update(attributes)
+        return Span(
+            name,
+            self.trace_id,
+            span_id,
+            parent_id,
+            self.epoch + start,
+            self.epoch + end,
+            attrs,
+            status,
+        )
+
+
+def phase(name, attributes=None):
+    """
+    Returns a context manager timing the named phase of the current flow (with any extra
+    span attributes), which does nothing when instrumentation is disabled.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _null_phase
+    return trace.phase(name, attributes)
+
+
+def set_idp(idp):
+    """
+    Records the IdP handling the current flow, as the `sp.idp` span attribute.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.idp = idp
+
+
+def set_variant(variant):
+    """
+    Records a variant of the current flow (e.g. "returning_user" for the ACS), which
+    may have its own query budget.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.variant = variant
+        trace.attributes["sp.variant"] = variant
+
+
+def instrument(flow):
+    """
+    A view decorator that traces the view as the named flow, when there are any
+    `span_finished` receivers, `SP_SPAN_CALLBACKS`, or `SP_QUERY_BUDGETS`.
+    """
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+
+            @functools.wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if not is_enabled():
+                    return await view(request, *args, **kwargs)
+                trace = Trace(flow)
+                trace.start()
+                await sync_to_async(trace.count_queries)()
+                try:
+                    try:
+                        response = await view(request, *args, **kwargs)
+                    finally:
+                        await sync_to_async(trace.stop_counting)()
+                except BaseException as e:
+                    trace.finish(exc_type=type(e))
+                    raise
+                trace.finish(response)
+                return response
+
+        else:
+
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if not is_enabled():
+                    return view(request, *args, **kwargs)
+                trace = Trace(flow)
+                trace.start()
+                trace.count_queries()
+                try:
+                    try:
+                        response = view(request, *args, **kwargs)
+                    finally:
+                        trace.stop_counting()
+                except BaseException as e:
+                    trace.finish(exc_type=type(e))
+                    raise
+                trace.finish(response)
+                return response
+
+        return wrapper
+
+    return decorator
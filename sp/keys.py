@@ -0,0 +1,265 @@
+import collections
+import datetime
+import hashlib
+import json
+import threading
+
+import xmlsec
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from onelogin.saml2.auth import OneLogin_Saml2_Auth
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+
+# A parsed private key or certificate. `key` is the cryptography object, and
+# `xmlsec_key` is ready to assign to an xmlsec SignatureContext. The validity window
+# is only set for certificates.
+KeyMaterial = collections.namedtuple(
+    "KeyMaterial",
+    ["fingerprint", "key", "xmlsec_key", "not_valid_before", "not_valid_after"],
+)
+
+
+class IdPKeys(
+    collections.namedtuple(
+        "IdPKeys", ["private_key", "certificate", "idp_certificates"]
+    )
+):
+    """
+    The parsed key material for an IdP: the SP private key and certificate, and the
+    IdP signing certificates (any of which may be missing).
+    """
+
+    @property
+    def certificate_expires(self):
+        return self.certificate.not_valid_after if self.certificate else None
+
+    @property
+    def idp_certificate_expires(self):
+        """
+        When the first of the IdP signing certificates expires.
+        """
+        return min((c.not_valid_after for c in self.idp_certificates), default=None)
+
+
+# python3-saml has no constants for ECDSA (and always signs XML with RSA).
+ECDSA_SHA256 = "http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha256"
+ECDSA_SHA384 = "http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha384"
+ECDSA_SHA512 = "http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha512"
+
+SIGN_TRANSFORMS = {
+    OneLogin_Saml2_Constants.DSA_SHA1: xmlsec.Transform.DSA_SHA1,
+    OneLogin_Saml2_Constants.RSA_SHA1: xmlsec.Transform.RSA_SHA1,
+    OneLogin_Saml2_Constants.RSA_SHA256: xmlsec.Transform.RSA_SHA256,
+    OneLogin_Saml2_Constants.RSA_SHA384: xmlsec.Transform.RSA_SHA384,
+    OneLogin_Saml2_Constants.RSA_SHA512: xmlsec.Transform.RSA_SHA512,
+    ECDSA_SHA256: xmlsec.Transform.ECDSA_SHA256,
+    ECDSA_SHA384: xmlsec.Transform.ECDSA_SHA384,
+    ECDSA_SHA512: xmlsec.Transform.ECDSA_SHA512,
+}
+
+DIGEST_TRANSFORMS = {
+    OneLogin_Saml2_Constants.SHA1: xmlsec.Transform.SHA1,
+    OneLogin_Saml2_Constants.SHA256: xmlsec.Transform.SHA256,
+    OneLogin_Saml2_Constants.SHA384: xmlsec.Transform.SHA384,
+    OneLogin_Saml2_Constants.SHA512: xmlsec.Transform.SHA512,
+}
+
+
+def fingerprint(pem):
+    """
+    Returns a SHA-256 fingerprint of a PEM string, ignoring whitespace differences.
+    """
+    return hashlib.sha256("".join(pem.split()).encode("ascii")).hexdigest()
+
+
+class KeyCache:
+    """
+    An LRU cache (bounded by `SP_KEY_CACHE_SIZE`) of parsed key material, keyed by the
+    fingerprint of its PEM. Since the key is derived from the PEM content, an entry can
+    never be stale, and IdPs sharing a key or certificate share the parsed object.
+    """
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pem, loader):
+        key = (loader, fingerprint(pem))
+        with self._lock:
+            material = self._entries.get(key)
+            if material is not None:
+                self._entries.move_to_end(key)
+                return material
+        material = loader(pem, key[1])
+        maxsize = getattr(settings, "SP_KEY_CACHE_SIZE", 1000)
+        with self._lock:
+            self._entries[key] = material
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+        return material
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+key_cache = KeyCache()
+
+
+def _load_private_key(pem, digest):
+    return KeyMaterial(
+        digest,
+        serialization.load_pem_private_key(pem.encode("ascii"), None),
+        xmlsec.Key.from_memory(pem, xmlsec.KeyFormat.PEM, None),
+        None,
+        None,
+    )
+
+
+def _load_certificate(pem, digest):
+    cert = x509.load_pem_x509_certificate(pem.encode("ascii"))
+    return KeyMaterial(
+        digest,
+        cert,
+        xmlsec.Key.from_memory(pem, xmlsec.KeyFormat.CERT_PEM, None),
+        _utc(cert, "not_valid_before"),
+        _utc(cert, "not_valid_after"),
+    )
+
+
+def _utc(cert, name):
+    # cryptography < 42 only has naive (UTC) datetimes.
+    value = getattr(cert, name + "_utc", None)
+    if value is None:
+        value = getattr(cert, name).replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def load_private_key(pem):
+    return key_cache.get(pem, _load_private_key)
+
+
+def load_certificate(pem):
+    return key_cache.get(OneLogin_Saml2_Utils.format_cert(pem), _load_certificate)
+
+
+def get_signature_algorithm(pem):
+    """
+    Returns the signature algorithm to sign with a PEM private key: ECDSA-SHA256 for EC
+    keys, and RSA-SHA256 otherwise.
+    """
+    if pem and isinstance(load_private_key(pem).key, ec.EllipticCurvePrivateKey):
+        return ECDSA_SHA256
+    return OneLogin_Saml2_Constants.RSA_SHA256
+
+
+def sign_xml(
+    xml,
+    private_key,
+    certificate,
+    sign_algorithm=OneLogin_Saml2_Constants.RSA_SHA256,
+    digest_algorithm=OneLogin_Saml2_Constants.SHA256,
+):
+    """
+    Signs an XML message (or metadata) the way OneLogin_Saml2_Utils.add_sign does, but
+    with the cached, parsed private key, and supporting ECDSA keys. Returns the signed
+    XML as a string.
+    """
+    elem = OneLogin_Saml2_XML.to_etree(xml)
+    signature = xmlsec.template.create(
+        elem,
+        xmlsec.Transform.EXCL_C14N,
+        SIGN_TRANSFORMS.get(sign_algorithm, xmlsec.Transform.RSA_SHA256),
+        ns="ds",
+    )
+    # The signature goes right after the Issuer, or first in metadata.
+    issuer = OneLogin_Saml2_XML.query(elem, "//saml:Issuer")
+    if issuer:
+        issuer[0].addnext(signature)
+        elem_to_sign = issuer[0].getparent()
+    else:
+        elem.insert(0, signature)
+        elem_to_sign = elem
+    elem_id = elem_to_sign.get("ID")
+    if not elem_id:
+        elem_id = elem_to_sign.attrib["ID"] = OneLogin_Saml2_Utils.generate_unique_id()
+    xmlsec.tree.add_ids(elem_to_sign, ["ID"])
+    ref = xmlsec.template.add_reference(
+        signature,
+        DIGEST_TRANSFORMS.get(digest_algorithm, xmlsec.Transform.SHA256),
+        uri="#" + elem_id,
+    )
+    xmlsec.template.add_transform(ref, xmlsec.Transform.ENVELOPED)
+    xmlsec.template.add_transform(ref, xmlsec.Transform.EXCL_C14N)
+    x509_data = xmlsec.template.add_x509_data(
+        xmlsec.template.ensure_key_info(signature)
+    )
+    # The cached key is shared, so the certificate is written out here rather than
+    # loaded into it.
+    xmlsec.template.x509_data_add_certificate(x509_data).text = "".join(
+        line for line in certificate.splitlines() if "-----" not in line
+    )
+    ctx = xmlsec.SignatureContext()
+    ctx.key = load_private_key(private_key).xmlsec_key
+    ctx.sign(signature)
+    return OneLogin_Saml2_XML.to_string(elem).decode("utf-8")
+
+
+def build_idp_keys(idp):
+    # Read from the fields, rather than the validated settings, so the SP key material
+    # is available before any IdP metadata has been imported.
+    deferred = idp.get_deferred_fields() & {
+        "saml_settings",
+        "x509_certificate",
+        "private_key",
+    }
+    if deferred:
+        idp.refresh_from_db(fields=deferred)
+    idp_data = json.loads(idp.saml_settings or "{}").get("idp", {})
+    idp_certs = idp_data.get("x509certMulti", {}).get("signing") or [
+        idp_data.get("x509cert")
+    ]
+    return IdPKeys(
+        load_private_key(idp.private_key) if idp.private_key else None,
+        load_certificate(idp.x509_certificate) if idp.x509_certificate else None,
+        [load_certificate(cert) for cert in idp_certs if cert],
+    )
+
+
+class SAMLAuth(OneLogin_Saml2_Auth):
+    """
+    A OneLogin_Saml2_Auth that signs HTTP-Redirect messages with a cached, parsed SP
+    private key, rather than parsing the PEM for every signature, and supports ECDSA
+    SP keys.
+    """
+
+    def _build_signature(
+        self, data, saml_type, sign_algorithm=OneLogin_Saml2_Constants.RSA_SHA256
+    ):
+        pem = self.get_settings().get_sp_key()
+        if not pem:
+            # Let python3-saml raise its usual error.
+            return super()._build_signature(data, saml_type, sign_algorithm)
+        msg = self._build_sign_query(
+            data[saml_type], data.get("RelayState", None), sign_algorithm, saml_type
+        )
+        ctx = xmlsec.SignatureContext()
+        ctx.key = load_private_key(pem).xmlsec_key
+        signature = ctx.sign_binary(
+            msg.encode("utf-8") if isinstance(msg, str) else msg,
+            SIGN_TRANSFORMS.get(sign_algorithm, xmlsec.Transform.RSA_SHA256),
+        )
+        data["Signature"] = OneLogin_Saml2_Utils.b64encode(signature)
+        data["SigAlg"] = sign_algorithm
+
+
+@receiver(setting_changed)
+def _setting_changed(setting, **kwargs):
+    if setting == "SP_KEY_CACHE_SIZE":
+        key_cache.clear()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from sp import sessions
+from sp.stores import get_replay_store, get_state_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Removes expired entries from the SP replay and login state stores, and the "
+        "session registry."
+    )
+
+    def handle(self, *args, **options):
+        for name, store in (
+            ("replay", get_replay_store()),
+            ("login state", get_state_store()),
+        ):
+            removed = store.cleanup() if store else 0
+            self.stdout.write("Removed {} expired {} entries.".format(removed, name))
+        removed = sessions.cleanup()
+        self.stdout.write(
+            "Removed {} expired session registry entries.".format(removed)
+        )
@@ -0,0 +1,94 @@
+import shutil
+import tempfile
+import time
+import urllib.request
+
+from django.core.management.base import BaseCommand, CommandError
+from lxml import etree
+
+from sp.metadata import MetadataError, import_aggregate, verify_aggregate
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports the IdPs in a (signed) federation aggregate metadata document, "
+        "creating or updating one IdP per entity ID."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="The aggregate file path or URL.")
+        parser.add_argument(
+            "--cert",
+            help="A PEM file with the certificate the aggregate is signed with.",
+        )
+        parser.add_argument(
+            "--no-verify",
+            action="store_true",
+            help="Import the aggregate without verifying its signature.",
+        )
+        parser.add_argument(
+            "--base-url", default="", help="The base_url for newly created IdPs."
+        )
+        parser.add_argument(
+            "--contact-name", default="", help="The contact_name for new IdPs."
+        )
+        parser.add_argument(
+            "--contact-email", default="", help="The contact_email for new IdPs."
+        )
+        parser.add_argument(
+            "--url-param",
+            default="idp_slug",
+            help="The URL parameter to put each new IdP's slug in (default: idp_slug).",
+        )
+        parser.add_argument(
+            "--inactive",
+            action="store_true",
+            help="Create new IdPs as inactive.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of entities to process per transaction (default: 500).",
+        )
+
+    def handle(self, *args, **options):
+        if not options["cert"] and not options["no_verify"]:
+            raise CommandError("Specify the signing certificate with --cert.")
+        start = time.perf_counter()
+        with tempfile.NamedTemporaryFile(suffix=".xml") as temp:
+            source = options["source"]
+            if source.startswith(("http://", "https://")):
+                # Both passes need to read the same document, so download it once.
+                with urllib.request.urlopen(source) as response:
+                    shutil.copyfileobj(response, temp)
+                temp.flush()
+                source = temp.name
+            try:
+                if not options["no_verify"]:
+                    with open(options["cert"]) as f:
+                        verify_aggregate(source, f.read())
+                counts, errors = import_aggregate(
+                    source,
+                    defaults={
+                        "base_url": options["base_url"],
+                        "contact_name": options["contact_name"],
+                        "contact_email": options["contact_email"],
+                        "is_active": not options["inactive"],
+                    },
+                    url_param=options["url_param"],
+                    batch_size=options["batch_size"],
+                )
+            except (MetadataError, etree.XMLSyntaxError) as ex:
+                raise CommandError(str(ex))
+        for entity_id, error in errors:
+            self.stderr.write("{}: {}".format(entity_id, error))
+        self.stdout.write(
+            "{} created, {} updated, {} unchanged, {} failed in {:.2f}s".format(
+                counts["created"],
+                counts["updated"],
+                counts["unchanged"],
+                counts["failed"],
+                time.perf_counter() - start,
+            )
+        )
@@ -0,0 +1,266 @@
+import csv
+import itertools
+import json
+import sys
+import time
+
+from django.contrib.auth import get_backends, get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.functions import Lower
+
+from sp.backends import SAMLAuthenticationBackend
+from sp.models import IdP, IdPUser
+
+
+class RowAttributes:
+    """
+    Adapts an input row to the parts of OneLogin_Saml2_Auth used by AttributeMapping.
+    """
+
+    def __init__(self, row):
+        self.nameid = row.get("nameid")
+        self.attributes = {}
+        for name, value in row.items():
+            if name in ("nameid", "username") or value in (None, ""):
+                continue
+            self.attributes[name] = value if isinstance(value, list) else [value]
+
+    def get_nameid(self):
+        return self.nameid
+
+    def get_attributes(self):
+        return self.attributes
+
+    def get_attribute(self, name):
+        return self.attributes.get(name)
+
+
+def read_rows(stream, fmt):
+    if fmt == "jsonl":
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield from csv.DictReader(stream)
+
+
+class Command(BaseCommand):
+    help = (
+        "Links existing users to an IdP (and optionally creates them) in bulk, from a "
+        "CSV or JSON Lines file with a nameid column, and optionally username and "
+        "SAML attribute columns."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("idp", type=int, help="The primary key of the IdP.")
+        parser.add_argument("path", help="The file to read, or - for stdin.")
+        parser.add_argument(
+            "--format",
+            choices=("csv", "jsonl"),
+            help="The input format (default: based on the file extension, or csv).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of rows to process per transaction (default: 1000).",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report what would be done, without writing anything.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            self.idp = IdP.objects.get(pk=options["idp"])
+        except IdP.DoesNotExist:
+            raise CommandError("IdP {} does not exist.".format(options["idp"]))
+        self.backend = next(
+            (b for b in get_backends() if isinstance(b, SAMLAuthenticationBackend)),
+            SAMLAuthenticationBackend(),
+        )
+        self.User = get_user_model()
+        self.mapping = self.idp.get_attribute_mapping()
+        self.fields = self.mapping.get_user_fields(self.User)
+        self.content_type = ContentType.objects.get_for_model(self.User)
+        self.dry_run = options["dry_run"]
+        self.counts = {"rows": 0, "linked": 0, "created": 0, "conflicts": 0}
+
+        path = options["path"]
+        fmt = options["format"] or ("jsonl" if path.endswith(".jsonl") else "csv")
+        stream = sys.stdin if path == "-" else open(path, newline="")
+        start = time.perf_counter()
+        try:
+            rows = read_rows(stream, fmt)
+            while True:
+                batch = list(itertools.islice(rows, options["batch_size"]))
+                if not batch:
+                    break
+                with transaction.atomic():
+                    self.process_batch(batch)
+                    if self.dry_run:
+                        transaction.set_rollback(True)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            "{rows} rows: {linked} existing users linked, {created} users created, "
+            "{conflicts} conflicts".format(**self.counts)
+        )
+        self.stdout.write(
+            "{:.2f}s ({:.0f} rows/s){}".format(
+                elapsed,
+                self.counts["rows"] / elapsed if elapsed else 0,
+                " [dry run]" if self.dry_run else "",
+            )
+        )
+
+    def conflict(self, row, reason):
+        self.counts["conflicts"] += 1
+        self.stderr.write("{}: {}".format(row.get("nameid"), reason))
+
+    def process_batch(self, batch):
+        self.counts["rows"] += len(batch)
+        username_field = self.User.USERNAME_FIELD
+        case_sensitive = self.idp.auth_case_sensitive
+
+        def key(username):
+            return username if case_sensitive else username.lower()
+
+        # Map each row's nameid the way logging in would, then skip rows without one,
+        # or whose nameid is already linked to this IdP.
+        for row in batch:
+            row["nameid"] = self.get_nameid(row)
+        nameids = [row["nameid"] for row in batch]
+        linked = set(
+            IdPUser.objects.filter(idp=self.idp, nameid__in=nameids).values_list(
+                "nameid", flat=True
+            )
+        )
+        # Generated (or given) usernames, keyed for comparison, to nameids.
+        pending = {}
+        seen = set()
+        for row in batch:
+            nameid = row["nameid"]
+            if not nameid:
+                self.conflict(row, "missing nameid")
+            elif nameid in linked or nameid in seen:
+                self.conflict(row, "nameid is already linked")
+            else:
+                username = row.get("username") or self.backend.get_username(
+                    self.idp, RowAttributes(row)
+                )
+                if key(username) in pending:
+                    self.conflict(row, "duplicate username {}".format(username))
+                else:
+                    pending[key(username)] = nameid
+                    seen.add(nameid)
+                    row["username"] = username
+
+        # Find existing users for the usernames in this batch.
+        users = self.User._default_manager.all()
+        if case_sensitive:
+            users = users.filter(**{username_field + "__in": list(pending)})
+        else:
+            users = users.annotate(sp_username=Lower(username_field)).filter(
+                sp_username__in=list(pending)
+            )
+        existing = {}
+        for user in users:
+            existing.setdefault(key(getattr(user, username_field)), []).append(user)
+        already_linked = set(
+            IdPUser.objects.filter(
+                idp=self.idp,
+                content_type=self.content_type,
+                user_id__in=[str(u.pk) for us in existing.values() for u in us],
+            ).values_list("user_id", flat=True)
+        )
+
+        links = []
+        new_users = []
+        for row in batch:
+            username = row.get("username")
+            if username is None or pending.get(key(username)) != row["nameid"]:
+                continue
+            matches = existing.get(key(username))
+            if matches:
+                if len(matches) > 1:
+                    self.conflict(row, "multiple users match {}".format(username))
+                elif not self.idp.associate_users:
+                    self.conflict(row, "IdP does not associate existing users")
+                elif str(matches[0].pk) in already_linked:
+                    self.conflict(row, "user is linked to another nameid")
+                else:
+                    links.append((row["nameid"], matches[0]))
+            elif not self.idp.create_users:
+                self.conflict(row, "IdP does not create users")
+            else:
+                user = self.build_user(row, username)
+                if user is not None:
+                    new_users.append((row["nameid"], user))
+
+        if new_users:
+            created = self.User._default_manager.bulk_create(
+                [user for _, user in new_users]
+            )
+            if any(user.pk is None for user in created):
+                # Not every database returns primary keys from bulk inserts.
+                pks = dict(
+                    self.User._default_manager.filter(
+                        **{
+                            username_field
+                            + "__in": [getattr(u, username_field) for u in created]
+                        }
+                    ).values_list(username_field, "pk")
+                )
+                for user in created:
+                    user.pk = pks[getattr(user, username_field)]
+            links.extend(new_users)
+            self.counts["created"] += len(new_users)
+        IdPUser.objects.bulk_create(
+            [
+                IdPUser(
+                    idp=self.idp,
+                    nameid=nameid,
+                    content_type=self.content_type,
+                    user_id=str(user.pk),
+                )
+                for nameid, user in links
+            ]
+        )
+        self.counts["linked"] += len(links) - len(new_users)
+
+    def get_nameid(self, row):
+        """
+        Returns the nameid a login would link for the row, using the IdP's nameid
+        attribute mapping and transform, or None if the row is missing it.
+        """
+        attrs = RowAttributes(row)
+        if self.mapping.nameid is not None and not attrs.get_attribute(
+            self.mapping.nameid[0]
+        ):
+            return None
+        return self.mapping.get_nameid(attrs)
+
+    def build_user(self, row, username):
+        user = self.User(**{self.User.USERNAME_FIELD: username})
+        user.set_unusable_password()
+        # Set mapped attributes and user defaults, as update_user does for new users.
+        attrs = self.mapping.map(RowAttributes(row))
+        attrs.update(self.mapping.defaults)
+        for name, values in attrs.items():
+            field = self.fields.get(name)
+            if field is not None and values:
+                setattr(user, field.attname, values[0])
+        try:
+            user.full_clean(validate_unique=False)
+        except ValidationError as e:
+            self.conflict(row, "invalid user: {}".format(e.messages))
+            return None
+        return user
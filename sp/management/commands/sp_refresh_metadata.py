@@ -0,0 +1,71 @@
+import collections
+import time
+
+from django.core.management.base import BaseCommand
+
+from sp.metadata import FAILED, REFRESH_FIELDS, refresh_metadata
+from sp.models import IdP
+
+
+class Command(BaseCommand):
+    help = (
+        "Refreshes IdP metadata from each IdP's metadata URL, concurrently, using "
+        "conditional requests. Only changed metadata is re-parsed and saved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "idps",
+            nargs="*",
+            type=int,
+            help="Primary keys of the IdPs to refresh (default: all active IdPs).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of metadata URLs to fetch at once (default: 8).",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=30,
+            help="Timeout in seconds for each request (default: 30).",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Fetch and re-parse all metadata, even if unchanged.",
+        )
+
+    def handle(self, *args, **options):
+        idps = IdP.objects.exclude(metadata_url="").only(*REFRESH_FIELDS)
+        if options["idps"]:
+            idps = idps.filter(pk__in=options["idps"])
+        else:
+            idps = idps.filter(is_active=True)
+        counts = collections.Counter()
+        start = time.perf_counter()
+        for idp, outcome, error in refresh_metadata(
+            idps,
+            workers=options["workers"],
+            force=options["force"],
+            timeout=options["timeout"],
+        ):
+            counts[outcome] += 1
+            if outcome == FAILED:
+                self.stderr.write("{} ({}): {}".format(idp, idp.pk, error))
+            elif options["verbosity"] > 1:
+                self.stdout.write("{} ({}): {}".format(idp, idp.pk, outcome))
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            "{} IdPs refreshed in {:.2f}s: {}".format(
+                sum(counts.values()),
+                elapsed,
+                ", ".join(
+                    "{} {}".format(count, outcome)
+                    for outcome, count in sorted(counts.items())
+                )
+                or "nothing to do",
+            )
+        )
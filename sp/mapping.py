@@ -0,0 +1,152 @@
+import collections
+import re
+
+from django.core.exceptions import FieldDoesNotExist
+from django.utils.translation import gettext_lazy as _
+
+
+def _lowercase(arg):
+    return lambda values: [v.lower() for v in values]
+
+
+def _uppercase(arg):
+    return lambda values: [v.upper() for v in values]
+
+
+def _strip(arg):
+    return lambda values: [v.strip() for v in values]
+
+
+def _first(arg):
+    return lambda values: values[:1]
+
+
+def _join(arg):
+    separator = arg or " "
+    return lambda values: [separator.join(values)] if values else []
+
+
+def _regex(arg):
+    pattern = re.compile(arg)
+
+    def transform(values):
+        extracted = []
+        for value in values:
+            match = pattern.search(value)
+            if match:
+                # Use the first group if the pattern has one, otherwise the whole match.
+                extracted.append(match.group(1 if pattern.groups else 0))
+        return extracted
+
+    return transform
+
+
+# Value transforms that can be applied to SAML attribute values, given as a (possibly
+# empty) list of strings. Each entry is a factory taking the `transform_arg` of the
+# IdPAttribute and returning a function from a list of values to a list of values.
+TRANSFORMS = {
+    "lowercase": _lowercase,
+    "uppercase": _uppercase,
+    "strip": _strip,
+    "first": _first,
+    "join": _join,
+    "regex": _regex,
+}
+
+TRANSFORM_CHOICES = [
+    ("lowercase", _("Lowercase")),
+    ("uppercase", _("Uppercase")),
+    ("strip", _("Strip whitespace")),
+    ("first", _("First value only")),
+    ("join", _("Join values (argument is the separator)")),
+    ("regex", _("Regex extract (argument is the pattern)")),
+]
+
+
+def compile_transform(name, arg=""):
+    """
+    Returns a function that applies the named transform to a list of values, or None if
+    no transform is specified.
+    """
+    if not name:
+        return None
+    return TRANSFORMS[name](arg)
+
+
+class AttributeMapping:
+    """
+    A compiled plan for mapping SAML attributes to user fields for a single IdP, built
+    once from its IdPAttribute and IdPUserDefaultValue rows.
+    """
+
+    def __init__(self, attributes, defaults):
+        # (saml_attribute, transform) of the attribute used as the nameid, if any.
+        self.nameid = None
+        # (saml_attribute, mapped_name, transform) for each mapped attribute.
+        self.fields = []
+        # Mapped names that should be updated on every login.
+        self.always_update = set()
+        # Initial user field values, as lists to match mapped SAML attributes.
+        self.defaults = collections.OrderedDict(
+            (default.field, [default.value]) for default in defaults
+        )
+        for attr in attributes:
+            transform = compile_transform(attr.transform, attr.transform_arg)
+            if attr.is_nameid and self.nameid is None:
+                self.nameid = (attr.saml_attribute, transform)
+            if attr.mapped_name:
+                self.fields.append((attr.saml_attribute, attr.mapped_name, transform))
+                if attr.always_update:
+                    self.always_update.add(attr.mapped_name)
+
+        # Resolved model fields for each user model this mapping is applied to.
+        self._user_fields = {}
+
+    @classmethod
+    def for_idp(cls, idp):
+        return cls(idp.attributes.order_by("pk"), idp.user_defaults.order_by("pk"))
+
+    def get_nameid(self, saml):
+        """
+        Returns the SAML nameid, or the (transformed) value of the attribute mapped to
+        it, or None if that attribute is missing or transformed away.
+        """
+        if self.nameid is None:
+            return saml.get_nameid()
+        saml_attribute, transform = self.nameid
+        values = saml.get_attribute(saml_attribute)
+        if values is not None and transform is not None:
+            values = transform(values)
+        return values[0] if values else None
+
+    def map(self, saml):
+        """
+        Returns an OrderedDict of mapped names to (transformed) lists of values, for
+        every mapped attribute present in the SAML response.
+        """
+        saml_attrs = saml.get_attributes()
+        attrs = collections.OrderedDict()
+        for saml_attribute, mapped_name, transform in self.fields:
+            values = saml_attrs.get(saml_attribute)
+            if values is not None:
+                attrs[mapped_name] = values if transform is None else transform(values)
+        return attrs
+
+    def get_user_fields(self, model):
+        """
+        Returns a dictionary of mapped names (and default fields) to the concrete fields
+        of `model` they set, skipping any names that aren't fields on the model.
+        """
+        fields = self._user_fields.get(model)
+        if fields is None:
+            fields = {}
+            names = [name for _, name, _ in self.fields] + list(self.defaults)
+            for name in names:
+                try:
+                    field = model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    continue
+                if field.concrete:
+                    fields[name] = field
+            self._user_fields[model] = fields
+        return fields
@@ -0,0 +1,391 @@
+import collections
+import concurrent.futures
+import hashlib
+import http.client
+import itertools
+import json
+import ssl
+import threading
+from urllib.parse import urljoin, urlsplit
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.text import slugify
+
+from .cache import invalidate_idp
+from .models import IdP
+
+# Refresh outcomes.
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+NOT_MODIFIED = "not modified"
+FAILED = "failed"
+
+# The IdP fields needed to refresh its metadata.
+REFRESH_FIELDS = (
+    "name",
+    "metadata_url",
+    "verify_metadata_cert",
+    "metadata_etag",
+    "metadata_modified",
+    "metadata_hash",
+)
+
+MAX_REDIRECTS = 5
+
+MD = "{urn:oasis:names:tc:SAML:2.0:metadata}"
+MDUI = "{urn:oasis:names:tc:SAML:metadata:ui}"
+DS = "{http://www.w3.org/2000/09/xmldsig#}"
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+# Aggregates are large, but they still shouldn't be able to expand entities or fetch
+# anything.
+PARSER_OPTIONS = {
+    "resolve_entities": False,
+    "load_dtd": False,
+    "no_network": True,
+    "huge_tree": True,
+}
+
+
+class MetadataError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Keeps a keep-alive HTTP(S) connection per host in each thread, so refreshing many
+    IdPs served from the same host doesn't pay for a new TCP and TLS handshake each
+    time.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get_connection(self, scheme, netloc, verify=True):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+            with self._lock:
+                self._connections.append(connections)
+        key = (scheme, netloc, verify)
+        conn = connections.get(key)
+        if conn is None:
+            if scheme == "https":
+                context = ssl.create_default_context()
+                if not verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                conn = http.client.HTTPSConnection(
+                    netloc, timeout=self.timeout, context=context
+                )
+            elif scheme == "http":
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise MetadataError(
+                    "Unsupported metadata URL scheme: {}".format(scheme)
+                )
+            connections[key] = conn
+        return conn
+
+    def request(self, url, headers=None, verify=True):
+        """
+        Sends a GET request for `url`, following redirects. Returns a tuple of the
+        response status, headers, and body.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            conn = self.get_connection(parts.scheme, parts.netloc, verify)
+            try:
+                response, body = self._send(conn, path, headers)
+            except TimeoutError:
+                conn.close()
+                raise
+            except (http.client.HTTPException, OSError):
+                # The server may have closed an idle keep-alive connection, try once
+                # more on a new one.
+                conn.close()
+                response, body = self._send(conn, path, headers)
+            location = response.getheader("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            return response.status, response.headers, body
+        raise MetadataError("Too many redirects fetching {}".format(url))
+
+    def _send(self, conn, path, headers):
+        conn.request("GET", path, headers=headers or {})
+        response = conn.getresponse()
+        # Always read the whole body, so the connection can be reused.
+        return response, response.read()
+
+    def close(self):
+        with self._lock:
+            for connections in self._connections:
+                for conn in connections.values():
+                    conn.close()
+                connections.clear()
+
+
+def parse_metadata(xml):
+    """
+    Validates that `xml` contains IdP metadata, and returns the python3-saml settings
+    parsed from it.
+    """
+    from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+    from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+
+    try:
+        dom = OneLogin_Saml2_XML.to_etree(xml)
+        valid = bool(OneLogin_Saml2_XML.query(dom, "//md:IDPSSODescriptor"))
+    except Exception:
+        valid = False
+    if not valid:
+        raise MetadataError("No valid IdP metadata found.")
+    return OneLogin_Saml2_IdPMetadataParser.parse(xml)
+
+
+def check_metadata(idp, pool, force=False):
+    """
+    Fetches the metadata for `idp`, using a conditional request unless `force` is set.
+    Returns a tuple of the outcome and a dictionary of changed IdP fields, without
+    modifying the IdP itself. Metadata is only parsed if its content has changed.
+    """
+    headers = {"Accept": "application/samlmetadata+xml, application/xml, text/xml"}
+    if not force:
+        if idp.metadata_etag:
+            headers["If-None-Match"] = idp.metadata_etag
+        if idp.metadata_modified:
+            headers["If-Modified-Since"] = idp.metadata_modified
+    status, response_headers, body = pool.request(
+        idp.metadata_url, headers, verify=idp.verify_metadata_cert
+    )
+    changes = {"last_import": timezone.now()}
+    if status == 304:
+        return NOT_MODIFIED, changes
+    if status != 200:
+        raise MetadataError("HTTP {} fetching {}".format(status, idp.metadata_url))
+    etag = response_headers.get("ETag", "")
+    modified = response_headers.get("Last-Modified", "")
+    if etag != idp.metadata_etag:
+        changes["metadata_etag"] = etag
+    if modified != idp.metadata_modified:
+        changes["metadata_modified"] = modified
+    digest = hashlib.sha256(body).hexdigest()
+    if digest == idp.metadata_hash and not force:
+        return UNCHANGED, changes
+    xml = body.decode("utf-8")
+    parsed = parse_metadata(xml)
+    changes.update(
+        metadata_xml=xml,
+        saml_settings=json.dumps(parsed),
+        metadata_hash=digest,
+        idp_entity_id=parsed.get("idp", {}).get("entityId", ""),
+    )
+    return UPDATED, changes
+
+
+def refresh_metadata(idps, workers=8, force=False, timeout=30):
+    """
+    Refreshes the metadata of the given IdPs (which should have a `metadata_url`)
+    concurrently, using up to `workers` threads. Yields a tuple of each IdP, the
+    outcome, and the exception if it failed, as they complete.
+
+    Only the fetching and parsing happen in worker threads; changes are saved from the
+    calling thread, writing only the fields that changed.
+    """
+    pool = ConnectionPool(timeout=timeout)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(check_metadata, idp, pool, force): idp for idp in idps
+            }
+            for future in concurrent.futures.as_completed(futures):
+                idp = futures[future]
+                try:
+                    outcome, changes = future.result()
+                except Exception as ex:
+                    yield idp, FAILED, ex
+                    continue
+                for field, value in changes.items():
+                    setattr(idp, field, value)
+                idp.save(update_fields=changes)
+                yield idp, outcome, None
+    finally:
+        pool.close()
+
+
+def verify_aggregate(source, cert):
+    """
+    Verifies the signature (against `cert`) and validUntil of an aggregate metadata
+    document. The signature covers the whole document, so this parses it in full, once.
+    """
+    from lxml import etree
+    from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+    root = etree.parse(source, etree.XMLParser(**PARSER_OPTIONS)).getroot()
+    if root.getroottree().docinfo.doctype:
+        raise MetadataError("Metadata may not contain a DTD.")
+    valid_until = parse_datetime(root.get("validUntil") or "")
+    if valid_until is not None and valid_until <= timezone.now():
+        raise MetadataError("The aggregate expired at {}.".format(valid_until))
+    # validate_metadata_sign accepts a signature over any element with an ID, but every
+    # entity is imported, so the signature must cover the whole document.
+    signatures = root.findall(DS + "Signature")
+    if not signatures:
+        raise MetadataError("The aggregate is not signed.")
+    whole = {""} if root.get("ID") is None else {"", "#" + root.get("ID")}
+    for signature in signatures:
+        references = signature.findall(DS + "SignedInfo/" + DS + "Reference")
+        if len(references) != 1 or references[0].get("URI", "") not in whole:
+            raise MetadataError("The aggregate signature doesn't cover the aggregate.")
+    if not OneLogin_Saml2_Utils.validate_metadata_sign(root, cert=cert):
+        raise MetadataError("The aggregate signature is not valid.")
+
+
+def iter_aggregate(source):
+    """
+    Stream-parses an aggregate metadata document, yielding a tuple of the entity ID,
+    display name, and EntityDescriptor XML of each IdP in it. Elements are discarded as
+    soon as they have been read, so memory use doesn't depend on the aggregate's size.
+    """
+    from lxml import etree
+
+    events = etree.iterparse(
+        source, events=("end",), tag=MD + "EntityDescriptor", **PARSER_OPTIONS
+    )
+    for _, elem in events:
+        if elem.getroottree().docinfo.doctype:
+            raise MetadataError("Metadata may not contain a DTD.")
+        idp = elem.find(MD + "IDPSSODescriptor")
+        if idp is not None and elem.get("entityID"):
+            yield (
+                elem.get("entityID"),
+                get_display_name(elem, idp),
+                etree.tostring(elem, encoding="unicode"),
+            )
+        # Drop this entity, and anything before it (like the aggregate's signature).
+        elem.clear()
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def get_display_name(entity, idp):
+    names = idp.findall(
+        "{md}Extensions/{mdui}UIInfo/{mdui}DisplayName".format(md=MD, mdui=MDUI)
+    ) or entity.findall("{md}Organization/{md}OrganizationDisplayName".format(md=MD))
+    for name in names:
+        if name.get(XML_LANG, "en").startswith("en") and name.text:
+            return name.text.strip()
+    if names and names[0].text:
+        return names[0].text.strip()
+    return entity.get("entityID")
+
+
+def make_url_slug(entity_id):
+    """
+    Generates a (stable) URL slug for an IdP imported from an aggregate.
+    """
+    digest = hashlib.sha1(entity_id.encode("utf-8")).hexdigest()[:8]
+    base = slugify(urlsplit(entity_id).netloc or entity_id)[:40].strip("-")
+    return "{}-{}".format(base, digest) if base else digest
+
+
+# The fields written when an IdP's metadata changes in an aggregate.
+AGGREGATE_FIELDS = (
+    "metadata_xml",
+    "saml_settings",
+    "metadata_hash",
+    "last_import",
+    "updated",
+)
+
+
+def import_aggregate(source, defaults=None, url_param="idp_slug", batch_size=500):
+    """
+    Creates or updates an IdP for each IdP entity in an aggregate metadata document
+    (which should already have been verified with verify_aggregate), keyed by
+    `IdP.idp_entity_id`. Each IdP stores only its own EntityDescriptor. IdPs whose
+    metadata is unchanged aren't touched. New IdPs are created with `defaults` (e.g.
+    base_url and contact information), and `url_params` of {url_param: slug}.
+
+    Returns a Counter of created, updated, unchanged, and failed entities, and a list of
+    (entity ID, exception) tuples for the failures.
+    """
+    counts = collections.Counter()
+    errors = []
+    entities = iter_aggregate(source)
+    while True:
+        batch = list(itertools.islice(entities, batch_size))
+        if not batch:
+            break
+        with transaction.atomic():
+            _import_batch(batch, defaults or {}, url_param, counts, errors)
+    return counts, errors
+
+
+def _import_batch(batch, defaults, url_param, counts, errors):
+    from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+
+    # Later duplicates of an entity ID win, as they would when importing one by one.
+    entities = {entity_id: (name, xml) for entity_id, name, xml in batch}
+    existing = collections.defaultdict(list)
+    for idp in IdP.objects.filter(idp_entity_id__in=entities).only(
+        "pk", "idp_entity_id", "metadata_hash"
+    ):
+        existing[idp.idp_entity_id].append(idp)
+    now = timezone.now()
+    to_create = []
+    to_update = []
+    for entity_id, (name, xml) in entities.items():
+        digest = hashlib.sha256(xml.encode("utf-8")).hexdigest()
+        stale = [idp for idp in existing[entity_id] if idp.metadata_hash != digest]
+        if existing[entity_id] and not stale:
+            counts["unchanged"] += 1
+            continue
+        try:
+            saml_settings = json.dumps(OneLogin_Saml2_IdPMetadataParser.parse(xml))
+        except Exception as ex:
+            counts["failed"] += 1
+            errors.append((entity_id, ex))
+            continue
+        fields = {
+            "metadata_xml": xml,
+            "saml_settings": saml_settings,
+            "metadata_hash": digest,
+            "last_import": now,
+        }
+        if stale:
+            for idp in stale:
+                for field, value in fields.items():
+                    setattr(idp, field, value)
+                # bulk_update doesn't set auto_now fields.
+                idp.updated = now
+                to_update.append(idp)
+            counts["updated"] += 1
+        else:
+            url_params = {url_param: make_url_slug(entity_id)}
+            to_create.append(
+                IdP(
+                    **defaults,
+                    **fields,
+                    name=name[: IdP._meta.get_field("name").max_length],
+                    idp_entity_id=entity_id,
+                    url_params=url_params,
+                    # bulk_create doesn't call IdP.save.
+                    lookup_key=IdP.make_lookup_key(url_params),
+                )
+            )
+            counts["created"] += 1
+    IdP.objects.bulk_create(to_create)
+    IdP.objects.bulk_update(to_update, AGGREGATE_FIELDS)
+    for idp in to_update:
+        invalidate_idp(idp.pk)
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0015_idp_logout_request_signed_idp_logout_response_signed"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idp",
+            name="updated",
+            field=models.DateTimeField(
+                auto_now=True,
+                help_text="When the configuration of this IdP last changed.",
+            ),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:40
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+
+def set_lookup_keys(apps, schema_editor):
+    IdP = apps.get_model("sp", "IdP")
+    db_alias = schema_editor.connection.alias
+    for idp in IdP.objects.using(db_alias).only("pk", "url_params"):
+        normalized = json.dumps(
+            idp.url_params or {}, sort_keys=True, separators=(",", ":")
+        )
+        IdP.objects.using(db_alias).filter(pk=idp.pk).update(
+            lookup_key=hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0016_idp_updated"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idp",
+            name="lookup_key",
+            field=models.CharField(
+                db_index=True,
+                default="",
+                editable=False,
+                help_text="A normalized hash of the URL parameters, used for lookups.",
+                max_length=64,
+            ),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_lookup_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0017_idp_lookup_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idpattribute",
+            name="transform",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("lowercase", "Lowercase"),
+                    ("uppercase", "Uppercase"),
+                    ("strip", "Strip whitespace"),
+                    ("first", "First value only"),
+                    ("join", "Join values (argument is the separator)"),
+                    ("regex", "Regex extract (argument is the pattern)"),
+                ],
+                help_text="An optional transformation applied to the attribute values.",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="idpattribute",
+            name="transform_arg",
+            field=models.CharField(
+                blank=True,
+                help_text="The separator for joins, or the pattern for regex extracts.",
+                max_length=200,
+                verbose_name="Transform argument",
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0018_idpattribute_transform"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idpuser",
+            name="last_login",
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+    ]
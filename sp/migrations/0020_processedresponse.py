@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0019_idpuser_last_login"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProcessedResponse",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=255, unique=True)),
+                ("value", models.TextField(blank=True)),
+                ("expires", models.DateTimeField(db_index=True)),
+            ],
+            options={
+                "verbose_name": "processed response",
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0020_processedresponse"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LoginState",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=100, unique=True)),
+                ("state", models.JSONField(default=dict)),
+                ("expires", models.DateTimeField(db_index=True)),
+            ],
+            options={
+                "verbose_name": "login state",
+            },
+        ),
+    ]
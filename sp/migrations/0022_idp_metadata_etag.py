@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0021_loginstate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idp",
+            name="metadata_etag",
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name="idp",
+            name="metadata_hash",
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="idp",
+            name="metadata_modified",
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+    ]
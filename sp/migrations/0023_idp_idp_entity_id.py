@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:41
+
+import json
+
+from django.db import migrations, models
+
+
+def set_idp_entity_ids(apps, schema_editor):
+    IdP = apps.get_model("sp", "IdP")
+    db_alias = schema_editor.connection.alias
+    for idp in (
+        IdP.objects.using(db_alias)
+        .exclude(saml_settings="")
+        .only("pk", "saml_settings")
+    ):
+        try:
+            entity_id = json.loads(idp.saml_settings)["idp"]["entityId"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        IdP.objects.using(db_alias).filter(pk=idp.pk).update(idp_entity_id=entity_id)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0022_idp_metadata_etag"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idp",
+            name="idp_entity_id",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="The entity ID of the identity provider, from its metadata.",
+                max_length=500,
+                verbose_name="IdP entity ID",
+            ),
+        ),
+        migrations.RunPython(set_idp_entity_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0023_idp_idp_entity_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdPSession",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("nameid", models.CharField(max_length=200)),
+                ("session_index", models.CharField(blank=True, max_length=255)),
+                ("session_key", models.CharField(db_index=True, max_length=40)),
+                ("expires", models.DateTimeField(db_index=True)),
+                (
+                    "idp",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sessions",
+                        to="sp.idp",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "IdP session",
+                "indexes": [
+                    models.Index(
+                        fields=["idp", "nameid", "session_index"],
+                        name="sp_idpsessi_idp_id_0270f0_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sp", "0024_idpsession"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idp",
+            name="key_algorithm",
+            field=models.CharField(
+                choices=[
+                    ("rsa-2048", "RSA (2048-bit)"),
+                    ("rsa-3072", "RSA (3072-bit)"),
+                    ("ec-p256", "ECDSA (P-256)"),
+                ],
+                default="rsa-2048",
+                help_text=(
+                    "The kind of private key generated for new SP certificates. ECDSA "
+                    "keys are much faster to generate and sign with, but the IdP must "
+                    "support ECDSA signatures, and can't encrypt assertions to them."
+                ),
+                max_length=20,
+            ),
+        ),
+    ]
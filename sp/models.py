@@ -1,22 +1,47 @@
 import collections
 import datetime
+import hashlib
 import json
+import re
 from urllib.parse import urlparse
 
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.x509.oid import NameOID
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.urls import NoReverseMatch, reverse
 from django.utils import timezone
-from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
-from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+
+from .cache import IdPCache, invalidate_idp
+from .hooks import HOOKS, load_hook, resolve_hooks
+from .instrumentation import set_variant
+from .mapping import TRANSFORM_CHOICES, AttributeMapping, compile_transform
+
+# Compiled OneLogin_Saml2_Settings objects, shared by all requests for an IdP.
+_settings_cache = IdPCache()
+# Rendered (and optionally signed) SP metadata.
+_metadata_cache = IdPCache()
+# Compiled AttributeMapping plans.
+_mapping_cache = IdPCache()
+# Parsed SP keys and IdP certificates.
+_keys_cache = IdPCache()
+# Resolved hook functions.
+_hooks_cache = IdPCache()
+
+SPMetadata = collections.namedtuple(
+    "SPMetadata", ["xml", "etag", "last_modified", "expires"]
+)
+
+
+# The kinds of SP private key that can be generated (see sp.crypto.KEY_GENERATORS).
+KEY_ALGORITHM_CHOICES = (
+    ("rsa-2048", _("RSA (2048-bit)")),
+    ("rsa-3072", _("RSA (3072-bit)")),
+    ("ec-p256", _("ECDSA (P-256)")),
+)
 
 
 def _default_authn_context():
@@ -24,6 +49,27 @@ def _default_authn_context():
 
 
 class IdP(models.Model):
+    # Bookkeeping fields that can be saved without changing the IdP's configuration
+    # version (IdP.updated), and so without invalidating anything cached for it.
+    STATUS_FIELDS = frozenset(
+        (
+            "last_login",
+            "last_import",
+            "metadata_etag",
+            "metadata_modified",
+            "updated",
+        )
+    )
+
+    # Large text fields that are not needed to route a request to an IdP.
+    DEFERRED_FIELDS = (
+        "x509_certificate",
+        "private_key",
+        "metadata_xml",
+        "saml_settings",
+        "notes",
+    )
+
     name = models.CharField(max_length=200)
     url_params = models.JSONField(
         _("URL Parameters"),
@@ -31,6 +77,12 @@ class IdP(models.Model):
         blank=True,
         help_text=_("Application-specific URL path parameters."),
     )
+    lookup_key = models.CharField(
+        max_length=64,
+        db_index=True,
+        editable=False,
+        help_text=_("A normalized hash of the URL parameters, used for lookups."),
+    )
     base_url = models.CharField(
         _("Base URL"),
         max_length=200,
@@ -44,6 +96,16 @@ class IdP(models.Model):
     )
     contact_name = models.CharField(max_length=100)
     contact_email = models.EmailField(max_length=100)
+    key_algorithm = models.CharField(
+        max_length=20,
+        choices=KEY_ALGORITHM_CHOICES,
+        default="rsa-2048",
+        help_text=_(
+            "The kind of private key generated for new SP certificates. ECDSA keys are "
+            "much faster to generate and sign with, but the IdP must support ECDSA "
+            "signatures, and can't encrypt assertions to them."
+        ),
+    )
     x509_certificate = models.TextField(blank=True)
     private_key = models.TextField(blank=True)
     certificate_expires = models.DateTimeField(null=True, blank=True)
@@ -72,7 +134,18 @@ class IdP(models.Model):
         help_text=_("Settings imported and used by the python-saml library."),
         editable=False,
     )
+    idp_entity_id = models.CharField(
+        _("IdP entity ID"),
+        max_length=500,
+        blank=True,
+        db_index=True,
+        editable=False,
+        help_text=_("The entity ID of the identity provider, from its metadata."),
+    )
     last_import = models.DateTimeField(null=True, blank=True)
+    metadata_etag = models.CharField(max_length=200, blank=True, editable=False)
+    metadata_modified = models.CharField(max_length=100, blank=True, editable=False)
+    metadata_hash = models.CharField(max_length=64, blank=True, editable=False)
     notes = models.TextField(blank=True)
     auth_case_sensitive = models.BooleanField(
         _("NameID is case sensitive"), default=True
@@ -143,6 +216,10 @@ class IdP(models.Model):
     logout_request_signed = models.BooleanField(default=False)
     logout_response_signed = models.BooleanField(default=False)
     sort_order = models.IntegerField(default=0)
+    updated = models.DateTimeField(
+        auto_now=True,
+        help_text=_("When the configuration of this IdP last changed."),
+    )
 
     class Meta:
         verbose_name = _("identity provider")
@@ -151,6 +228,29 @@ class IdP(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if "url_params" not in self.get_deferred_fields():
+            self.lookup_key = self.make_lookup_key(self.url_params)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if "url_params" in update_fields:
+                update_fields.add("lookup_key")
+            # Saving any configuration field is a new configuration version.
+            if not update_fields.issubset(self.STATUS_FIELDS):
+                update_fields.add("updated")
+            kwargs["update_fields"] = update_fields
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def make_lookup_key(url_params):
+        """
+        Returns a fixed-length key for the given URL parameters that does not depend
+        on their ordering, suitable for an indexed equality lookup.
+        """
+        normalized = json.dumps(url_params or {}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
     def get_url(self, name, default="/"):
         try:
             return reverse(name, kwargs=self.url_params)
@@ -190,14 +290,32 @@ class IdP(models.Model):
     def get_logout_url(self):
         return self.get_url("sp-idp-logout")
 
+    def clean(self):
+        errors = {}
+        for name in HOOKS:
+            path = getattr(self, name + "_method")
+            if path:
+                try:
+                    load_hook(path)
+                except ImportError as e:
+                    errors[name + "_method"] = str(e)
+        if errors:
+            raise ValidationError(errors)
+
+    def get_hooks(self):
+        """
+        Returns the resolved hooks (see sp.hooks) for this IdP, keyed by name. Cached
+        until the IdP or any settings change.
+        """
+        return _hooks_cache.get(self, resolve_hooks)
+
     def prepare_request(self, request):
-        method = self.prepare_request_method or getattr(
-            settings, "SP_PREPARE_REQUEST", "sp.utils.prepare_request"
-        )
-        return import_string(method)(request, self)
+        return self.get_hooks()["prepare_request"](request, self)
 
     @property
     def sp_settings(self):
+        from .keys import get_signature_algorithm
+
         return {
             "strict": True,
             "sp": {
@@ -221,6 +339,7 @@ class IdP(models.Model):
                 "requestedAuthnContext": self.authn_context,
                 "logoutRequestSigned": self.logout_request_signed,
                 "logoutResponseSigned": self.logout_response_signed,
+                "signatureAlgorithm": get_signature_algorithm(self.private_key),
             },
             "contactPerson": {
                 "technical": {
@@ -236,62 +355,119 @@ class IdP(models.Model):
         settings_dict.update(self.sp_settings)
         return settings_dict
 
-    def generate_certificate(self):
-        url_parts = urlparse(self.base_url)
-        backend = default_backend()
-        key = rsa.generate_private_key(
-            public_exponent=65537, key_size=2048, backend=backend
-        )
-        self.private_key = key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption(),
-        ).decode("ascii")
-        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, url_parts.netloc)])
-        basic_contraints = x509.BasicConstraints(ca=True, path_length=0)
+    def get_saml_settings(self):
+        """
+        Returns a validated OneLogin_Saml2_Settings object for this IdP, suitable for
+        passing to OneLogin_Saml2_Auth. The object is built once per configuration
+        version and shared across requests, so it must not be modified.
+        """
+        return _settings_cache.get(self, _build_saml_settings)
+
+    def get_sp_metadata(self):
+        """
+        Returns an SPMetadata tuple containing the SP metadata XML for this IdP, a
+        strong ETag for it, when it last changed, and when it stops being valid. The
+        XML is rendered (and signed, if SP_SIGN_METADATA is set) once per configuration
+        version.
+        """
+        metadata = _metadata_cache.get(self, _build_sp_metadata)
+        if (
+            metadata.expires <= timezone.now()
+            and self.get_keys().certificate_expires is None
+        ):
+            # Without a certificate expiration, the metadata is only valid for a short
+            # time after it was rendered, so render it again.
+            _metadata_cache.invalidate(self.pk)
+            metadata = _metadata_cache.get(self, _build_sp_metadata)
+        return metadata
+
+    def generate_certificate(self, private_key=None):
+        """
+        Generates a new self-signed certificate for this IdP, using the given PEM
+        private key, or a `key_algorithm` key from the key pool (see sp.crypto).
+        """
+        from .crypto import take_private_key
+
+        self.set_certificate(private_key or take_private_key(self.key_algorithm))
+        self.save()
+
+    def set_certificate(self, private_key):
+        from .crypto import make_certificate
+
         now = timezone.now()
+        self.private_key = private_key
         self.certificate_expires = now + datetime.timedelta(days=3650)
-        cert = (
-            x509.CertificateBuilder()
-            .subject_name(name)
-            .issuer_name(name)
-            .public_key(key.public_key())
-            .serial_number(x509.random_serial_number())
-            .not_valid_before(now)
-            .not_valid_after(self.certificate_expires)
-            .add_extension(basic_contraints, critical=False)
-            .sign(key, hashes.SHA256(), backend)
+        self.x509_certificate = make_certificate(
+            private_key, urlparse(self.base_url).netloc, now, self.certificate_expires
         )
-        self.x509_certificate = cert.public_bytes(serialization.Encoding.PEM).decode(
-            "ascii"
+
+    @classmethod
+    def generate_certificates(cls, idps, processes=None):
+        """
+        Generates new certificates for the given IdPs in bulk, generating their private
+        (RSA) keys in parallel worker processes.
+        """
+        from .crypto import generate_private_keys
+
+        idps = list(idps)
+        by_algorithm = collections.defaultdict(list)
+        for idp in idps:
+            by_algorithm[idp.key_algorithm].append(idp)
+        now = timezone.now()
+        for algorithm, group in by_algorithm.items():
+            private_keys = generate_private_keys(len(group), processes, algorithm)
+            for idp, private_key in zip(group, private_keys):
+                idp.set_certificate(private_key)
+                # bulk_update doesn't set auto_now fields.
+                idp.updated = now
+        cls.objects.bulk_update(
+            idps, ["private_key", "x509_certificate", "certificate_expires", "updated"]
         )
-        self.save()
+        for idp in idps:
+            invalidate_idp(idp.pk)
+        return idps
 
     def import_metadata(self):
+        from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+
         if self.metadata_url:
             self.metadata_xml = OneLogin_Saml2_IdPMetadataParser.get_metadata(
                 self.metadata_url, validate_cert=self.verify_metadata_cert
             ).decode("utf-8")
-        self.saml_settings = json.dumps(
-            OneLogin_Saml2_IdPMetadataParser.parse(self.metadata_xml)
-        )
+            # The response headers aren't available here, so the next refresh will
+            # do a full (unconditional) fetch.
+            self.metadata_etag = self.metadata_modified = ""
+        parsed = OneLogin_Saml2_IdPMetadataParser.parse(self.metadata_xml)
+        self.saml_settings = json.dumps(parsed)
+        self.idp_entity_id = parsed.get("idp", {}).get("entityId", "")
+        self.metadata_hash = hashlib.sha256(
+            self.metadata_xml.encode("utf-8")
+        ).hexdigest()
         self.last_import = timezone.now()
         self.save()
 
+    def get_keys(self):
+        """
+        Returns the parsed SP private key and certificate, and IdP signing certificates
+        (along with their validity windows), as an IdPKeys tuple. Cached until the IdP
+        changes.
+        """
+        from .keys import build_idp_keys
+
+        return _keys_cache.get(self, build_idp_keys)
+
+    def get_attribute_mapping(self):
+        """
+        Returns the compiled AttributeMapping for this IdP, which is cached until the
+        IdP (or any of its attributes or user defaults) changes.
+        """
+        return _mapping_cache.get(self, AttributeMapping.for_idp)
+
     def mapped_attributes(self, saml):
-        attrs = collections.OrderedDict()
-        for attr in self.attributes.exclude(mapped_name=""):
-            value = saml.get_attribute(attr.saml_attribute)
-            if value is not None:
-                attrs[attr.mapped_name] = value
-        return attrs
+        return self.get_attribute_mapping().map(saml)
 
     def get_nameid(self, saml):
-        nameid_attr = self.attributes.filter(is_nameid=True).first()
-        if nameid_attr:
-            return saml.get_attribute(nameid_attr.saml_attribute)[0]
-        else:
-            return saml.get_nameid()
+        return self.get_attribute_mapping().get_nameid(saml)
 
     def get_login_redirect(self, redir=None):
         return redir or self.login_redirect or settings.LOGIN_REDIRECT_URL
@@ -300,28 +476,117 @@ class IdP(models.Model):
         return redir or self.logout_redirect or settings.LOGOUT_REDIRECT_URL
 
     def authenticate(self, request, saml):
-        method = self.authenticate_method or getattr(
-            settings, "SP_AUTHENTICATE", "sp.utils.authenticate"
-        )
-        return import_string(method)(request, self, saml)
+        return self.get_hooks()["authenticate"](request, self, saml)
 
     def login(self, request, user, saml):
-        method = self.login_method or getattr(settings, "SP_LOGIN", "sp.utils.login")
-        return import_string(method)(request, user, self, saml)
+        return self.get_hooks()["login"](request, user, self, saml)
 
     def logout(self, request):
-        method = self.logout_method or getattr(settings, "SP_LOGOUT", "sp.utils.logout")
-        return import_string(method)(request, self)
+        return self.get_hooks()["logout"](request, self)
 
     def update_user(self, request, saml, user, created=None):
-        method = self.update_user_method or getattr(
-            settings, "SP_UPDATE_USER", "sp.utils.update_user"
+        set_variant("new_user" if created else "returning_user")
+        hook = self.get_hooks()["update_user"]
+        if hook.func is None:
+            return user
+        return hook(request, self, saml, user, created=created)
+
+    # Async versions of the hooks above, used by sp.async_views. Hooks may be async
+    # functions, which are awaited, or regular functions, which are run in a thread.
+    # The built-in default hooks are swapped for their async counterparts.
+
+    async def aprepare_request(self, request):
+        return await self.get_hooks()["prepare_request"].acall(request, self)
+
+    async def aauthenticate(self, request, saml):
+        return await self.get_hooks()["authenticate"].acall(request, self, saml)
+
+    async def alogin(self, request, user, saml):
+        return await self.get_hooks()["login"].acall(request, user, self, saml)
+
+    async def alogout(self, request):
+        return await self.get_hooks()["logout"].acall(request, self)
+
+    async def aupdate_user(self, request, saml, user, created=None):
+        set_variant("new_user" if created else "returning_user")
+        hook = self.get_hooks()["update_user"]
+        if hook.func is None:
+            return user
+        return await hook.acall(request, self, saml, user, created=created)
+
+    async def aget_saml_settings(self):
+        saml_settings = _settings_cache.peek(self)
+        if saml_settings is None:
+            saml_settings = await sync_to_async(self.get_saml_settings)()
+        return saml_settings
+
+    async def aget_sp_metadata(self):
+        metadata = _metadata_cache.peek(self)
+        if metadata is None or metadata.expires <= timezone.now():
+            metadata = await sync_to_async(self.get_sp_metadata)()
+        return metadata
+
+    async def aget_attribute_mapping(self):
+        mapping = _mapping_cache.peek(self)
+        if mapping is None:
+            mapping = await sync_to_async(self.get_attribute_mapping)()
+        return mapping
+
+
+def _build_saml_settings(idp):
+    from onelogin.saml2.settings import OneLogin_Saml2_Settings
+
+    # Load any deferred fields we need in a single query, rather than one per access.
+    deferred = idp.get_deferred_fields() & {
+        "saml_settings",
+        "x509_certificate",
+        "private_key",
+    }
+    if deferred:
+        idp.refresh_from_db(fields=deferred)
+    return OneLogin_Saml2_Settings(settings=idp.settings)
+
+
+def _build_sp_metadata(idp):
+    from onelogin.saml2.settings import OneLogin_Saml2_Settings
+
+    from .keys import sign_xml
+
+    deferred = idp.get_deferred_fields() & {"x509_certificate", "private_key"}
+    if deferred:
+        idp.refresh_from_db(fields=deferred)
+    now = timezone.now()
+    settings_dict = idp.sp_settings
+    # The expiration of the certificate itself, which may have been pasted in (without
+    # setting certificate_expires).
+    certificate_expires = idp.get_keys().certificate_expires
+    if certificate_expires:
+        settings_dict["security"]["metadataValidUntil"] = certificate_expires
+        expires = certificate_expires
+        last_modified = idp.updated or now
+    else:
+        # python3-saml will set validUntil two days out, re-render after one.
+        settings_dict["security"]["metadataValidUntil"] = now + datetime.timedelta(
+            days=2
         )
-        return (
-            import_string(method)(request, self, saml, user, created=created)
-            if method
-            else user
+        expires = now + datetime.timedelta(days=1)
+        last_modified = now
+    saml_settings = OneLogin_Saml2_Settings(
+        settings=settings_dict, sp_validation_only=True
+    )
+    xml = saml_settings.get_sp_metadata()
+    if getattr(settings, "SP_SIGN_METADATA", False):
+        # Signed with the cached SP key, which may be an RSA or ECDSA key.
+        xml = sign_xml(
+            xml,
+            saml_settings.get_sp_key(),
+            saml_settings.get_sp_cert(),
+            settings_dict["security"]["signatureAlgorithm"],
         )
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+    etag = '"{}"'.format(hashlib.sha256(xml).hexdigest())
+    return SPMetadata(xml, etag, last_modified, expires)
 
 
 class IdPUserDefaultValue(models.Model):
@@ -369,6 +634,18 @@ class IdPAttribute(models.Model):
             "By default, mapped fields are only set on user creation."
         ),
     )
+    transform = models.CharField(
+        max_length=20,
+        blank=True,
+        choices=TRANSFORM_CHOICES,
+        help_text=_("An optional transformation applied to the attribute values."),
+    )
+    transform_arg = models.CharField(
+        _("Transform argument"),
+        max_length=200,
+        blank=True,
+        help_text=_("The separator for joins, or the pattern for regex extracts."),
+    )
 
     class Meta:
         verbose_name = _("attribute mapping")
@@ -377,6 +654,12 @@ class IdPAttribute(models.Model):
             ("idp", "saml_attribute"),
         ]
 
+    def clean(self):
+        try:
+            compile_transform(self.transform, self.transform_arg)
+        except re.error as e:
+            raise ValidationError({"transform_arg": str(e)})
+
     def __str__(self):
         if self.mapped_name:
             return "{} -> {}".format(self.saml_attribute, self.mapped_name)
@@ -391,6 +674,7 @@ class IdPUser(models.Model):
         ContentType, related_name="idp_users", on_delete=models.CASCADE
     )
     user_id = models.CharField(max_length=100)
+    last_login = models.DateTimeField(null=True, blank=True, default=None)
 
     user = GenericForeignKey("content_type", "user_id")
 
@@ -399,3 +683,41 @@ class IdPUser(models.Model):
             ("idp", "nameid"),
             ("idp", "content_type", "user_id"),
         ]
+
+
+class ProcessedResponse(models.Model):
+    key = models.CharField(max_length=255, unique=True)
+    value = models.TextField(blank=True)
+    expires = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = _("processed response")
+
+
+class LoginState(models.Model):
+    token = models.CharField(max_length=100, unique=True)
+    state = models.JSONField(default=dict)
+    expires = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = _("login state")
+
+
+class IdPSession(models.Model):
+    """
+    Records which Django session was logged in by which SAML session, so Single Logout
+    can find and end sessions other than the one making the request (see sp.sessions).
+    """
+
+    # The (idp, nameid, session_index) index below covers lookups by IdP.
+    idp = models.ForeignKey(
+        IdP, related_name="sessions", on_delete=models.CASCADE, db_index=False
+    )
+    nameid = models.CharField(max_length=200)
+    session_index = models.CharField(max_length=255, blank=True)
+    session_key = models.CharField(max_length=40, db_index=True)
+    expires = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = _("IdP session")
+        indexes = [models.Index(fields=["idp", "nameid", "session_index"])]
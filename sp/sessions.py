@@ -0,0 +1,148 @@
+import datetime
+from importlib import import_module
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .models import IdPSession
+
+
+def is_enabled():
+    return getattr(settings, "SP_SESSION_REGISTRY", False)
+
+
+def register_session(request, idp, nameid, session_index=None):
+    """
+    Records that the current session was logged in by `idp` as `nameid`, so it can be
+    ended by Single Logout from another request. Does nothing when `SP_SESSION_REGISTRY`
+    is off, or the session engine has no server-side key yet.
+    """
+    if not is_enabled() or not request.session.session_key:
+        return None
+    return IdPSession.objects.create(
+        idp=idp,
+        nameid=nameid,
+        session_index=session_index or "",
+        session_key=request.session.session_key,
+        expires=request.session.get_expiry_date(),
+    )
+
+
+async def aregister_session(request, idp, nameid, session_index=None):
+    if not is_enabled() or not request.session.session_key:
+        return None
+    return await IdPSession.objects.acreate(
+        idp=idp,
+        nameid=nameid,
+        session_index=session_index or "",
+        session_key=request.session.session_key,
+        expires=await request.session.aget_expiry_date(),
+    )
+
+
+def unregister_session(session_key):
+    if is_enabled() and session_key:
+        IdPSession.objects.filter(session_key=session_key).delete()
+
+
+async def aunregister_session(session_key):
+    if is_enabled() and session_key:
+        await IdPSession.objects.filter(session_key=session_key).adelete()
+
+
+def delete_sessions(session_keys):
+    """
+    Deletes the given Django sessions. Database-backed engines delete them with one
+    query, and cache-backed engines with one delete_many call. Sessions stored only in
+    signed cookies can't be deleted server-side.
+    """
+    store_class = import_module(settings.SESSION_ENGINE).SessionStore
+    get_model_class = getattr(store_class, "get_model_class", None)
+    prefix = getattr(store_class, "cache_key_prefix", None)
+    if get_model_class is not None:
+        get_model_class().objects.filter(session_key__in=session_keys).delete()
+    if prefix is not None:
+        caches[settings.SESSION_CACHE_ALIAS].delete_many(
+            [prefix + key for key in session_keys]
+        )
+    if get_model_class is None and prefix is None:
+        for key in session_keys:
+            store_class().delete(key)
+
+
+def terminate_sessions(idp, nameid=None, session_indexes=None, batch_size=1000):
+    """
+    Ends every registered session logged in by `idp`, optionally only those for
+    `nameid`, and only those with one of `session_indexes`. The registry is indexed by
+    (idp, nameid, session_index), so this takes time proportional to the number of
+    matching sessions. Returns the number of sessions ended.
+    """
+    sessions = IdPSession.objects.filter(idp=idp)
+    if nameid is not None:
+        sessions = sessions.filter(nameid=nameid)
+    if session_indexes:
+        sessions = sessions.filter(session_index__in=session_indexes)
+    total = 0
+    while True:
+        batch = list(sessions.values_list("pk", "session_key")[:batch_size])
+        if not batch:
+            return total
+        delete_sessions([session_key for _, session_key in batch])
+        IdPSession.objects.filter(pk__in=[pk for pk, _ in batch]).delete()
+        total += len(batch)
+
+
+# Session engines have no async API for deleting sessions in bulk.
+aterminate_sessions = sync_to_async(terminate_sessions)
+
+
+def get_live_sessions(session_keys):
+    """
+    Returns the expiry dates of those of the given Django sessions that still exist,
+    keyed by session key. Saving a session moves its expiry forward, so the date
+    recorded at login can be out of date. Database-backed engines report the actual
+    expiry date. Other engines only report whether the session exists, so those are
+    given a full `SESSION_COOKIE_AGE`, and checked again once that has passed.
+    """
+    store_class = import_module(settings.SESSION_ENGINE).SessionStore
+    get_model_class = getattr(store_class, "get_model_class", None)
+    prefix = getattr(store_class, "cache_key_prefix", None)
+    now = timezone.now()
+    if get_model_class is not None:
+        return dict(
+            get_model_class()
+            .objects.filter(session_key__in=session_keys, expire_date__gt=now)
+            .values_list("session_key", "expire_date")
+        )
+    expires = now + datetime.timedelta(seconds=settings.SESSION_COOKIE_AGE)
+    if prefix is not None:
+        found = caches[settings.SESSION_CACHE_ALIAS].get_many(
+            [prefix + key for key in session_keys]
+        )
+        return {key: expires for key in session_keys if prefix + key in found}
+    return {key: expires for key in session_keys if store_class().exists(key)}
+
+
+def cleanup(batch_size=1000):
+    """
+    Removes the registry entries of sessions that have ended. Entries past their
+    recorded expiry are checked against the session store first, and those of sessions
+    that are still live get their expiry updated instead. Returns the number of entries
+    removed.
+    """
+    expired = IdPSession.objects.filter(expires__lte=timezone.now())
+    deleted = 0
+    while True:
+        batch = list(expired.only("session_key", "expires")[:batch_size])
+        if not batch:
+            return deleted
+        live = get_live_sessions({entry.session_key for entry in batch})
+        ended = [entry.pk for entry in batch if entry.session_key not in live]
+        if ended:
+            deleted += IdPSession.objects.filter(pk__in=ended).delete()[0]
+        extended = [entry for entry in batch if entry.session_key in live]
+        for entry in extended:
+            entry.expires = live[entry.session_key]
+        IdPSession.objects.bulk_update(extended, ["expires"])
@@ -0,0 +1,154 @@
+from xml.sax.saxutils import escape
+
+from django.http import HttpResponse
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
+from onelogin.saml2.logout_request import OneLogin_Saml2_Logout_Request
+from onelogin.saml2.logout_response import OneLogin_Saml2_Logout_Response
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+
+from .keys import sign_xml
+
+SOAP_ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">'
+    "<SOAP-ENV:Body>{}</SOAP-ENV:Body></SOAP-ENV:Envelope>"
+)
+
+SOAP_FAULT = (
+    "<SOAP-ENV:Fault><faultcode>SOAP-ENV:Client</faultcode>"
+    "<faultstring>{}</faultstring></SOAP-ENV:Fault>"
+)
+
+LOGOUT_REQUEST_PATH = "{{{}}}Body/{{{}}}LogoutRequest".format(
+    OneLogin_Saml2_Constants.NS_SOAP, OneLogin_Saml2_Constants.NS_SAMLP
+)
+
+DS = "{{{}}}".format(OneLogin_Saml2_Constants.NS_DS)
+
+
+class LogoutRequestError(Exception):
+    pass
+
+
+def get_idp_certificates(saml_settings):
+    idp_data = saml_settings.get_idp_data()
+    certs = idp_data.get("x509certMulti", {}).get("signing") or [
+        idp_data.get("x509cert")
+    ]
+    return [cert for cert in certs if cert]
+
+
+def parse_soap_logout_request(saml_settings, body):
+    """
+    Extracts the LogoutRequest from a SOAP (back-channel) Single Logout message, and
+    checks that it was signed by, and issued by, the IdP and hasn't expired. Since
+    there is no browser session to tie it to, the request must be signed. Returns a
+    tuple of the request ID, nameid, and session indexes.
+    """
+    try:
+        envelope = OneLogin_Saml2_XML.to_etree(body)
+    except Exception:
+        raise LogoutRequestError("The message is not valid XML.")
+    request = envelope.find(LOGOUT_REQUEST_PATH)
+    if request is None:
+        raise LogoutRequestError("The message does not contain a LogoutRequest.")
+    # Signatures are validated against the LogoutRequest as a document of its own.
+    request = OneLogin_Saml2_XML.to_etree(OneLogin_Saml2_XML.to_string(request))
+    if not signatures_cover(request):
+        raise LogoutRequestError("The LogoutRequest signature does not cover it.")
+    if saml_settings.is_strict():
+        valid = OneLogin_Saml2_XML.validate_xml(
+            request, "saml-schema-protocol-2.0.xsd", saml_settings.is_debug_active()
+        )
+        if isinstance(valid, str):
+            raise LogoutRequestError("The LogoutRequest does not match the schema.")
+    try:
+        signed = OneLogin_Saml2_Utils.validate_sign(
+            request,
+            xpath="/samlp:LogoutRequest/ds:Signature",
+            multicerts=get_idp_certificates(saml_settings),
+        )
+    except Exception:
+        signed = False
+    if not signed:
+        raise LogoutRequestError("The LogoutRequest signature is not valid.")
+    issuer = OneLogin_Saml2_Logout_Request.get_issuer(request)
+    if issuer != saml_settings.get_idp_data()["entityId"]:
+        raise LogoutRequestError("Unexpected LogoutRequest issuer: {}".format(issuer))
+    not_on_or_after = request.get("NotOnOrAfter")
+    if not_on_or_after and (
+        OneLogin_Saml2_Utils.parse_SAML_to_time(not_on_or_after)
+        <= OneLogin_Saml2_Utils.now()
+    ):
+        raise LogoutRequestError("The LogoutRequest has expired.")
+    return get_logout_request_targets(saml_settings, request)
+
+
+def signatures_cover(root):
+    """
+    Whether every signature of a parsed message signs the whole of it, with exactly one
+    Reference, whose URI is empty or "#" and the message ID. python3-saml verifies
+    signatures without checking what they refer to, so a valid signature of another
+    element could otherwise be moved into a forged message (signature wrapping).
+    """
+    whole = {""} if root.get("ID") is None else {"", "#" + root.get("ID")}
+    for signature in root.findall(DS + "Signature"):
+        references = signature.findall(DS + "SignedInfo/" + DS + "Reference")
+        if len(references) != 1 or references[0].get("URI", "") not in whole:
+            return False
+    return True
+
+
+def get_logout_request_targets(saml_settings, request):
+    """
+    Returns a tuple of the ID, nameid, and session indexes of a LogoutRequest (XML or
+    parsed), decrypting the nameid with the SP private key if needed.
+    """
+    return (
+        OneLogin_Saml2_Logout_Request.get_id(request),
+        OneLogin_Saml2_Logout_Request.get_nameid(
+            request, key=saml_settings.get_sp_key()
+        ),
+        OneLogin_Saml2_Logout_Request.get_session_indexes(request),
+    )
+
+
+def is_signed_logout_request(request, saml):
+    """
+    Whether a front-channel (redirect) SLO request carries a signed LogoutRequest.
+    process_slo rejects any LogoutRequest whose signature doesn't verify, so once it
+    succeeds, a signed request really came from the IdP. The redirect signature covers
+    the whole message, but any signature embedded in it must too.
+    """
+    if "SAMLRequest" not in request.GET or "Signature" not in request.GET:
+        return False
+    return signatures_cover(OneLogin_Saml2_XML.to_etree(saml.get_last_request_xml()))
+
+
+def soap_logout_response(saml_settings, in_response_to, sign=False):
+    """
+    Returns a SOAP message containing a successful LogoutResponse, signed with the SP
+    private key if `sign` is set.
+    """
+    response = OneLogin_Saml2_Logout_Response(saml_settings)
+    response.build(in_response_to)
+    xml = response.get_xml()
+    if sign:
+        security = saml_settings.get_security_data()
+        xml = sign_xml(
+            xml,
+            saml_settings.get_sp_key(),
+            saml_settings.get_sp_cert(),
+            security["signatureAlgorithm"],
+            security["digestAlgorithm"],
+        )
+    return SOAP_ENVELOPE.format(xml)
+
+
+def soap_fault(message):
+    return SOAP_ENVELOPE.format(SOAP_FAULT.format(escape(message)))
+
+
+def soap_fault_response(message):
+    return HttpResponse(soap_fault(message), status=500, content_type="text/xml")
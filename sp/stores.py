@@ -0,0 +1,317 @@
+import collections
+import datetime
+import secrets
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+class ReplayStore:
+    """
+    Records the IDs of processed SAML responses, so the same response can't be used to
+    log in twice. Each ID is stored along with a value (the redirect URL of the original
+    login), until an expiration given as a Unix timestamp.
+    """
+
+    def add(self, key, value, expires):
+        """
+        Records `key` until `expires`. Returns True if the key was added, or False if it
+        was already present (i.e. the response is a replay).
+        """
+        raise NotImplementedError()
+
+    def get(self, key):
+        """
+        Returns the value stored for `key`, or None if it is not present.
+        """
+        raise NotImplementedError()
+
+    async def aadd(self, key, value, expires):
+        return await sync_to_async(self.add)(key, value, expires)
+
+    async def aget(self, key):
+        return await sync_to_async(self.get)(key)
+
+    def cleanup(self):
+        """
+        Removes expired entries, for stores that don't do this themselves. Returns the
+        number of entries removed.
+        """
+        return 0
+
+
+class MemoryReplayStore(ReplayStore):
+    """
+    An in-process, LRU-bounded replay store. Only suitable for single-process
+    deployments, since other processes won't see its entries.
+    """
+
+    def __init__(self):
+        self.maxsize = getattr(settings, "SP_REPLAY_MAX_ENTRIES", 100000)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        # Entries are roughly in expiration order, so expired entries are at the front.
+        # Stop at the first live one to keep this O(1) amortized.
+        while self._entries:
+            key, (expires, value) = next(iter(self._entries.items()))
+            if expires > now and len(self._entries) <= self.maxsize:
+                break
+            del self._entries[key]
+
+    def add(self, key, value, expires):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return False
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            self._evict(now)
+            return True
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    async def aadd(self, key, value, expires):
+        return self.add(key, value, expires)
+
+    async def aget(self, key):
+        return self.get(key)
+
+
+class CacheReplayStore(ReplayStore):
+    """
+    A replay store using the Django cache named by `SP_REPLAY_CACHE` (by default, the
+    "default" cache). Relies on `cache.add` being atomic for the cache backend.
+    """
+
+    key_prefix = "sp:replay:"
+
+    def __init__(self):
+        self.cache = caches[getattr(settings, "SP_REPLAY_CACHE", "default")]
+
+    def add(self, key, value, expires):
+        timeout = max(1, int(expires - time.time()))
+        return self.cache.add(self.key_prefix + key, value or "", timeout)
+
+    def get(self, key):
+        return self.cache.get(self.key_prefix + key)
+
+    async def aadd(self, key, value, expires):
+        timeout = max(1, int(expires - time.time()))
+        return await self.cache.aadd(self.key_prefix + key, value or "", timeout)
+
+    async def aget(self, key):
+        return await self.cache.aget(self.key_prefix + key)
+
+
+class DatabaseReplayStore(ReplayStore):
+    """
+    A replay store backed by the ProcessedResponse model. Expired rows are removed by
+    the `sp_cleanup` management command.
+    """
+
+    def add(self, key, value, expires):
+        from .models import ProcessedResponse
+
+        expires = datetime.datetime.fromtimestamp(expires, tz=datetime.timezone.utc)
+        try:
+            with transaction.atomic():
+                ProcessedResponse.objects.create(
+                    key=key, value=value or "", expires=expires
+                )
+            return True
+        except IntegrityError:
+            # Reclaim the key only if the existing entry has expired.
+            return bool(
+                ProcessedResponse.objects.filter(
+                    key=key, expires__lte=timezone.now()
+                ).update(value=value or "", expires=expires)
+            )
+
+    def get(self, key):
+        from .models import ProcessedResponse
+
+        return (
+            ProcessedResponse.objects.filter(key=key, expires__gt=timezone.now())
+            .values_list("value", flat=True)
+            .first()
+        )
+
+    def cleanup(self):
+        from .models import ProcessedResponse
+
+        deleted, _ = ProcessedResponse.objects.filter(
+            expires__lte=timezone.now()
+        ).delete()
+        return deleted
+
+
+class StateStore:
+    """
+    Stores the state of outstanding login requests (the redirect URL, login mode, and
+    AuthnRequest ID) server-side, keyed by a short random token sent as the RelayState.
+    """
+
+    token_prefix = "sp-"
+
+    def new_token(self):
+        return self.token_prefix + secrets.token_urlsafe(16)
+
+    def is_token(self, value):
+        return bool(value) and value.startswith(self.token_prefix)
+
+    def set(self, token, state, timeout):
+        """
+        Stores the `state` dictionary for `timeout` seconds.
+        """
+        raise NotImplementedError()
+
+    def pop(self, token):
+        """
+        Returns and removes the state stored for `token`, or returns None if there is
+        no such (unexpired) state. A token can only ever be popped once.
+        """
+        raise NotImplementedError()
+
+    async def aset(self, token, state, timeout):
+        await sync_to_async(self.set)(token, state, timeout)
+
+    async def apop(self, token):
+        return await sync_to_async(self.pop)(token)
+
+    def cleanup(self):
+        """
+        Removes expired entries, for stores that don't do this themselves. Returns the
+        number of entries removed.
+        """
+        return 0
+
+
+class CacheStateStore(StateStore):
+    """
+    A state store using the Django cache named by `SP_STATE_CACHE` (by default, the
+    "default" cache). The cache must be shared by all processes serving the SP.
+    """
+
+    key_prefix = "sp:state:"
+
+    def __init__(self):
+        self.cache = caches[getattr(settings, "SP_STATE_CACHE", "default")]
+
+    def set(self, token, state, timeout):
+        self.cache.set(self.key_prefix + token, state, timeout)
+
+    def pop(self, token):
+        key = self.key_prefix + token
+        state = self.cache.get(key)
+        # Only the request that actually deletes the key gets to use the state.
+        if state is None or not self.cache.delete(key):
+            return None
+        return state
+
+    async def aset(self, token, state, timeout):
+        await self.cache.aset(self.key_prefix + token, state, timeout)
+
+    async def apop(self, token):
+        key = self.key_prefix + token
+        state = await self.cache.aget(key)
+        if state is None or not await self.cache.adelete(key):
+            return None
+        return state
+
+
+class DatabaseStateStore(StateStore):
+    """
+    A state store backed by the LoginState model. Expired rows are removed by the
+    `sp_cleanup` management command.
+    """
+
+    def set(self, token, state, timeout):
+        from .models import LoginState
+
+        LoginState.objects.create(
+            token=token,
+            state=state,
+            expires=timezone.now() + datetime.timedelta(seconds=timeout),
+        )
+
+    def pop(self, token):
+        from .models import LoginState
+
+        login_state = LoginState.objects.filter(
+            token=token, expires__gt=timezone.now()
+        ).first()
+        # Only the request that actually deletes the row gets to use the state.
+        if login_state is None or not login_state.delete()[0]:
+            return None
+        return login_state.state
+
+    async def aset(self, token, state, timeout):
+        from .models import LoginState
+
+        await LoginState.objects.acreate(
+            token=token,
+            state=state,
+            expires=timezone.now() + datetime.timedelta(seconds=timeout),
+        )
+
+    async def apop(self, token):
+        from .models import LoginState
+
+        login_state = await LoginState.objects.filter(
+            token=token, expires__gt=timezone.now()
+        ).afirst()
+        if login_state is None or not (await login_state.adelete())[0]:
+            return None
+        return login_state.state
+
+    def cleanup(self):
+        from .models import LoginState
+
+        deleted, _ = LoginState.objects.filter(expires__lte=timezone.now()).delete()
+        return deleted
+
+
+_stores = {}
+
+
+def get_store(setting, default):
+    """
+    Returns the (shared) store instance for the class named by `setting`, or None if
+    the setting is empty.
+    """
+    path = getattr(settings, setting, default)
+    if not path:
+        return None
+    store = _stores.get(path)
+    if store is None:
+        store = _stores[path] = import_string(path)()
+    return store
+
+
+def get_replay_store():
+    return get_store("SP_REPLAY_STORE", "sp.stores.CacheReplayStore")
+
+
+def get_state_store():
+    return get_store("SP_STATE_STORE", "sp.stores.DatabaseStateStore")
+
+
+@receiver(setting_changed)
+def _setting_changed(**kwargs):
+    _stores.clear()
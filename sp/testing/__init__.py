@@ -0,0 +1,439 @@
+import base64
+import datetime
+import threading
+import uuid
+from urllib.parse import parse_qs, urlencode, urlsplit
+from xml.sax.saxutils import escape, quoteattr
+
+import xmlsec
+from django.contrib.auth import REDIRECT_FIELD_NAME
+from lxml import etree
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+
+from ..crypto import DEFAULT_KEY_ALGORITHM, make_certificate, take_private_key
+from ..keys import SIGN_TRANSFORMS, load_certificate
+from ..models import IdP
+from ..slo import SOAP_ENVELOPE
+
+NAMEID_FORMAT = "urn:oasis:names:tc:SAML:1.1:nameid-format:unspecified"
+SAML_NS = OneLogin_Saml2_Constants.NS_SAML
+
+# SAML attribute names mapped to user fields by LocalIdP.create_idp, by default.
+DEFAULT_ATTRIBUTES = {
+    "mail": "email",
+    "givenName": "first_name",
+    "sn": "last_name",
+}
+
+METADATA = """<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" \
+entityID={entity_id}>
+<md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+<md:KeyDescriptor use="signing">
+<ds:KeyInfo xmlns:ds="http://www.w3.org/2000/09/xmldsig#">
+<ds:X509Data><ds:X509Certificate>{certificate}</ds:X509Certificate></ds:X509Data>
+</ds:KeyInfo></md:KeyDescriptor>
+<md:SingleLogoutService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect" \
+Location={slo_url}/>
+<md:NameIDFormat>{nameid_format}</md:NameIDFormat>
+<md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect" \
+Location={sso_url}/>
+</md:IDPSSODescriptor>
+</md:EntityDescriptor>"""
+
+RESPONSE = """<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" \
+xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="{response_id}" Version="2.0" \
+IssueInstant="{now}" Destination={acs}{in_response_to}>
+<saml:Issuer>{issuer}</saml:Issuer>
+<samlp:Status><samlp:StatusCode Value="urn:oasis:names:tc:SAML:2.0:status:Success"/>\
+</samlp:Status>
+<saml:Assertion ID="{assertion_id}" Version="2.0" IssueInstant="{now}">
+<saml:Issuer>{issuer}</saml:Issuer>
+<saml:Subject>
+<saml:NameID Format={nameid_format}>{nameid}</saml:NameID>
+<saml:SubjectConfirmation Method="urn:oasis:names:tc:SAML:2.0:cm:bearer">
+<saml:SubjectConfirmationData NotOnOrAfter="{expires}" Recipient={acs}\
+{in_response_to}/>
+</saml:SubjectConfirmation>
+</saml:Subject>
+<saml:Conditions NotBefore="{not_before}" NotOnOrAfter="{expires}">
+<saml:AudienceRestriction><saml:Audience>{audience}</saml:Audience>\
+</saml:AudienceRestriction>
+</saml:Conditions>
+<saml:AuthnStatement AuthnInstant="{now}" SessionIndex={session_index}\
+{session_expires}>
+<saml:AuthnContext><saml:AuthnContextClassRef>\
+urn:oasis:names:tc:SAML:2.0:ac:classes:PasswordProtectedTransport\
+</saml:AuthnContextClassRef></saml:AuthnContext>
+</saml:AuthnStatement>
+{attributes}</saml:Assertion>
+</samlp:Response>"""
+
+LOGOUT_REQUEST = """<samlp:LogoutRequest \
+xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" \
+xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="{request_id}" Version="2.0" \
+IssueInstant="{now}" Destination={slo}>
+<saml:Issuer>{issuer}</saml:Issuer>
+<saml:NameID Format={nameid_format}>{nameid}</saml:NameID>{session_index}
+</samlp:LogoutRequest>"""
+
+LOGOUT_RESPONSE = """<samlp:LogoutResponse \
+xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" \
+xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="{response_id}" Version="2.0" \
+IssueInstant="{now}" Destination={slo}{in_response_to}>
+<saml:Issuer>{issuer}</saml:Issuer>
+<samlp:Status><samlp:StatusCode Value="urn:oasis:names:tc:SAML:2.0:status:Success"/>\
+</samlp:Status>
+</samlp:LogoutResponse>"""
+
+
+def saml_id():
+    return "_" + uuid.uuid4().hex
+
+
+def saml_time(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _optional(name, value):
+    return " {}={}".format(name, quoteattr(value)) if value else ""
+
+
+def _attribute_statement(attributes):
+    if not attributes:
+        return ""
+    xml = []
+    for name, values in attributes.items():
+        if isinstance(values, str):
+            values = [values]
+        xml.append(
+            "<saml:Attribute Name={}>{}</saml:Attribute>".format(
+                quoteattr(name),
+                "".join(
+                    "<saml:AttributeValue>{}</saml:AttributeValue>".format(escape(v))
+                    for v in values
+                ),
+            )
+        )
+    return "<saml:AttributeStatement>{}</saml:AttributeStatement>\n".format(
+        "".join(xml)
+    )
+
+
+def parse_message(data, deflated=True):
+    """
+    Decodes a SAML message from the HTTP-Redirect (or, if `deflated` is False,
+    HTTP-POST) binding, returning a dictionary of its type, ID, issuer, and (where
+    present) InResponseTo, AssertionConsumerServiceURL, and NameID.
+    """
+    if deflated:
+        xml = OneLogin_Saml2_Utils.decode_base64_and_inflate(data)
+    else:
+        xml = base64.b64decode(data)
+    root = OneLogin_Saml2_XML.to_etree(xml)
+    issuer = root.find("{%s}Issuer" % SAML_NS)
+    nameid = root.find("{%s}NameID" % SAML_NS)
+    return {
+        "type": etree.QName(root).localname,
+        "id": root.get("ID"),
+        "issuer": issuer.text if issuer is not None else None,
+        "in_response_to": root.get("InResponseTo"),
+        "acs_url": root.get("AssertionConsumerServiceURL"),
+        "nameid": nameid.text if nameid is not None else None,
+    }
+
+
+class LocalIdP:
+    """
+    A stand-in identity provider for tests, benchmarks, and local development. It has
+    its own key pair and metadata, and mints signed (and optionally encrypted) SAML
+    messages for an `IdP`, without any network access. Parsed keys are kept for the
+    life of the instance, so minting a message mostly costs one RSA signature.
+    """
+
+    def __init__(
+        self,
+        base_url="https://idp.example.com",
+        entity_id=None,
+        private_key=None,
+        certificate=None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.entity_id = entity_id or self.base_url + "/metadata/"
+        self.sso_url = self.base_url + "/sso/"
+        self.slo_url = self.base_url + "/slo/"
+        self.private_key = private_key or take_private_key()
+        if not certificate:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            certificate = make_certificate(
+                self.private_key,
+                urlsplit(self.base_url).hostname or "localhost",
+                now - datetime.timedelta(days=1),
+                now + datetime.timedelta(days=3650),
+            )
+        self.certificate = certificate
+        self._signing_key = xmlsec.Key.from_memory(
+            self.private_key, xmlsec.KeyFormat.PEM, None
+        )
+        self._signing_key.load_cert_from_memory(
+            self.certificate, xmlsec.KeyFormat.CERT_PEM
+        )
+        self._sp_private_keys = {}
+        self._managers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def certificate_body(self):
+        """
+        The certificate, without its PEM header and footer, as used in metadata.
+        """
+        return "".join(
+            line for line in self.certificate.splitlines() if "-----" not in line
+        )
+
+    @property
+    def sp_private_key(self):
+        """
+        A private key shared by the IdPs created with create_idp, so tests don't have
+        to wait on key generation.
+        """
+        return self.shared_private_key(DEFAULT_KEY_ALGORITHM)
+
+    def shared_private_key(self, algorithm):
+        """
+        Returns the shared private key (see sp_private_key) for a key algorithm.
+        """
+        with self._lock:
+            if algorithm not in self._sp_private_keys:
+                self._sp_private_keys[algorithm] = take_private_key(algorithm)
+            return self._sp_private_keys[algorithm]
+
+    def metadata(self, entity_id=None):
+        return METADATA.format(
+            entity_id=quoteattr(entity_id or self.entity_id),
+            certificate=self.certificate_body,
+            sso_url=quoteattr(self.sso_url),
+            slo_url=quoteattr(self.slo_url),
+            nameid_format=NAMEID_FORMAT,
+        )
+
+    def configure(self, idp):
+        """
+        Imports this IdP's metadata into an existing `IdP`.
+        """
+        idp.metadata_url = ""
+        idp.metadata_xml = self.metadata()
+        idp.import_metadata()
+        return idp
+
+    def create_idp(self, attributes=None, **fields):
+        """
+        Creates an `IdP` (with a certificate) that authenticates via this IdP, mapping
+        the given SAML attributes to user fields (by default, DEFAULT_ATTRIBUTES).
+        """
+        fields.setdefault("name", "Local IdP")
+        fields.setdefault("url_params", {"idp_slug": "local"})
+        fields.setdefault("base_url", "https://sp.example.com")
+        fields.setdefault("contact_name", "Local IdP")
+        fields.setdefault("contact_email", "local@example.com")
+        idp = IdP(**fields)
+        idp.set_certificate(self.shared_private_key(idp.key_algorithm))
+        self.configure(idp)
+        if attributes is None:
+            attributes = DEFAULT_ATTRIBUTES
+        for saml_attribute, mapped_name in attributes.items():
+            idp.attributes.create(
+                saml_attribute=saml_attribute, mapped_name=mapped_name
+            )
+        return idp
+
+    def response(
+        self,
+        idp,
+        nameid,
+        attributes=None,
+        in_response_to=None,
+        sign_response=False,
+        sign_assertion=True,
+        encrypt=False,
+        session_expires=None,
+        session_index=None,
+    ):
+        """
+        Returns a base64-encoded Response (for the HTTP-POST binding) authenticating
+        `nameid` with the given attributes (a dictionary of names to a value or list
+        of values). The assertion is encrypted with the SP certificate if `encrypt` is
+        True, and has a random SessionIndex unless `session_index` is given.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        xml = RESPONSE.format(
+            response_id=saml_id(),
+            assertion_id=saml_id(),
+            now=saml_time(now),
+            not_before=saml_time(now - datetime.timedelta(minutes=1)),
+            expires=saml_time(now + datetime.timedelta(minutes=5)),
+            issuer=escape(self.entity_id),
+            nameid=escape(nameid),
+            nameid_format=quoteattr(NAMEID_FORMAT),
+            acs=quoteattr(idp.get_acs()),
+            audience=escape(idp.get_entity_id()),
+            in_response_to=_optional("InResponseTo", in_response_to),
+            session_index=quoteattr(session_index or saml_id()),
+            session_expires=_optional(
+                "SessionNotOnOrAfter", session_expires and saml_time(session_expires)
+            ),
+            attributes=_attribute_statement(attributes),
+        )
+        response = etree.fromstring(xml)
+        assertion = response.find("{%s}Assertion" % SAML_NS)
+        if sign_assertion:
+            self._sign(assertion)
+        if encrypt:
+            self._encrypt(assertion, idp.x509_certificate)
+        if sign_response:
+            self._sign(response)
+        return base64.b64encode(etree.tostring(response)).decode("ascii")
+
+    def logout_request(
+        self, idp, nameid, session_index=None, relay_state=None, sign=False
+    ):
+        """
+        Returns the query parameters of an IdP-initiated LogoutRequest for the
+        HTTP-Redirect binding.
+        """
+        xml = self._logout_request_xml(idp, nameid, session_index)
+        return self._redirect_params("SAMLRequest", xml, relay_state, sign)
+
+    def soap_logout_request(self, idp, nameid, session_index=None, sign=True):
+        """
+        Returns a SOAP message containing a back-channel LogoutRequest, which is signed
+        unless `sign` is False.
+        """
+        request = etree.fromstring(self._logout_request_xml(idp, nameid, session_index))
+        if sign:
+            self._sign(request)
+        return SOAP_ENVELOPE.format(etree.tostring(request).decode("utf-8"))
+
+    def _logout_request_xml(self, idp, nameid, session_index):
+        return LOGOUT_REQUEST.format(
+            request_id=saml_id(),
+            now=saml_time(datetime.datetime.now(datetime.timezone.utc)),
+            slo=quoteattr(idp.get_slo()),
+            issuer=escape(self.entity_id),
+            nameid=escape(nameid),
+            nameid_format=quoteattr(NAMEID_FORMAT),
+            session_index=(
+                "\n<samlp:SessionIndex>{}</samlp:SessionIndex>".format(
+                    escape(session_index)
+                )
+                if session_index
+                else ""
+            ),
+        )
+
+    def logout_response(self, idp, in_response_to=None, relay_state=None, sign=False):
+        """
+        Returns the query parameters of a successful LogoutResponse for the
+        HTTP-Redirect binding.
+        """
+        xml = LOGOUT_RESPONSE.format(
+            response_id=saml_id(),
+            now=saml_time(datetime.datetime.now(datetime.timezone.utc)),
+            slo=quoteattr(idp.get_slo()),
+            issuer=escape(self.entity_id),
+            in_response_to=_optional("InResponseTo", in_response_to),
+        )
+        return self._redirect_params("SAMLResponse", xml, relay_state, sign)
+
+    def login(self, client, idp, nameid, attributes=None, next=None, **kwargs):
+        """
+        Logs in via the SP's login and ACS views using a Django test `client`, as
+        `nameid` with the given attributes. Extra arguments are passed to response().
+        Returns the ACS response.
+        """
+        extra = self.client_kwargs(idp)
+        params = {REDIRECT_FIELD_NAME: next} if next else {}
+        response = client.get(idp.get_login_url(), params, **extra)
+        query = parse_qs(urlsplit(response["Location"]).query)
+        request = parse_message(query["SAMLRequest"][0])
+        data = {
+            "SAMLResponse": self.response(
+                idp, nameid, attributes, in_response_to=request["id"], **kwargs
+            ),
+            "RelayState": query["RelayState"][0],
+        }
+        return client.post(idp.get_url("sp-idp-acs"), data, **extra)
+
+    def client_kwargs(self, idp):
+        """
+        Returns the test client request arguments for the host and scheme of the SP's
+        base URL, which python3-saml checks against the message destination.
+        """
+        url = urlsplit(idp.base_url)
+        return {"HTTP_HOST": url.netloc, "secure": url.scheme == "https"}
+
+    def _sign(self, element):
+        # The signature goes right after the Issuer.
+        signature = xmlsec.template.create(
+            element, xmlsec.Transform.EXCL_C14N, xmlsec.Transform.RSA_SHA256, ns="ds"
+        )
+        element.insert(1, signature)
+        ref = xmlsec.template.add_reference(
+            signature, xmlsec.Transform.SHA256, uri="#" + element.get("ID")
+        )
+        xmlsec.template.add_transform(ref, xmlsec.Transform.ENVELOPED)
+        xmlsec.template.add_transform(ref, xmlsec.Transform.EXCL_C14N)
+        xmlsec.template.add_x509_data(xmlsec.template.ensure_key_info(signature))
+        xmlsec.tree.add_ids(element, ["ID"])
+        ctx = xmlsec.SignatureContext()
+        ctx.key = self._signing_key
+        ctx.sign(signature)
+
+    def _encrypt(self, assertion, certificate):
+        wrapper = etree.Element("{%s}EncryptedAssertion" % SAML_NS)
+        assertion.getparent().replace(assertion, wrapper)
+        wrapper.append(assertion)
+        data = xmlsec.template.encrypted_data_create(
+            wrapper,
+            xmlsec.Transform.AES128,
+            type=xmlsec.EncryptionType.ELEMENT,
+            ns="xenc",
+        )
+        xmlsec.template.encrypted_data_ensure_cipher_value(data)
+        key_info = xmlsec.template.encrypted_data_ensure_key_info(data, ns="ds")
+        encrypted_key = xmlsec.template.add_encrypted_key(
+            key_info, xmlsec.Transform.RSA_OAEP
+        )
+        xmlsec.template.encrypted_data_ensure_cipher_value(encrypted_key)
+        ctx = xmlsec.EncryptionContext(self._keys_manager(certificate))
+        ctx.key = xmlsec.Key.generate(
+            xmlsec.KeyData.AES, 128, xmlsec.KeyDataType.SESSION
+        )
+        ctx.encrypt_xml(data, assertion)
+
+    def _keys_manager(self, certificate):
+        # Creating a KeysManager is comparatively expensive, so keep one per SP
+        # certificate.
+        material = load_certificate(certificate)
+        with self._lock:
+            manager = self._managers.get(material.fingerprint)
+            if manager is None:
+                manager = self._managers[material.fingerprint] = xmlsec.KeysManager()
+                manager.add_key(material.xmlsec_key)
+            return manager
+
+    def _redirect_params(self, name, xml, relay_state, sign):
+        params = {name: OneLogin_Saml2_Utils.deflate_and_base64_encode(xml)}
+        if relay_state is not None:
+            params["RelayState"] = relay_state
+        if sign:
+            params["SigAlg"] = OneLogin_Saml2_Constants.RSA_SHA256
+            ctx = xmlsec.SignatureContext()
+            ctx.key = self._signing_key
+            signature = ctx.sign_binary(
+                urlencode(params).encode("ascii"),
+                SIGN_TRANSFORMS[OneLogin_Saml2_Constants.RSA_SHA256],
+            )
+            params["Signature"] = OneLogin_Saml2_Utils.b64encode(signature)
+        return params
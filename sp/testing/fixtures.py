@@ -0,0 +1,40 @@
+"""
+pytest fixtures for testing an SP against a LocalIdP. Enable them in a conftest.py with:
+
+    pytest_plugins = ["sp.testing.fixtures"]
+
+The database and client fixtures come from pytest-django.
+"""
+
+import pytest
+
+from . import LocalIdP
+
+
+@pytest.fixture(scope="session")
+def local_idp():
+    """
+    A LocalIdP shared by the whole test session, so keys are only generated once.
+    """
+    return LocalIdP()
+
+
+@pytest.fixture
+def saml_idp(db, local_idp):
+    """
+    An `IdP` that authenticates via `local_idp`.
+    """
+    return local_idp.create_idp()
+
+
+@pytest.fixture
+def saml_login(client, local_idp, saml_idp):
+    """
+    A function that logs the test client in via `saml_idp` as the given nameid, with
+    optional attributes, returning the ACS response.
+    """
+
+    def login(nameid, attributes=None, idp=None, **kwargs):
+        return local_idp.login(client, idp or saml_idp, nameid, attributes, **kwargs)
+
+    return login
@@ -0,0 +1,89 @@
+import atexit
+import collections
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+
+class TimestampBuffer:
+    """
+    Collects timestamp updates (like `IdP.last_login`) in memory, and writes them with
+    one `bulk_update` per model and field at most once every `SP_TIMESTAMP_INTERVAL`
+    seconds. Repeated updates to the same row between flushes are coalesced, so a busy
+    row is written at most once per interval instead of once per login.
+    """
+
+    def __init__(self):
+        # (model, field) -> {pk: timestamp}
+        self._pending = collections.defaultdict(dict)
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def interval(self):
+        return getattr(settings, "SP_TIMESTAMP_INTERVAL", 10)
+
+    def touch(self, instance, field="last_login", when=None):
+        """
+        Sets `field` on `instance` to `when` (defaulting to now), and schedules it to be
+        written to the database.
+        """
+        if self._add(instance, field, when):
+            self.flush()
+
+    async def atouch(self, instance, field="last_login", when=None):
+        """
+        Like `touch`, for use from async code.
+        """
+        if self._add(instance, field, when):
+            await sync_to_async(self.flush)()
+
+    def _add(self, instance, field, when):
+        # Returns True if the timestamp should be written immediately.
+        when = when or timezone.now()
+        setattr(instance, field, when)
+        interval = self.interval
+        with self._lock:
+            self._pending[(instance.__class__, field)][instance.pk] = when
+            if interval > 0 and self._timer is None:
+                self._timer = threading.Timer(interval, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        return interval <= 0
+
+    def flush(self):
+        """
+        Writes all pending timestamps to the database.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, collections.defaultdict(dict)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for (model, field), stamps in pending.items():
+            objs = []
+            for pk, when in stamps.items():
+                obj = model(pk=pk)
+                setattr(obj, field, when)
+                objs.append(obj)
+            model._default_manager.bulk_update(objs, [field], batch_size=500)
+
+    def _flush_from_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            # The timer thread gets its own database connection, don't leak it.
+            connection.close()
+
+
+buffer = TimestampBuffer()
+touch = buffer.touch
+atouch = buffer.atouch
+flush = buffer.flush
+
+atexit.register(flush)
@@ -6,6 +6,7 @@ urlpatterns = [
     path("", views.metadata, name="sp-idp-metadata"),
     path("acs/", views.acs, name="sp-idp-acs"),
     path("slo/", views.slo, name="sp-idp-slo"),
+    path("slo/soap/", views.slo_soap, name="sp-idp-slo-soap"),
     path("login/", views.login, name="sp-idp-login"),
     path("test/", views.login, {"test": True}, name="sp-idp-test"),
     path("verify/", views.login, {"verify": True}, name="sp-idp-verify"),
@@ -1,17 +1,43 @@
+import asyncio
+import collections
+import copy
 import datetime
+import time
 
 import django
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import auth
-from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
-from django.shortcuts import get_object_or_404
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404
 from django.utils.module_loading import import_string
 
+from .cache import idp_lookup_cache, session_idp_cache
 from .models import IdP
+from .sessions import (
+    aregister_session,
+    aunregister_session,
+    register_session,
+    unregister_session,
+)
+from .stores import get_replay_store, get_state_store
 
+# The SAML login context is stored under one session key, as a list of the fields of
+# SAMLSession.
+SAML_SESSION_KEY = "_saml"
+
+# Sessions logged in by earlier versions stored the context under separate keys.
 IDP_SESSION_KEY = "_idpid"
 NAMEID_SESSION_KEY = "_nameid"
 NAMEID_FORMAT_SESSION_KEY = "_nameidfmt"
+LEGACY_SESSION_KEYS = (IDP_SESSION_KEY, NAMEID_SESSION_KEY, NAMEID_FORMAT_SESSION_KEY)
+
+# How a session was logged in: the IdP primary key, the (unmapped) SAML nameid and its
+# format, the SessionIndex of the assertion, and when the IdP said the session expires
+# (as a Unix timestamp), any of which but the IdP may be None.
+SAMLSession = collections.namedtuple(
+    "SAMLSession", ["idp_id", "nameid", "nameid_format", "session_index", "expires"]
+)
 
 
 def authenticate(request, idp, saml):
@@ -21,7 +47,14 @@ def authenticate(request, idp, saml):
 def login(request, user, idp, saml):
     auth.login(request, user)
     # Store the authenticating IdP and actual (not mapped) SAML nameid in the session.
-    set_session_idp(request, idp, saml.get_nameid(), saml.get_nameid_format())
+    set_session_idp(
+        request,
+        idp,
+        saml.get_nameid(),
+        saml.get_nameid_format(),
+        saml.get_session_index(),
+        saml.get_session_expiration(),
+    )
     if idp.respect_expiration:
         if (
             django.VERSION[:2] < (4, 1)
@@ -39,11 +72,46 @@ def login(request, user, idp, saml):
             request.session.set_expiry(dt)
         except TypeError:
             pass
+    register_session(request, idp, saml.get_nameid(), saml.get_session_index())
+
+
+async def aauthenticate(request, idp, saml):
+    return await auth.aauthenticate(request, idp=idp, saml=saml)
+
+
+async def alogin(request, user, idp, saml):
+    await auth.alogin(request, user)
+    await aset_session_idp(
+        request,
+        idp,
+        saml.get_nameid(),
+        saml.get_nameid_format(),
+        saml.get_session_index(),
+        saml.get_session_expiration(),
+    )
+    if idp.respect_expiration:
+        try:
+            dt = datetime.datetime.fromtimestamp(
+                saml.get_session_expiration(), tz=datetime.timezone.utc
+            )
+            await request.session.aset_expiry(dt)
+        except TypeError:
+            pass
+    await aregister_session(request, idp, saml.get_nameid(), saml.get_session_index())
 
 
 def logout(request, idp):
+    session_key = request.session.session_key
     auth.logout(request)
     clear_session_idp(request)
+    unregister_session(session_key)
+
+
+async def alogout(request, idp):
+    session_key = request.session.session_key
+    await auth.alogout(request)
+    await aclear_session_idp(request)
+    await aunregister_session(session_key)
 
 
 def prepare_request(request, idp):
@@ -58,69 +126,406 @@ def prepare_request(request, idp):
     }
 
 
+async def aprepare_request(request, idp):
+    # Nothing here blocks, so there's no need to run it in a thread.
+    return prepare_request(request, idp)
+
+
 def update_user(request, idp, saml, user, created=None):
-    # A dictionary of SAML attributes, mapped to field names via IdPAttribute.
-    attrs = idp.mapped_attributes(saml)
-    # The set of mapped attributes that should always be updated on the user.
-    always_update = set(
-        idp.attributes.filter(always_update=True).values_list("mapped_name", flat=True)
+    update_fields = _set_user_attributes(
+        idp.get_attribute_mapping(), saml, user, created
     )
-    # For users created by this backend, set initial user default values.
     if created:
-        attrs.update(
-            {default.field: [default.value] for default in idp.user_defaults.all()}
-        )
-    # Keep track of which fields (if any) were updated.
-    update_fields = []
-    for field, values in attrs.items():
-        if created or field in always_update:
-            try:
-                f = user._meta.get_field(field)
-                # Only update if the field changed. This is a primitive check, but
-                # will catch most cases.
-                if values[0] != getattr(user, f.attname):
-                    setattr(user, f.attname, values[0])
-                    update_fields.append(f.name)
-            except FieldDoesNotExist:
-                pass
-    if created or update_fields:
-        # Doing a full clean will make sure the values we set are of the correct
-        # types before saving.
+        # Doing a full clean will make sure the values we set are of the correct types
+        # before saving.
         user.full_clean(validate_unique=False)
         user.save()
+    elif update_fields:
+        # For existing users, only validate and write the fields that changed.
+        user.full_clean(
+            exclude=_unchanged_fields(user, update_fields), validate_unique=False
+        )
+        user.save(update_fields=update_fields)
+    return user
+
+
+async def aupdate_user(request, idp, saml, user, created=None):
+    update_fields = _set_user_attributes(
+        await idp.aget_attribute_mapping(), saml, user, created
+    )
+    if created:
+        user.full_clean(validate_unique=False)
+        await user.asave()
+    elif update_fields:
+        user.full_clean(
+            exclude=_unchanged_fields(user, update_fields), validate_unique=False
+        )
+        await user.asave(update_fields=update_fields)
     return user
 
 
+def _set_user_attributes(mapping, saml, user, created):
+    """
+    Sets mapped SAML attributes (and user defaults, for created users) on the user,
+    returning the names of the fields that changed.
+    """
+    # Mapped names that are actual fields on this user model, resolved once per IdP.
+    fields = mapping.get_user_fields(user.__class__)
+    # A dictionary of SAML attributes, mapped to field names via IdPAttribute.
+    attrs = mapping.map(saml)
+    # For users created by this backend, set initial user default values.
+    if created:
+        attrs.update(mapping.defaults)
+    # Keep track of which fields (if any) were updated.
+    update_fields = []
+    for name, values in attrs.items():
+        if not values or not (created or name in mapping.always_update):
+            continue
+        f = fields.get(name)
+        # Only update if the field changed. This is a primitive check, but will catch
+        # most cases.
+        if f is not None and values[0] != getattr(user, f.attname):
+            setattr(user, f.attname, values[0])
+            update_fields.append(f.name)
+    return update_fields
+
+
+def _unchanged_fields(user, update_fields):
+    return [f.name for f in user._meta.concrete_fields if f.name not in update_fields]
+
+
+def new_login_state_token():
+    return get_state_store().new_token()
+
+
+def save_login_state(idp, token, redirect, mode, request_id):
+    """
+    Stores the state of a login request (to be sent with `token` as the RelayState) for
+    `IdP.state_timeout` seconds. The `mode` is one of "login", "test", or "verify".
+    """
+    get_state_store().set(
+        token,
+        {
+            "idp": idp.pk,
+            "redirect": redirect,
+            "mode": mode,
+            "request_id": request_id,
+        },
+        idp.state_timeout,
+    )
+
+
+async def asave_login_state(idp, token, redirect, mode, request_id):
+    await get_state_store().aset(
+        token,
+        {
+            "idp": idp.pk,
+            "redirect": redirect,
+            "mode": mode,
+            "request_id": request_id,
+        },
+        idp.state_timeout,
+    )
+
+
+def pop_login_state(idp, relay_state):
+    """
+    Returns (and removes) the login state for the RelayState sent to the ACS, or None if
+    it has expired or was already used. A RelayState that isn't a login state token
+    comes from an IdP-initiated login, and is treated as the redirect URL.
+    """
+    store = get_state_store()
+    if not store.is_token(relay_state):
+        return _unsolicited_state(idp, relay_state)
+    return _check_state(idp, store.pop(relay_state))
+
+
+async def apop_login_state(idp, relay_state):
+    store = get_state_store()
+    if not store.is_token(relay_state):
+        return _unsolicited_state(idp, relay_state)
+    return _check_state(idp, await store.apop(relay_state))
+
+
+def _unsolicited_state(idp, relay_state):
+    return {
+        "idp": idp.pk,
+        "redirect": relay_state,
+        "mode": "login",
+        "request_id": None,
+    }
+
+
+def _check_state(idp, state):
+    if state is None or state.get("idp") != idp.pk:
+        return None
+    return state
+
+
+def record_response(idp, saml, value=""):
+    """
+    Records a successfully processed SAML response in the replay store (if any), along
+    with `value`. Returns False if the response had already been recorded.
+    """
+    store = get_replay_store()
+    if store is None:
+        return True
+    return store.add(get_response_key(idp, saml), value, _response_expires(saml))
+
+
+async def arecord_response(idp, saml, value=""):
+    store = get_replay_store()
+    if store is None:
+        return True
+    return await store.aadd(get_response_key(idp, saml), value, _response_expires(saml))
+
+
+def _response_expires(saml):
+    expires = saml.get_last_assertion_not_on_or_after() or (
+        time.time() + getattr(settings, "SP_REPLAY_TIMEOUT", 3600)
+    )
+    # Allow for the same clock drift python3-saml does when validating NotOnOrAfter.
+    return expires + 300
+
+
+def get_recorded_response(idp, saml):
+    """
+    Returns the value recorded for a previously processed SAML response, or None.
+    """
+    store = get_replay_store()
+    return store.get(get_response_key(idp, saml)) if store else None
+
+
+async def aget_recorded_response(idp, saml):
+    store = get_replay_store()
+    return await store.aget(get_response_key(idp, saml)) if store else None
+
+
+def get_response_key(idp, saml):
+    response_id = saml.get_last_assertion_id() or saml.get_last_message_id()
+    return "{}:{}".format(idp.pk, response_id)
+
+
 def get_request_idp(request, **kwargs):
     custom_loader = getattr(settings, "SP_IDP_LOADER", None)
     if custom_loader:
         return import_string(custom_loader)(request, **kwargs)
     else:
-        return get_object_or_404(IdP, url_params=kwargs, is_active=True)
+        return load_idp(**kwargs)
+
+
+async def aget_request_idp(request, **kwargs):
+    """
+    Like get_request_idp, for async views. `SP_IDP_LOADER` may be an async function.
+    """
+    custom_loader = getattr(settings, "SP_IDP_LOADER", None)
+    if custom_loader:
+        loader = import_string(custom_loader)
+        if asyncio.iscoroutinefunction(loader):
+            return await loader(request, **kwargs)
+        return await sync_to_async(loader)(request, **kwargs)
+    else:
+        return await aload_idp(**kwargs)
+
+
+def load_idp(**url_params):
+    """
+    The default IdP loader. Looks up an active IdP by its (indexed) lookup key, caching
+    both hits and misses in-process for `SP_IDP_CACHE_TIMEOUT` seconds.
+    """
+    lookup_key = IdP.make_lookup_key(url_params)
+    idp = idp_lookup_cache.get(lookup_key)
+    if idp is None:
+        try:
+            idp = _idp_queryset().get(lookup_key=lookup_key)
+        except IdP.DoesNotExist:
+            idp = False
+        _cache_idp(lookup_key, idp)
+    return _loaded_idp(idp)
+
+
+async def aload_idp(**url_params):
+    lookup_key = IdP.make_lookup_key(url_params)
+    idp = idp_lookup_cache.get(lookup_key)
+    if idp is None:
+        try:
+            idp = await _idp_queryset().aget(lookup_key=lookup_key)
+        except IdP.DoesNotExist:
+            idp = False
+        _cache_idp(lookup_key, idp)
+    return _loaded_idp(idp)
+
+
+def _idp_queryset():
+    return IdP.objects.defer(*IdP.DEFERRED_FIELDS).filter(is_active=True)
+
+
+def _cache_idp(lookup_key, idp):
+    idp_lookup_cache.set(lookup_key, idp, getattr(settings, "SP_IDP_CACHE_TIMEOUT", 10))
+
+
+def _loaded_idp(idp):
+    if idp is False:
+        raise Http404("No active IdP matches the given URL parameters.")
+    # Callers are free to modify the IdP they get back, so don't share instances.
+    return copy.copy(idp)
+
+
+def get_saml_session(request):
+    """
+    Returns the SAMLSession the current session was logged in with, or None.
+    """
+    value = request.session.get(SAML_SESSION_KEY)
+    if value is not None:
+        return SAMLSession(*value)
+    idp_id = request.session.get(IDP_SESSION_KEY)
+    if idp_id is None:
+        return None
+    return SAMLSession(
+        idp_id,
+        request.session.get(NAMEID_SESSION_KEY),
+        request.session.get(NAMEID_FORMAT_SESSION_KEY),
+        None,
+        None,
+    )
+
+
+async def aget_saml_session(request):
+    value = await request.session.aget(SAML_SESSION_KEY)
+    if value is not None:
+        return SAMLSession(*value)
+    idp_id = await request.session.aget(IDP_SESSION_KEY)
+    if idp_id is None:
+        return None
+    return SAMLSession(
+        idp_id,
+        await request.session.aget(NAMEID_SESSION_KEY),
+        await request.session.aget(NAMEID_FORMAT_SESSION_KEY),
+        None,
+        None,
+    )
+
+
+def is_logged_in_by(request, idp):
+    """
+    Whether the current session's user was logged in by `idp`.
+    """
+    saml_session = get_saml_session(request)
+    return (
+        request.user.is_authenticated
+        and saml_session is not None
+        and saml_session.idp_id == idp.pk
+    )
+
+
+async def ais_logged_in_by(request, idp):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return False
+    saml_session = await aget_saml_session(request)
+    return saml_session is not None and saml_session.idp_id == idp.pk
 
 
 def get_session_idp(request):
-    return IdP.objects.filter(pk=request.session.get(IDP_SESSION_KEY)).first()
+    """
+    Returns the IdP the current session was logged in with (with its large fields
+    deferred), or None. The IdP is cached for the rest of the request, and in-process
+    for `SP_IDP_CACHE_TIMEOUT` seconds, so this can be called on every page.
+    """
+    saml_session = get_saml_session(request)
+    if saml_session is None:
+        return None
+    cached = getattr(request, "_sp_session_idp", None)
+    if cached is not None and cached[0] == saml_session.idp_id:
+        return cached[1]
+    idp = session_idp_cache.get(saml_session.idp_id)
+    if idp is None:
+        idp = _session_idp_queryset(saml_session.idp_id).first() or False
+        _cache_session_idp(saml_session.idp_id, idp)
+    return _request_session_idp(request, saml_session.idp_id, idp)
+
+
+async def aget_session_idp(request):
+    saml_session = await aget_saml_session(request)
+    if saml_session is None:
+        return None
+    cached = getattr(request, "_sp_session_idp", None)
+    if cached is not None and cached[0] == saml_session.idp_id:
+        return cached[1]
+    idp = session_idp_cache.get(saml_session.idp_id)
+    if idp is None:
+        idp = await _session_idp_queryset(saml_session.idp_id).afirst() or False
+        _cache_session_idp(saml_session.idp_id, idp)
+    return _request_session_idp(request, saml_session.idp_id, idp)
+
+
+def _session_idp_queryset(pk):
+    return IdP.objects.defer(*IdP.DEFERRED_FIELDS).filter(pk=pk)
+
+
+def _cache_session_idp(pk, idp):
+    session_idp_cache.set(pk, idp, getattr(settings, "SP_IDP_CACHE_TIMEOUT", 10))
+
+
+def _request_session_idp(request, pk, idp):
+    # Each request gets its own copy, shared by every call during the request.
+    idp = copy.copy(idp) if idp else None
+    request._sp_session_idp = (pk, idp)
+    return idp
 
 
 def get_session_nameid(request):
-    return request.session.get(NAMEID_SESSION_KEY)
+    saml_session = get_saml_session(request)
+    return saml_session.nameid if saml_session else None
+
+
+async def aget_session_nameid(request):
+    saml_session = await aget_saml_session(request)
+    return saml_session.nameid if saml_session else None
 
 
 def get_session_nameid_format(request):
-    return request.session.get(NAMEID_FORMAT_SESSION_KEY)
+    saml_session = get_saml_session(request)
+    return saml_session.nameid_format if saml_session else None
+
 
+async def aget_session_nameid_format(request):
+    saml_session = await aget_saml_session(request)
+    return saml_session.nameid_format if saml_session else None
 
-def set_session_idp(request, idp, nameid, nameid_format=None):
-    request.session[IDP_SESSION_KEY] = idp.pk
-    request.session[NAMEID_SESSION_KEY] = nameid
-    if nameid_format:
-        request.session[NAMEID_FORMAT_SESSION_KEY] = nameid_format
+
+def set_session_idp(
+    request, idp, nameid, nameid_format=None, session_index=None, expires=None
+):
+    request.session[SAML_SESSION_KEY] = list(
+        SAMLSession(idp.pk, nameid, nameid_format or None, session_index, expires)
+    )
+    for key in LEGACY_SESSION_KEYS:
+        request.session.pop(key, None)
+    request._sp_session_idp = (idp.pk, idp)
+
+
+async def aset_session_idp(
+    request, idp, nameid, nameid_format=None, session_index=None, expires=None
+):
+    await request.session.aset(
+        SAML_SESSION_KEY,
+        list(
+            SAMLSession(idp.pk, nameid, nameid_format or None, session_index, expires)
+        ),
+    )
+    for key in LEGACY_SESSION_KEYS:
+        await request.session.apop(key, None)
+    request._sp_session_idp = (idp.pk, idp)
 
 
 def clear_session_idp(request):
-    for key in (IDP_SESSION_KEY, NAMEID_SESSION_KEY, NAMEID_FORMAT_SESSION_KEY):
-        try:
-            del request.session[key]
-        except KeyError:
-            pass
+    for key in (SAML_SESSION_KEY,) + LEGACY_SESSION_KEYS:
+        request.session.pop(key, None)
+    request._sp_session_idp = None
+
+
+async def aclear_session_idp(request):
+    for key in (SAML_SESSION_KEY,) + LEGACY_SESSION_KEYS:
+        await request.session.apop(key, None)
+    request._sp_session_idp = None
@@ -1,31 +1,95 @@
+from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.http.response import HttpResponseBase
 from django.shortcuts import redirect, render
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, urlencode
+from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
-from onelogin.saml2.auth import OneLogin_Saml2_Auth
-from onelogin.saml2.settings import OneLogin_Saml2_Settings
 
-from .utils import get_request_idp, get_session_nameid, get_session_nameid_format
+from . import sessions, timestamps
+from .discovery import discovery_index, get_search_params
+from .instrumentation import instrument, phase, set_idp
+from .keys import SAMLAuth
+from .slo import (
+    LogoutRequestError,
+    get_logout_request_targets,
+    is_signed_logout_request,
+    parse_soap_logout_request,
+    soap_fault_response,
+    soap_logout_response,
+)
+from .stores import get_replay_store
+from .utils import (
+    get_recorded_response,
+    get_request_idp,
+    get_saml_session,
+    get_session_nameid,
+    is_logged_in_by,
+    new_login_state_token,
+    pop_login_state,
+    record_response,
+    save_login_state,
+)
 
 
+@instrument("metadata")
 def metadata(request, **kwargs):
-    idp = get_request_idp(request, **kwargs)
-    saml_settings = OneLogin_Saml2_Settings(
-        settings=idp.sp_settings, sp_validation_only=True
+    with phase("lookup"):
+        idp = get_request_idp(request, **kwargs)
+    set_idp(idp)
+    with phase("build"):
+        md = idp.get_sp_metadata()
+    response = get_conditional_response(
+        request, etag=md.etag, last_modified=int(md.last_modified.timestamp())
     )
-    return HttpResponse(saml_settings.get_sp_metadata(), content_type="text/xml")
+    if response is None:
+        response = HttpResponse(md.xml, content_type="text/xml")
+    # Let clients and caches hold on to the metadata for a while, but never past the
+    # point where it (or the certificate in it) expires.
+    max_age = getattr(settings, "SP_METADATA_MAX_AGE", 3600)
+    remaining = int((md.expires - timezone.now()).total_seconds())
+    patch_cache_control(response, public=True, max_age=max(0, min(max_age, remaining)))
+    response["ETag"] = md.etag
+    response["Last-Modified"] = http_date(md.last_modified.timestamp())
+    return response
 
 
 @csrf_exempt
 @require_POST
+@instrument("acs")
 def acs(request, **kwargs):
-    idp = get_request_idp(request, **kwargs)
-    state = request.POST.get("RelayState")
-    saml = OneLogin_Saml2_Auth(idp.prepare_request(request), old_settings=idp.settings)
-    saml.process_response()
+    with phase("lookup"):
+        idp = get_request_idp(request, **kwargs)
+    set_idp(idp)
+    relay_state = request.POST.get("RelayState")
+    with phase("state"):
+        state = pop_login_state(idp, relay_state)
+    if state is None:
+        with phase("replay"):
+            redir = _replayed_login_redirect(request, idp)
+        if redir:
+            return redirect(redir)
+        return render(
+            request,
+            "sp/error.html",
+            {
+                "idp": idp,
+                "state": relay_state,
+                "reason": _("The login request has expired or was already used."),
+            },
+            status=400,
+        )
+    with phase("settings"):
+        saml = SAMLAuth(
+            idp.prepare_request(request), old_settings=idp.get_saml_settings()
+        )
+    # Parsing the response XML, and validating its signature.
+    with phase("verify"):
+        saml.process_response(request_id=state["request_id"])
     errors = saml.get_errors()
     if errors:
         return render(
@@ -33,14 +97,33 @@ def acs(request, **kwargs):
             "sp/error.html",
             {
                 "idp": idp,
-                "state": state,
+                "state": relay_state,
                 "errors": errors,
                 "reason": saml.get_last_error_reason(),
             },
             status=500,
         )
     else:
-        if state and state.startswith("test:"):
+        mode = state["mode"]
+        redir = state["redirect"]
+        with phase("replay"):
+            recorded = record_response(idp, saml, idp.get_login_redirect(redir))
+        if not recorded:
+            # A response we've already processed. If it was already used to log in this
+            # session (e.g. a double-submitted form), send the user where it went then.
+            if mode == "login" and is_logged_in_by(request, idp):
+                return redirect(get_recorded_response(idp, saml) or "/")
+            return render(
+                request,
+                "sp/error.html",
+                {
+                    "idp": idp,
+                    "state": relay_state,
+                    "reason": _("This SAML response has already been processed."),
+                },
+                status=400,
+            )
+        if mode == "test":
             attrs = []
             for saml_attr, value in saml.get_attributes().items():
                 attr, created = idp.attributes.get_or_create(saml_attribute=saml_attr)
@@ -53,14 +136,14 @@ def acs(request, **kwargs):
                     "attrs": attrs,
                     "nameid": saml.get_nameid(),
                     "nameid_format": saml.get_nameid_format(),
-                    "redir": state[5:],
+                    "redir": redir,
                 },
             )
-        elif state and state.startswith("verify:"):
+        elif mode == "verify":
             user = idp.authenticate(request, saml)
             if user == request.user:
                 # TODO: add a hook here
-                return redirect(idp.get_login_redirect(state[7:]))
+                return redirect(idp.get_login_redirect(redir))
             else:
                 return render(
                     request,
@@ -79,9 +162,9 @@ def acs(request, **kwargs):
                     return user
                 else:
                     idp.login(request, user, saml)
-                    idp.last_login = timezone.now()
-                    idp.save(update_fields=("last_login",))
-                    return redirect(idp.get_login_redirect(state))
+                    timestamps.touch(idp)
+                    with phase("redirect"):
+                        return redirect(idp.get_login_redirect(redir))
             else:
                 return render(
                     request,
@@ -95,11 +178,34 @@ def acs(request, **kwargs):
                 )
 
 
+def _replayed_login_redirect(request, idp):
+    """
+    Returns where a SAML response went when it logged in the current session, or None.
+    A double-submitted form gets here once the first submission has used up its login
+    state.
+    """
+    if get_replay_store() is None or not is_logged_in_by(request, idp):
+        return None
+    saml = SAMLAuth(idp.prepare_request(request), old_settings=idp.get_saml_settings())
+    # The InResponseTo was checked against the login request the first time.
+    saml.process_response()
+    if saml.get_errors():
+        return None
+    return get_recorded_response(idp, saml)
+
+
+@instrument("slo")
 def slo(request, **kwargs):
-    idp = get_request_idp(request, **kwargs)
-    saml = OneLogin_Saml2_Auth(idp.prepare_request(request), old_settings=idp.settings)
+    with phase("lookup"):
+        idp = get_request_idp(request, **kwargs)
+    set_idp(idp)
+    with phase("settings"):
+        saml = SAMLAuth(
+            idp.prepare_request(request), old_settings=idp.get_saml_settings()
+        )
     state = request.GET.get("RelayState")
-    redir = saml.process_slo()
+    with phase("process"):
+        redir = saml.process_slo()
     errors = saml.get_errors()
     if errors:
         return render(
@@ -115,44 +221,141 @@ def slo(request, **kwargs):
         )
     else:
         idp.logout(request)
+        if sessions.is_enabled() and is_signed_logout_request(request, saml):
+            # Also end any other sessions the IdP is logging out. Anyone can send an
+            # unsigned LogoutRequest, so those only end the current session.
+            with phase("terminate"):
+                _, nameid, session_indexes = get_logout_request_targets(
+                    saml.get_settings(), saml.get_last_request_xml()
+                )
+                sessions.terminate_sessions(idp, nameid, session_indexes)
         if not redir:
             redir = idp.get_logout_redirect(state)
         return redirect(redir)
 
 
+@csrf_exempt
+@require_POST
+@instrument("slo_soap")
+def slo_soap(request, **kwargs):
+    with phase("lookup"):
+        idp = get_request_idp(request, **kwargs)
+    set_idp(idp)
+    if not sessions.is_enabled():
+        return soap_fault_response("Back-channel logout is not enabled.")
+    with phase("settings"):
+        saml_settings = idp.get_saml_settings()
+    with phase("process"):
+        try:
+            request_id, nameid, session_indexes = parse_soap_logout_request(
+                saml_settings, request.body
+            )
+        except LogoutRequestError as e:
+            return soap_fault_response(str(e))
+    with phase("terminate"):
+        sessions.terminate_sessions(idp, nameid, session_indexes)
+    with phase("build"):
+        xml = soap_logout_response(
+            saml_settings, request_id, sign=idp.logout_response_signed
+        )
+    return HttpResponse(xml, content_type="text/xml")
+
+
+@instrument("login")
 def login(request, test=False, verify=False, **kwargs):
-    idp = get_request_idp(request, **kwargs)
-    saml = OneLogin_Saml2_Auth(idp.prepare_request(request), old_settings=idp.settings)
+    with phase("lookup"):
+        idp = get_request_idp(request, **kwargs)
+    set_idp(idp)
+    with phase("settings"):
+        saml = SAMLAuth(
+            idp.prepare_request(request), old_settings=idp.get_saml_settings()
+        )
     reauth = verify or "reauth" in request.GET
     redir = request.GET.get(REDIRECT_FIELD_NAME, "")
-    # SAML only allows RelayState to be 80 characters, make them count.
-    if test:
-        state = "test:" + redir
-    elif verify:
-        state = "verify:" + redir
-    else:
-        state = redir
     # When verifying, we want to pass the (unmapped) SAML nameid, stored in the session.
     # TODO: do we actually want UPN here, or some other specified mapped field? At least
     # Auth0 is pre-populating the email field with nameid, which is not what we want.
     nameid = get_session_nameid(request) if verify else None
-    return redirect(saml.login(state, force_authn=reauth, name_id_value_req=nameid))
+    # SAML only allows RelayState to be 80 characters, so it is just a token that refers
+    # to the state stored server-side.
+    token = new_login_state_token()
+    with phase("build"):
+        url = saml.login(token, force_authn=reauth, name_id_value_req=nameid)
+    mode = "test" if test else "verify" if verify else "login"
+    with phase("state"):
+        save_login_state(idp, token, redir, mode, saml.get_last_request_id())
+    return redirect(url)
 
 
+@instrument("logout")
 def logout(request, **kwargs):
-    idp = get_request_idp(request, **kwargs)
+    with phase("lookup"):
+        idp = get_request_idp(request, **kwargs)
+    set_idp(idp)
     redir = idp.get_logout_redirect(request.GET.get(REDIRECT_FIELD_NAME))
-    saml = OneLogin_Saml2_Auth(idp.prepare_request(request), old_settings=idp.settings)
+    with phase("settings"):
+        saml = SAMLAuth(
+            idp.prepare_request(request), old_settings=idp.get_saml_settings()
+        )
     if saml.get_slo_url() and idp.logout_triggers_slo:
         # If the IdP supports SLO, send it a logout request (it will call our SLO).
-        return redirect(
-            saml.logout(
+        saml_session = get_saml_session(request)
+        with phase("build"):
+            url = saml.logout(
                 redir,
-                name_id=get_session_nameid(request),
-                name_id_format=get_session_nameid_format(request),
+                name_id=saml_session.nameid if saml_session else None,
+                session_index=saml_session.session_index if saml_session else None,
+                name_id_format=saml_session.nameid_format if saml_session else None,
             )
-        )
+        return redirect(url)
     else:
         # Handle the logout "locally", i.e. log out via django.contrib.auth by default.
         idp.logout(request)
         return redirect(redir)
+
+
+@instrument("discovery")
+def discovery(request):
+    query, prefix, offset, limit = get_search_params(request.GET)
+    with phase("search"):
+        count, entries = discovery_index.search(query, prefix, offset, limit)
+    redir = request.GET.get(REDIRECT_FIELD_NAME)
+    return render(
+        request,
+        "sp/discovery.html",
+        {
+            "query": query,
+            "prefix": prefix,
+            "entries": entries,
+            "count": count,
+            "redir": redir,
+            "login_query": urlencode({REDIRECT_FIELD_NAME: redir}) if redir else "",
+            "previous_page": (
+                _page_query(request, max(offset - limit, 0)) if offset > 0 else None
+            ),
+            "next_page": (
+                _page_query(request, offset + limit) if offset + limit < count else None
+            ),
+        },
+    )
+
+
+def _page_query(request, offset):
+    params = request.GET.copy()
+    params["offset"] = offset
+    return params.urlencode()
+
+
+@instrument("discovery_api")
+def discovery_api(request):
+    query, prefix, offset, limit = get_search_params(request.GET)
+    with phase("search"):
+        count, entries = discovery_index.search(query, prefix, offset, limit)
+    return JsonResponse(
+        {
+            "count": count,
+            "offset": offset,
+            "limit": limit,
+            "results": [entry.as_json() for entry in entries],
+        }
+    )
@@ -0,0 +1,99 @@
+import datetime
+import functools
+import os
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.shortcuts import redirect, render
+from django.utils import timezone
+from django.views.decorators.http import require_GET
+
+from sp.models import IdP
+from sp.testing import LocalIdP, parse_message
+
+PEM_CERT_START = "-----BEGIN CERTIFICATE-----"
+
+
+@functools.lru_cache(maxsize=None)
+def get_local_idp():
+    """
+    Returns the test app's LocalIdP. Its key pair is kept in LOCAL_IDP_KEY_FILE (and
+    generated the first time), so it survives restarts.
+    """
+    path = settings.LOCAL_IDP_KEY_FILE
+    if not os.path.exists(path):
+        local_idp = LocalIdP(settings.LOCAL_IDP_URL)
+        with open(path, "w") as f:
+            f.write(local_idp.private_key + local_idp.certificate)
+        return local_idp
+    with open(path) as f:
+        private_key, certificate = f.read().split(PEM_CERT_START)
+    return LocalIdP(
+        settings.LOCAL_IDP_URL,
+        private_key=private_key,
+        certificate=PEM_CERT_START + certificate,
+    )
+
+
+def get_message_idp(local_idp, message):
+    """
+    Returns the IdP (as configured in the SP) that sent the given message.
+    """
+    for idp in IdP.objects.filter(idp_entity_id=local_idp.entity_id, is_active=True):
+        if idp.get_entity_id() == message["issuer"]:
+            return idp
+    raise Http404("No IdP is configured for {}.".format(message["issuer"]))
+
+
+def metadata(request):
+    return HttpResponse(get_local_idp().metadata(), content_type="text/xml")
+
+
+def sso(request):
+    local_idp = get_local_idp()
+    data = request.POST if request.method == "POST" else request.GET
+    message = parse_message(data.get("SAMLRequest", ""))
+    idp = get_message_idp(local_idp, message)
+    if request.method != "POST":
+        return render(
+            request,
+            "idp/login.html",
+            {
+                "idp": idp,
+                "saml_request": data["SAMLRequest"],
+                "relay_state": data.get("RelayState", ""),
+            },
+        )
+    attributes = {
+        "mail": request.POST.get("email", ""),
+        "givenName": request.POST.get("first_name", ""),
+        "sn": request.POST.get("last_name", ""),
+    }
+    response = local_idp.response(
+        idp,
+        request.POST["nameid"],
+        {name: value for name, value in attributes.items() if value},
+        in_response_to=message["id"],
+        session_expires=timezone.now() + datetime.timedelta(hours=8),
+    )
+    return render(
+        request,
+        "idp/post.html",
+        {
+            "acs": idp.get_acs(),
+            "saml_response": response,
+            "relay_state": data.get("RelayState", ""),
+        },
+    )
+
+
+@require_GET
+def slo(request):
+    local_idp = get_local_idp()
+    message = parse_message(request.GET.get("SAMLRequest", ""))
+    idp = get_message_idp(local_idp, message)
+    params = local_idp.logout_response(
+        idp, message["id"], relay_state=request.GET.get("RelayState")
+    )
+    return redirect("{}?{}".format(idp.get_slo(), urlencode(params)))
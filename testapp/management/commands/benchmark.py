@@ -0,0 +1,873 @@
+import base64
+import contextlib
+import datetime
+import json
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from urllib.parse import parse_qs, urlsplit
+
+import django
+import xmlsec
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.urls import reverse
+
+import sp
+from sp.backends import SAMLAuthenticationBackend
+from sp.crypto import generate_private_key
+from sp.keys import SIGN_TRANSFORMS, SAMLAuth, load_certificate
+from sp.models import KEY_ALGORITHM_CHOICES, IdP
+from sp.testing import DEFAULT_ATTRIBUTES, LocalIdP, parse_message
+from sp.utils import (
+    SAML_SESSION_KEY,
+    SAMLSession,
+    get_request_idp,
+    get_session_idp,
+    pop_login_state,
+    record_response,
+    update_user,
+)
+
+SET_CLAUSE = re.compile(r"\bSET\b(.*?)\bWHERE\b", re.IGNORECASE | re.DOTALL)
+
+HOST = "sp.example.com"
+BASE_URL = "https://" + HOST
+
+# The SAML dependencies that only need to be imported once the SP is actually used.
+SAML_PACKAGES = {"cryptography", "lxml", "onelogin", "xmlsec"}
+
+# Run in a fresh interpreter (with -X importtime) by the imports benchmark, which only
+# counts the imports written to stderr before SETUP_DONE.
+SETUP_DONE = "-- setup done"
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter() - start
+sys.stderr.write("-- setup done\\n")
+start = time.perf_counter()
+import sp.views
+views = time.perf_counter() - start
+print(json.dumps({"setup": setup, "views": views}))
+"""
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def aggregate(local_idp, entities):
+    """
+    Returns an EntitiesDescriptor with `entities` IdPs, the local IdP first.
+    """
+    descriptors = [local_idp.metadata()] + [
+        local_idp.metadata("{}{}/".format(local_idp.entity_id, i))
+        for i in range(1, entities)
+    ]
+    return (
+        '<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata">'
+        "{}</md:EntitiesDescriptor>".format("".join(descriptors))
+    )
+
+
+class FakeSAML:
+    """
+    Just enough of OneLogin_Saml2_Auth to map attributes without a SAML response.
+    """
+
+    def __init__(self, nameid, attributes):
+        self.nameid = nameid
+        self.attributes = attributes
+
+    def get_nameid(self):
+        return self.nameid
+
+    def get_attributes(self):
+        return self.attributes
+
+    def get_attribute(self, name):
+        return self.attributes.get(name)
+
+
+def written_columns(queries):
+    """
+    Returns the number of UPDATE statements, and the total number of columns they set.
+    """
+    updates = 0
+    columns = 0
+    for sql in queries:
+        match = SET_CLAUSE.search(sql)
+        if sql.startswith("UPDATE") and match:
+            updates += 1
+            columns += match.group(1).count("=")
+    return updates, columns
+
+
+class QueryLog:
+    """
+    Records the SQL (before parameters are substituted) of each query executed on the
+    default database connection.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return 0
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+
+class Phase:
+    """
+    The measurements for one phase of a benchmark, across all recorded iterations.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+        self.queries = []
+        self.updates = []
+        self.columns = []
+        self.peaks = []
+        self.retained = []
+
+    def add(self, elapsed, queries):
+        self.times.append(elapsed)
+        updates, columns = written_columns(queries)
+        self.queries.append(len(queries))
+        self.updates.append(updates)
+        self.columns.append(columns)
+
+    def summary(self):
+        times = sorted(self.times)
+        total = sum(times)
+        count = len(times)
+        summary = {
+            "name": self.name,
+            "iterations": count,
+            "mean_ms": total * 1000 / count if count else 0,
+            "p50_ms": percentile(times, 50) * 1000,
+            "p90_ms": percentile(times, 90) * 1000,
+            "p99_ms": percentile(times, 99) * 1000,
+            "max_ms": times[-1] * 1000 if times else 0,
+            "ops_per_sec": count / total if total else 0,
+            "queries": sum(self.queries) / count if count else 0,
+            "queries_min": min(self.queries, default=0),
+            "queries_max": max(self.queries, default=0),
+            "updates": sum(self.updates) / count if count else 0,
+            "columns": sum(self.columns) / count if count else 0,
+            "peak_kib": None,
+            "retained_kib": None,
+        }
+        if self.peaks:
+            summary["peak_kib"] = sum(self.peaks) / len(self.peaks) / 1024
+            summary["retained_kib"] = sum(self.retained) / len(self.retained) / 1024
+        return summary
+
+
+class Bench:
+    """
+    Runs a benchmark's iterations, recording the time, database queries, and (when
+    tracing allocations) memory of each phase. Work outside of a phase, such as
+    minting SAML responses, isn't measured.
+    """
+
+    # The Bench currently running, for code (like TimedBackend) that isn't passed one.
+    active = None
+
+    def __init__(self, idp, local_idp, options):
+        self.idp = idp
+        self.local_idp = local_idp
+        self.options = options
+        self.phases = {}
+        self.recording = False
+        self.tracing = False
+        self.client = Client(HTTP_HOST=HOST)
+        self.factory = RequestFactory(HTTP_HOST=HOST)
+        self._stack = []
+
+    def run(self, func, iterations, warmup, tracing=False):
+        self.tracing = tracing
+        Bench.active = self
+        if tracing:
+            tracemalloc.start()
+        try:
+            func(self, self._iterations(iterations, warmup))
+        finally:
+            if tracing:
+                tracemalloc.stop()
+            self.tracing = False
+            Bench.active = None
+
+    def _iterations(self, iterations, warmup):
+        for i in range(warmup + iterations):
+            self.recording = i >= warmup
+            yield i
+        self.recording = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.recording:
+            yield
+            return
+        frame = {"peak": 0, "current": 0}
+        if self.tracing:
+            # Phases may be nested, so fold the peak so far into the enclosing phases
+            # before resetting it.
+            current, peak = tracemalloc.get_traced_memory()
+            for outer in self._stack:
+                outer["peak"] = max(outer["peak"], peak)
+            tracemalloc.reset_peak()
+            frame["current"] = current
+        self._stack.append(frame)
+        with QueryLog() as log:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                elapsed = time.perf_counter() - start
+                self._stack.pop()
+        stats = self.phases.setdefault(name, Phase(name))
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(frame["peak"], peak)
+            for outer in self._stack:
+                outer["peak"] = max(outer["peak"], peak)
+            stats.peaks.append(peak - frame["current"])
+            stats.retained.append(current - frame["current"])
+        else:
+            stats.add(elapsed, log.queries)
+
+    def record(self, name, elapsed):
+        """
+        Records a time measured outside of this process (with no queries) for a phase.
+        """
+        if self.recording:
+            self.phases.setdefault(name, Phase(name)).add(elapsed, [])
+
+    def login_request(self):
+        """
+        Starts an SP-initiated login, returning the RelayState and AuthnRequest ID.
+        """
+        response = self.client.get(self.idp.get_login_url(), secure=True)
+        self.check(response, 302)
+        query = parse_qs(urlsplit(response["Location"]).query)
+        request = parse_message(query["SAMLRequest"][0])
+        return query["RelayState"][0], request["id"]
+
+    def check(self, response, status):
+        if response.status_code != status:
+            raise CommandError(
+                "{} returned {} (expected {}).".format(
+                    response.request["PATH_INFO"], response.status_code, status
+                )
+            )
+
+    def saml_response(self, nameid, in_response_to, seq=0):
+        attributes = {
+            "mail": "{}@example.com".format(nameid),
+            "givenName": "Bench {}".format(seq),
+            "sn": "User",
+        }
+        return self.local_idp.response(self.idp, nameid, attributes, in_response_to)
+
+
+class TimedBackend(SAMLAuthenticationBackend):
+    """
+    Times update_user as its own phase of authentication.
+    """
+
+    def update_user(self, request, idp, saml, user, created):
+        with Bench.active.phase("update_user"):
+            return super().update_user(request, idp, saml, user, created)
+
+
+def legacy_update_user(request, idp, saml, user, created=None):
+    """
+    The update_user behavior prior to field plans, for comparison: every changed login
+    validates the whole model and rewrites every column.
+    """
+    attrs = idp.mapped_attributes(saml)
+    always_update = set(
+        idp.attributes.filter(always_update=True).values_list("mapped_name", flat=True)
+    )
+    changed = False
+    for field, values in attrs.items():
+        if created or field in always_update:
+            f = user._meta.get_field(field)
+            if values[0] != getattr(user, f.attname):
+                setattr(user, f.attname, values[0])
+                changed = True
+    if created or changed:
+        user.full_clean(validate_unique=False)
+        user.save()
+    return user
+
+
+def bench_update_user(bench, iterations):
+    """
+    Logs in an existing user whose always-updated attributes change on every login,
+    with the legacy and field plan implementations of update_user. Each has its own
+    user, so both see (and write) the changed attributes.
+    """
+    User = get_user_model()
+    idp = IdP.objects.get(pk=bench.idp.pk)
+    versions = [
+        (
+            name,
+            func,
+            User.objects.create_user("bench-" + uuid.uuid4().hex, "bench@example.com"),
+        )
+        for name, func in (("legacy", legacy_update_user), ("field plan", update_user))
+    ]
+    for i in iterations:
+        attributes = {
+            "mail": ["bench{}@example.com".format(i)],
+            "givenName": ["Bench {}".format(i)],
+            "sn": ["User"],
+        }
+        for name, func, user in versions:
+            saml = FakeSAML(user.username, attributes)
+            with bench.phase(name):
+                func(None, idp, saml, user, created=False)
+
+
+def bench_metadata(bench, iterations):
+    """
+    Serves the SP metadata.
+    """
+    url = bench.idp.get_absolute_url()
+    for i in iterations:
+        with bench.phase("metadata"):
+            response = bench.client.get(url, secure=True)
+        bench.check(response, 200)
+
+
+def bench_login(bench, iterations):
+    """
+    Builds an AuthnRequest and redirects to the IdP.
+    """
+    url = bench.idp.get_login_url()
+    for i in iterations:
+        with bench.phase("login"):
+            response = bench.client.get(url, secure=True)
+        bench.check(response, 302)
+
+
+def bench_acs(bench, iterations):
+    """
+    Posts a response for a returning user to the ACS.
+    """
+    nameid = "returning-" + uuid.uuid4().hex
+    url = bench.idp.get_url("sp-idp-acs")
+    for i in iterations:
+        relay_state, request_id = bench.login_request()
+        data = {
+            "SAMLResponse": bench.saml_response(nameid, request_id, i),
+            "RelayState": relay_state,
+        }
+        with bench.phase("acs"):
+            response = bench.client.post(url, data, secure=True)
+        bench.check(response, 302)
+
+
+def bench_acs_new(bench, iterations):
+    """
+    Posts a response for a new user to the ACS.
+    """
+    url = bench.idp.get_url("sp-idp-acs")
+    for i in iterations:
+        relay_state, request_id = bench.login_request()
+        data = {
+            "SAMLResponse": bench.saml_response("new-" + uuid.uuid4().hex, request_id),
+            "RelayState": relay_state,
+        }
+        with bench.phase("acs"):
+            response = bench.client.post(url, data, secure=True)
+        bench.check(response, 302)
+
+
+def bench_acs_phases(bench, iterations):
+    """
+    Runs each step of the ACS view for a returning user as a separate phase.
+    """
+    nameid = "phases-" + uuid.uuid4().hex
+    url = bench.idp.get_url("sp-idp-acs")
+    url_params = bench.idp.url_params
+    backend = TimedBackend()
+    backend_path = "sp.backends.SAMLAuthenticationBackend"
+    for i in iterations:
+        relay_state, request_id = bench.login_request()
+        data = {
+            "SAMLResponse": bench.saml_response(nameid, request_id, i),
+            "RelayState": relay_state,
+        }
+        request = bench.factory.post(url, data, secure=True)
+        SessionMiddleware(lambda request: None).process_request(request)
+        with bench.phase("lookup"):
+            idp = get_request_idp(request, **url_params)
+        with bench.phase("state"):
+            state = pop_login_state(idp, relay_state)
+        with bench.phase("settings"):
+            saml = SAMLAuth(
+                idp.prepare_request(request), old_settings=idp.get_saml_settings()
+            )
+        with bench.phase("verify"):
+            saml.process_response(request_id=state["request_id"])
+        if saml.get_errors():
+            raise CommandError(saml.get_last_error_reason())
+        with bench.phase("replay"):
+            record_response(idp, saml)
+        with bench.phase("authenticate"):
+            user = backend.authenticate(request, idp=idp, saml=saml)
+        user.backend = backend_path
+        with bench.phase("login"):
+            idp.login(request, user, saml)
+            request.session.save()
+
+
+def bench_slo(bench, iterations):
+    """
+    Processes an IdP-initiated LogoutRequest for a logged in user.
+    """
+    User = get_user_model()
+    nameid = "slo-" + uuid.uuid4().hex
+    user = User.objects.create_user(nameid)
+    url = bench.idp.get_url("sp-idp-slo")
+    for i in iterations:
+        bench.client.force_login(user)
+        session = bench.client.session
+        session[SAML_SESSION_KEY] = list(
+            SAMLSession(bench.idp.pk, nameid, None, None, None)
+        )
+        session.save()
+        data = bench.local_idp.logout_request(bench.idp, nameid)
+        with bench.phase("slo"):
+            response = bench.client.get(url, data, secure=True)
+        bench.check(response, 302)
+
+
+def bench_logout(bench, iterations):
+    """
+    Builds and signs a LogoutRequest for a logged in user.
+    """
+    User = get_user_model()
+    nameid = "logout-" + uuid.uuid4().hex
+    user = User.objects.create_user(nameid)
+    IdP.objects.filter(pk=bench.idp.pk).update(
+        logout_triggers_slo=True,
+        logout_request_signed=True,
+        updated=datetime.datetime.now(datetime.timezone.utc),
+    )
+    url = bench.idp.get_logout_url()
+    bench.client.force_login(user)
+    session = bench.client.session
+    session[SAML_SESSION_KEY] = list(
+        SAMLSession(bench.idp.pk, nameid, None, None, None)
+    )
+    session.save()
+    for i in iterations:
+        with bench.phase("logout"):
+            response = bench.client.get(url, secure=True)
+        bench.check(response, 302)
+
+
+def bench_keys(bench, iterations):
+    """
+    Generates an SP private key, and builds and signs a LogoutRequest for the
+    HTTP-Redirect binding (and verifies its signature, as the IdP would), with each of
+    the key algorithms.
+    """
+    auth_args = {}
+    for algorithm, _ in KEY_ALGORITHM_CHOICES:
+        idp = IdP.objects.get(pk=bench.idp.pk)
+        idp.pk = None
+        idp.url_params = {"idp_slug": "keys-{}".format(uuid.uuid4().hex[:8])}
+        idp.key_algorithm = algorithm
+        idp.logout_request_signed = True
+        idp.generate_certificate()
+        request = bench.factory.get(idp.get_logout_url(), secure=True)
+        auth_args[algorithm] = (
+            idp.prepare_request(request),
+            idp.get_saml_settings(),
+            load_certificate(idp.x509_certificate).xmlsec_key,
+        )
+    for i in iterations:
+        for algorithm, (request_data, saml_settings, key) in auth_args.items():
+            with bench.phase("keygen " + algorithm):
+                generate_private_key(algorithm)
+            with bench.phase("sign " + algorithm):
+                url = SAMLAuth(request_data, old_settings=saml_settings).logout(
+                    name_id="bench"
+                )
+            query = parse_qs(urlsplit(url).query)
+            signed = SAMLAuth._build_sign_query(
+                query["SAMLRequest"][0],
+                query["RelayState"][0],
+                query["SigAlg"][0],
+                "SAMLRequest",
+            )
+            with bench.phase("verify " + algorithm):
+                ctx = xmlsec.SignatureContext()
+                ctx.key = key
+                ctx.verify_binary(
+                    signed.encode("utf-8"),
+                    SIGN_TRANSFORMS[query["SigAlg"][0]],
+                    base64.b64decode(query["Signature"][0]),
+                )
+
+
+def bench_discovery(bench, iterations):
+    """
+    Lists and searches `--entities` active IdPs through the discovery API.
+    """
+    idps = []
+    for n in range(bench.options["entities"]):
+        url_params = {"idp_slug": "discovery-{}".format(n)}
+        idps.append(
+            IdP(
+                name="Organization {:05d}".format(n),
+                url_params=url_params,
+                lookup_key=IdP.make_lookup_key(url_params),
+                idp_entity_id="https://idp{}.example.edu/".format(n),
+                base_url=BASE_URL,
+                contact_name="Benchmark",
+                contact_email="benchmark@example.com",
+            )
+        )
+    idps = IdP.objects.bulk_create(idps)
+    url = reverse("sp-discovery-api")
+    # Build the index before timing anything.
+    bench.client.get(url, secure=True)
+    for i in iterations:
+        with bench.phase("list"):
+            response = bench.client.get(url, {"offset": i % 50 * 20}, secure=True)
+        bench.check(response, 200)
+        with bench.phase("search"):
+            response = bench.client.get(url, {"q": "{:03d}".format(i)}, secure=True)
+        bench.check(response, 200)
+        with bench.phase("prefix"):
+            response = bench.client.get(
+                url,
+                {"q": "organization 0{}".format(i % 10), "match": "prefix"},
+                secure=True,
+            )
+        bench.check(response, 200)
+    IdP.objects.filter(pk__in=[idp.pk for idp in idps]).delete()
+
+
+def bench_session_idp(bench, iterations):
+    """
+    Looks up the IdP a session was logged in with, twice per request (as middleware
+    and a template might).
+    """
+    session = bench.client.session
+    session[SAML_SESSION_KEY] = list(
+        SAMLSession(bench.idp.pk, "session-idp", None, None, None)
+    )
+    session.save()
+    for i in iterations:
+        request = bench.factory.get("/", secure=True)
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session.session_key
+        SessionMiddleware(lambda request: None).process_request(request)
+        with bench.phase("session_idp"):
+            get_session_idp(request)
+            get_session_idp(request)
+
+
+def bench_import_metadata(bench, iterations):
+    """
+    Imports a large (aggregate) metadata document.
+    """
+    xml = aggregate(bench.local_idp, bench.options["entities"])
+    idp = IdP.objects.get(pk=bench.idp.pk)
+    for i in iterations:
+        idp.metadata_xml = xml
+        with bench.phase("import_metadata"):
+            idp.import_metadata()
+
+
+def saml_import_time(importtime):
+    """
+    Returns the total cumulative time (in seconds) of importing SAML_PACKAGES, from the
+    output of `python -X importtime`, counting only the outermost of nested imports.
+    """
+    total = 0
+    # Imports are listed after the modules they import, so walk them backwards to see
+    # each module before its dependencies.
+    ancestors = []
+    for line in reversed(importtime.splitlines()):
+        match = IMPORT_TIME.match(line)
+        if not match:
+            continue
+        depth = len(match.group(3))
+        while ancestors and ancestors[-1] >= depth:
+            ancestors.pop()
+        if match.group(4).split(".")[0] in SAML_PACKAGES:
+            if not ancestors:
+                total += int(match.group(2))
+            ancestors.append(depth)
+    return total / 1e6
+
+
+def bench_imports(bench, iterations):
+    """
+    Starts Django in a fresh interpreter, timing django.setup(), the SAML dependencies
+    it imports, and importing sp.views afterwards.
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+    for i in iterations:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT],
+            cwd=settings.BASE_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode:
+            raise CommandError(result.stderr)
+        times = json.loads(result.stdout)
+        bench.record("django.setup", times["setup"])
+        setup_imports = result.stderr.split(SETUP_DONE)[0]
+        bench.record("saml imports", saml_import_time(setup_imports))
+        bench.record("import sp.views", times["views"])
+
+
+BENCHMARKS = {
+    "update_user": bench_update_user,
+    "metadata": bench_metadata,
+    "login": bench_login,
+    "acs": bench_acs,
+    "acs_new": bench_acs_new,
+    "acs_phases": bench_acs_phases,
+    "slo": bench_slo,
+    "logout": bench_logout,
+    "import_metadata": bench_import_metadata,
+    "session_idp": bench_session_idp,
+    "keys": bench_keys,
+    "discovery": bench_discovery,
+    "imports": bench_imports,
+}
+
+# Benchmarks that start a new process per iteration, so they run fewer iterations and
+# don't trace allocations.
+STARTUP_BENCHMARKS = {"imports"}
+
+
+def environment():
+    try:
+        db_version = ".".join(str(v) for v in connection.get_database_version())
+    except Exception:
+        db_version = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "sp": sp.__version__,
+        "database": connection.vendor,
+        "database_version": db_version,
+        "platform": platform.platform(),
+    }
+
+
+class Command(BaseCommand):
+    help = "Runs offline benchmarks of the SP against a throwaway test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "benchmarks",
+            nargs="*",
+            metavar="benchmark",
+            help="Benchmarks to run (default: all). Choices: {}".format(
+                ", ".join(BENCHMARKS)
+            ),
+        )
+        parser.add_argument(
+            "-n",
+            "--iterations",
+            type=int,
+            default=200,
+            help="Number of measured iterations per benchmark (default: 200).",
+        )
+        parser.add_argument(
+            "--warmup",
+            type=int,
+            default=10,
+            help="Number of unmeasured iterations to run first (default: 10).",
+        )
+        parser.add_argument(
+            "--alloc-iterations",
+            type=int,
+            default=20,
+            help="Number of iterations to trace memory allocations for, in a separate "
+            "run after timing (default: 20, 0 to skip).",
+        )
+        parser.add_argument(
+            "--entities",
+            type=int,
+            default=1000,
+            help="Number of entities in the import_metadata document (default: 1000).",
+        )
+        parser.add_argument(
+            "--startup-iterations",
+            type=int,
+            default=20,
+            help="Number of measured iterations of the imports benchmark, which starts "
+            "a new Python process for each (default: 20).",
+        )
+        parser.add_argument(
+            "--json",
+            metavar="PATH",
+            help='Write the results as JSON to PATH ("-" for stdout).',
+        )
+        parser.add_argument(
+            "--compare",
+            metavar="PATH",
+            help="Compare the results to a previous --json run.",
+        )
+
+    def handle(self, *args, **options):
+        names = options["benchmarks"] or list(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark: {}".format(name))
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = {
+                    (b["name"], p["name"]): p
+                    for b in json.load(f)["benchmarks"]
+                    for p in b["phases"]
+                }
+        # Human-readable output goes to stderr when the JSON goes to stdout.
+        out = self.stderr if options["json"] == "-" else self.stdout
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            local_idp = LocalIdP()
+            results = {
+                "environment": environment(),
+                "options": {
+                    key: options[key]
+                    for key in (
+                        "iterations",
+                        "warmup",
+                        "alloc_iterations",
+                        "entities",
+                        "startup_iterations",
+                    )
+                },
+                "benchmarks": [],
+            }
+            out.write(
+                "{database} {database_version}, Python {python}, "
+                "Django {django}".format(**results["environment"])
+            )
+            for name in names:
+                phases = self.run_benchmark(name, local_idp, options)
+                results["benchmarks"].append({"name": name, "phases": phases})
+                out.write(name)
+                for phase in phases:
+                    out.write(self.format_phase(phase))
+                    previous = baseline and baseline.get((name, phase["name"]))
+                    if previous:
+                        out.write(self.format_change(phase, previous))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        if options["json"] == "-":
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        elif options["json"]:
+            with open(options["json"], "w") as f:
+                json.dump(results, f, indent=2)
+
+    def make_idp(self, name, local_idp):
+        idp = local_idp.create_idp(
+            attributes={},
+            name="Benchmark",
+            url_params={"idp_slug": "{}-{}".format(name, uuid.uuid4().hex[:8])},
+            base_url=BASE_URL,
+            contact_name="Benchmark",
+            contact_email="benchmark@example.com",
+        )
+        for saml_attribute, mapped_name in DEFAULT_ATTRIBUTES.items():
+            idp.attributes.create(
+                saml_attribute=saml_attribute,
+                mapped_name=mapped_name,
+                always_update=mapped_name != "last_name",
+            )
+        return idp
+
+    def run_benchmark(self, name, local_idp, options):
+        func = BENCHMARKS[name]
+        iterations, warmup = options["iterations"], options["warmup"]
+        alloc_iterations = options["alloc_iterations"]
+        if name in STARTUP_BENCHMARKS:
+            iterations, warmup, alloc_iterations = options["startup_iterations"], 1, 0
+        bench = Bench(self.make_idp(name, local_idp), local_idp, options)
+        bench.run(func, iterations, warmup)
+        phases = {p.name: p.summary() for p in bench.phases.values()}
+        if alloc_iterations > 0:
+            # Tracing slows everything down, so allocations are measured separately.
+            traced = Bench(self.make_idp(name, local_idp), local_idp, options)
+            traced.run(func, alloc_iterations, 1, tracing=True)
+            for phase in traced.phases.values():
+                summary = phase.summary()
+                phases[phase.name]["peak_kib"] = summary["peak_kib"]
+                phases[phase.name]["retained_kib"] = summary["retained_kib"]
+        return list(phases.values())
+
+    def format_phase(self, phase):
+        queries = "{:6.2f}".format(phase["queries"])
+        if phase["queries_min"] != phase["queries_max"]:
+            queries += " ({}-{})".format(phase["queries_min"], phase["queries_max"])
+        line = (
+            "  {name:<16} p50 {p50_ms:8.3f} ms  p90 {p90_ms:8.3f} ms  "
+            "p99 {p99_ms:8.3f} ms  {ops_per_sec:9.1f}/s  "
+            "{updates:4.2f} updates  {columns:4.2f} columns".format(**phase)
+        )
+        line += "  {} queries".format(queries)
+        if phase["peak_kib"] is not None:
+            line += "  {:8.1f} KiB peak  {:8.1f} KiB retained".format(
+                phase["peak_kib"], phase["retained_kib"]
+            )
+        return line
+
+    def format_change(self, phase, previous):
+        def change(key):
+            if not previous.get(key):
+                return "n/a"
+            return "{:+.1f}%".format((phase[key] / previous[key] - 1) * 100)
+
+        return "  {:<16} vs. baseline: p50 {}  p99 {}  queries {:+.2f}".format(
+            "",
+            change("p50_ms"),
+            change("p99_ms"),
+            phase["queries"] - previous["queries"],
+        )
@@ -54,6 +54,18 @@ DATABASES = {
     }
 }
 
+# Set POSTGRES_DB (and optionally the other POSTGRES_* variables) to use a local
+# PostgreSQL database instead, e.g. for benchmarking.
+if os.environ.get("POSTGRES_DB"):
+    DATABASES["default"] = {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ["POSTGRES_DB"],
+        "USER": os.environ.get("POSTGRES_USER", ""),
+        "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
+        "HOST": os.environ.get("POSTGRES_HOST", ""),
+        "PORT": os.environ.get("POSTGRES_PORT", ""),
+    }
+
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
 LANGUAGE_CODE = "en-us"
@@ -71,3 +83,11 @@ AUTHENTICATION_BACKENDS = [
 
 LOGIN_REDIRECT_URL = "home"
 LOGOUT_REDIRECT_URL = "home"
+
+# The test app runs in a single process, so the local memory cache is enough for the
+# replay store.
+SILENCED_SYSTEM_CHECKS = ["sp.W002"]
+
+# The built-in stand-in IdP (see testapp.idp), and where its key pair is kept.
+LOCAL_IDP_URL = "http://localhost:8000/idp"
+LOCAL_IDP_KEY_FILE = os.path.join(BASE_DIR, "local_idp.pem")
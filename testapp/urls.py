@@ -1,10 +1,14 @@
 from django.contrib import admin
 from django.urls import include, path
 
-from . import views
+from . import idp, views
 
 urlpatterns = [
     path("", views.home, name="home"),
     path("sso/<idp_slug>/", include("sp.urls")),
+    path("discovery/", include("sp.discovery_urls")),
+    path("idp/metadata/", idp.metadata, name="idp-metadata"),
+    path("idp/sso/", idp.sso, name="idp-sso"),
+    path("idp/slo/", idp.slo, name="idp-slo"),
     path("admin/", admin.site.urls),
 ]